@@ -0,0 +1,271 @@
+import re
+import threading
+from time import sleep
+from benchmarks.synthetic_schema import generate_rows
+
+SOURCE_SELECT = re.compile(
+    r"^\s*SELECT\s+(?P<columns>.+?)\s+FROM\s+\[(?P<schema>\w+)\]\.\[(?P<table>\w+)\]"
+    r"(?P<where>\s+WHERE\s.+)?\s*$",
+    re.DOTALL,
+)
+STAGE_TABLE = re.compile(r"\[STAGE\]\.\[(?P<table>\w+)\]")
+KEY_MAP_NAME = re.compile(r"KeyMap_\w+")
+CREATED_KEY_MAP = re.compile(r"CREATE TABLE \[STAGE\]\.\[(KeyMap_\w+)\]")
+KEY_COMPARISON = re.compile(r"\[(?P<column>\w+)\] (?P<operator><|>=|>) \?")
+HISTOGRAM_STEPS = 200
+
+
+class FakeServer:
+    """Shared state behind FakeConnection, standing in for one SQL Server database.
+    Source rows come from the synthetic schema generator.  On the destination only row
+    counts are tracked: stage tables and key maps, enough for the rowcounts and result
+    sets the pipeline reads back.  latency_ms is charged per round trip and row_cost_us
+    per row sent or received, so network bound settings like chunk size show up."""
+
+    def __init__(self, schema, latency_ms=0.0, row_cost_us=0.0):
+        self.schema = schema
+        self.latency_seconds = latency_ms / 1000
+        self.row_cost_seconds = row_cost_us / 1_000_000
+        self.lock = threading.Lock()
+        self.stage_rows = {}
+        self.key_maps = set()
+        self.generated_rows = {}
+        self.stats = {"round_trips": 0, "statements": 0, "rows_sent": 0, "rows_received": 0}
+
+    def round_trip(self, rows_sent=0, rows_received=0, statements=0):
+        with self.lock:
+            self.stats["round_trips"] += 1
+            self.stats["statements"] += statements
+            self.stats["rows_sent"] += rows_sent
+            self.stats["rows_received"] += rows_received
+        cost = self.latency_seconds + (rows_sent + rows_received) * self.row_cost_seconds
+        if cost > 0:
+            sleep(cost)
+
+    def cached_rows(self, table_name, columns):
+        "generated rows kept in memory, so key ranges do not generate the table once each"
+        key = (table_name, tuple(columns))
+        with self.lock:
+            if key not in self.generated_rows:
+                self.generated_rows[key] = list(generate_rows(self.schema, table_name, columns))
+            return self.generated_rows[key]
+
+    def stage_row_count(self, sql):
+        "rows in the first stage table a statement touches, used as its rowcount"
+        for match in STAGE_TABLE.finditer(sql):
+            table_name = match.group("table")
+            if not table_name.startswith("KeyMap_"):
+                with self.lock:
+                    return self.stage_rows.get(table_name, 0)
+        return -1
+
+
+def filter_rows(rows, columns, where, params):
+    """Apply a copy WHERE clause to generated rows.  A delta copy past a watermark (>)
+    finds nothing new in generated rows; key ranges (< and >=) are applied as such."""
+    if not where:
+        return iter(rows)
+    comparisons = [
+        (match.group("column"), match.group("operator"), value)
+        for match, value in zip(KEY_COMPARISON.finditer(where), params)
+    ]
+    if any(operator == ">" for _, operator, _ in comparisons):
+        return iter(())
+
+    def in_range(row):
+        for column, operator, value in comparisons:
+            key = row[columns.index(column)]
+            if operator == "<" and not key < value:
+                return False
+            if operator == ">=" and not key >= value:
+                return False
+        return True
+
+    return (row for row in rows if in_range(row))
+
+
+def build_histogram(server: "FakeServer", table_name):
+    "(range_high_key, rows) steps over the generated values of the leading key column"
+    definition = server.schema["tables"][table_name]
+    if not definition["pk"]:
+        return []
+    values = sorted(row[0] for row in server.cached_rows(table_name, definition["pk"][:1]))
+    step_size = max(1, -(-len(values) // HISTOGRAM_STEPS))
+
+    histogram = []
+    for start in range(0, len(values), step_size):
+        step = values[start : start + step_size]
+        histogram.append((step[-1], len(step)))
+    return histogram
+
+
+class FakeCursor:
+    "the slice of the pyodbc cursor API the migration uses"
+
+    def __init__(self, server: FakeServer):
+        self.server = server
+        self.fast_executemany = False
+        self.rowcount = -1
+        self.results = iter(())
+
+    def execute(self, sql, *params):
+        server = self.server
+        self.rowcount = -1
+        self.results = iter(())
+        # TvpWriter, the first two items of the parameter are the type name and schema
+        tvp_rows = params[0][2:] if sql.rstrip().endswith("FROM ?") else []
+        server.round_trip(rows_sent=len(tvp_rows), statements=1)
+
+        # SELECT ... INTO creates a stage table, it is not a source read
+        source_select = SOURCE_SELECT.match(sql) if " INTO " not in sql else None
+        if source_select and source_select.group("schema") == "STAGE":
+            # Reads of a stage table, such as the key range of a batched merge
+            source_select = None
+        if source_select and source_select.group("table") in server.schema["tables"]:
+            table_name = source_select.group("table")
+            if source_select.group("columns").startswith("MAX("):
+                # Watermark reads: the generated rows never change, so neither does the mark
+                self.results = iter([(server.schema["tables"][table_name]["rows"],)])
+            else:
+                columns = [
+                    col.strip().strip("[]")
+                    for col in source_select.group("columns").split(",")
+                ]
+                if source_select.group("where"):
+                    self.results = filter_rows(
+                        server.cached_rows(table_name, columns),
+                        columns,
+                        source_select.group("where"),
+                        params,
+                    )
+                else:
+                    self.results = generate_rows(server.schema, table_name, columns)
+        elif "sys.dm_db_stats_histogram" in sql:
+            # plan_copy_ranges, the histogram of the leading key column
+            table_name = re.search(r"OBJECT_ID\('\w+\.(\w+)'\)", sql).group(1)
+            self.results = iter(build_histogram(server, table_name))
+        elif "SELECT @counted_rows" in sql:
+            # An INSERT ... SELECT merge from run_merge_query
+            self.results = iter([(server.stage_row_count(sql),)])
+        elif "SELECT @merged_rows" in sql:
+            # A whole table batch from run_table_batch
+            with server.lock:
+                server.key_maps.update(CREATED_KEY_MAP.findall(sql))
+            self.results = iter([(server.stage_row_count(sql),)])
+        elif "FROM sys.columns" in sql and "column_type" in sql:
+            # get_column_type_definitions
+            table_name = re.search(r"OBJECT_ID\('\w+\.(\w+)'\)", sql).group(1)
+            self.results = iter(
+                [
+                    (
+                        col["name"],
+                        "decimal(18, 2)" if col["data_type"] == "decimal" else col["data_type"],
+                    )
+                    for col in server.schema["tables"][table_name]["columns"]
+                ]
+            )
+        elif "FROM sys.indexes" in sql and "is_disabled" in sql:
+            # get_wave_indexes, one index per FK column
+            self.results = iter(
+                [
+                    (table_name, f"IX_{table_name}_{parent_column}")
+                    for table_name in re.findall(r"'(\w+)'", sql.split(" IN ")[-1])
+                    for parent_column, _, _ in server.schema["tables"][table_name]["fks"]
+                ]
+            )
+        elif "FROM sys.foreign_keys" in sql:
+            # get_wave_foreign_keys
+            self.results = iter(
+                [
+                    (table_name, f"FK_{table_name}_{referenced_table}")
+                    for table_name in re.findall(r"'(\w+)'", sql.split(" IN ")[-1])
+                    for _, referenced_table, _ in server.schema["tables"][table_name]["fks"]
+                ]
+            )
+        elif "SERVERPROPERTY('EngineEdition')" in sql:
+            # Standard edition, index builds run serially
+            self.results = iter([(2,)])
+        elif tvp_rows:
+            self.add_stage_rows(sql, len(tvp_rows))
+            self.rowcount = len(tvp_rows)
+        elif "KeyMap[_]" in sql:
+            with server.lock:
+                self.results = iter([(name,) for name in sorted(server.key_maps)])
+        elif "COUNT(*)" in sql and "INFORMATION_SCHEMA.COLUMNS" in sql:
+            self.results = iter([(1,)])
+        elif "MIN(" in sql and "MAX(" in sql:
+            self.results = iter([(1, server.stage_row_count(sql))])
+        elif "CREATE TABLE" in sql and KEY_MAP_NAME.search(sql):
+            with server.lock:
+                server.key_maps.add(KEY_MAP_NAME.search(sql).group(0))
+        elif sql.lstrip().startswith("DROP TABLE") and KEY_MAP_NAME.search(sql):
+            with server.lock:
+                server.key_maps.discard(KEY_MAP_NAME.search(sql).group(0))
+        elif "SELECT TOP 0" in sql or "TRUNCATE TABLE" in sql:
+            match = STAGE_TABLE.search(sql)
+            with server.lock:
+                server.stage_rows[match.group("table")] = 0
+        elif "[Stage_Duplicate] = 1" in sql and "INNER JOIN" in sql:
+            # mark_duplicate_stage_rows, generated unique values never conflict
+            self.rowcount = 0
+        elif re.match(r"^\s*(UPDATE|MERGE|INSERT|WITH|DECLARE|SET NOCOUNT)", sql):
+            self.rowcount = server.stage_row_count(sql)
+
+        return self
+
+    def executemany(self, sql, rows):
+        server = self.server
+        rows = list(rows)
+        if self.fast_executemany:
+            server.round_trip(rows_sent=len(rows), statements=len(rows))
+        else:
+            for _ in rows:
+                server.round_trip(rows_sent=1, statements=1)
+
+        self.add_stage_rows(sql, len(rows))
+        self.rowcount = len(rows)
+
+    def add_stage_rows(self, sql, row_count):
+        match = STAGE_TABLE.search(sql)
+        if match:
+            with self.server.lock:
+                table_name = match.group("table")
+                self.server.stage_rows[table_name] = (
+                    self.server.stage_rows.get(table_name, 0) + row_count
+                )
+
+    def fetchone(self):
+        return next(self.results, None)
+
+    def fetchall(self):
+        rows = list(self.results)
+        self.server.round_trip(rows_received=len(rows))
+        return rows
+
+    def fetchmany(self, size):
+        rows = [row for _, row in zip(range(size), self.results)]
+        self.server.round_trip(rows_received=len(rows))
+        return rows
+
+    def close(self):
+        self.results = iter(())
+
+
+class FakeConnection:
+    "a pyodbc style connection onto a FakeServer"
+
+    def __init__(self, server: FakeServer, autocommit=True):
+        self.server = server
+        self.autocommit = autocommit
+
+    def cursor(self):
+        return FakeCursor(self.server)
+
+    def commit(self):
+        self.server.round_trip()
+
+    def rollback(self):
+        self.server.round_trip()
+
+    def close(self):
+        pass
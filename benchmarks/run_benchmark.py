@@ -0,0 +1,234 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import subprocess
+import tempfile
+from datetime import datetime, timezone
+from time import perf_counter
+import utils
+from benchmarks.fake_odbc import FakeConnection, FakeServer
+from benchmarks.synthetic_schema import SchemaSpec, build_catalog, build_synthetic_schema
+
+
+def get_git_commit(repo_dir):
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=repo_dir,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(
+    spec: SchemaSpec,
+    settings,
+    latency_ms=0.0,
+    row_cost_us=0.0,
+    metrics_path=None,
+    quiet=True,
+):
+    """Run the full wave pipeline over the synthetic schema against fake source and
+    destination servers.  Returns the report: wall time, per-phase throughput from the
+    telemetry spans and the round trips each side saw."""
+    schema = build_synthetic_schema(spec)
+    catalog = build_catalog(schema, schema_name=settings.schema_name)
+    src_server = FakeServer(schema, latency_ms=latency_ms, row_cost_us=row_cost_us)
+    dest_server = FakeServer(schema, latency_ms=latency_ms, row_cost_us=row_cost_us)
+
+    utils.telemetry.enable(metrics_path or os.devnull)
+
+    output = io.StringIO() if quiet else None
+    start = perf_counter()
+    with contextlib.redirect_stdout(output) if quiet else contextlib.nullcontext():
+        utils.run_waves(
+            waves_list=schema["waves"],
+            settings=settings,
+            catalog=catalog,
+            journal=utils.RunJournal(),
+            src_pool=utils.ConnectionPool(connect=lambda: FakeConnection(src_server)),
+            dest_pool=utils.ConnectionPool(connect=lambda: FakeConnection(dest_server)),
+        )
+    wall_seconds = perf_counter() - start
+
+    summary = utils.telemetry.summarize()
+    phases = {
+        phase: {
+            "seconds": round(group["seconds"], 4),
+            "rows": group["rows"],
+            "rows_per_sec": round(group["rows"] / group["seconds"], 1)
+            if group["rows"] and group["seconds"] > 0
+            else None,
+        }
+        for phase, group in summary["phases"]
+    }
+
+    return {
+        "spec": {
+            "base_rows": spec.base_rows,
+            "fanout": spec.fanout,
+            "string_width": spec.string_width,
+            "seed": spec.seed,
+        },
+        "settings": {
+            "workers": settings.workers,
+            "chunk_size": settings.chunk_size,
+            "memory_budget_mb": settings.memory_budget_mb,
+            "prefetch_chunks": settings.prefetch_chunks,
+            "merge_batch_size": settings.merge_batch_size,
+            "server_batch": settings.server_batch,
+            "stage_writer": settings.stage_writer,
+            "copy_connections": settings.copy_connections,
+            "spool": settings.spool_dir is not None,
+            "stage_load": settings.stage_load,
+            "merge_engine": settings.merge_engine,
+            "disable_indexes": settings.defer_constraints,
+            "latency_ms": latency_ms,
+            "row_cost_us": row_cost_us,
+        },
+        "source_rows": sum(
+            definition["rows"] for definition in schema["tables"].values()
+        ),
+        "wall_seconds": round(wall_seconds, 4),
+        "phases": phases,
+        "source": src_server.stats,
+        "destination": dest_server.stats,
+    }
+
+
+def print_report(report, baseline=None):
+    "print per-phase throughput, with the change against a baseline report when given"
+    print("#####################################################")
+    print(f"Commit: {report.get('commit')}  Source rows: {report['source_rows']}")
+    print(f"Wall time: {report['wall_seconds']:.2f}s")
+    # The fake servers cost the same whatever the SQL, see benchmarks/fake_odbc.py
+    print(
+        "Client side only: stage load modes, stage writers and merge engines do the same "
+        "work on the fake servers, so their rows/sec cannot be used to choose between them"
+    )
+    if baseline:
+        change = report["wall_seconds"] - baseline["wall_seconds"]
+        print(f"Baseline {baseline.get('commit')}: {baseline['wall_seconds']:.2f}s ({change:+.2f}s)")
+    print("")
+
+    print(f"{'phase':<20}{'seconds':>12}{'rows':>12}{'rows/sec':>14}{'vs baseline':>14}")
+    for phase, group in report["phases"].items():
+        rows_per_sec = f"{group['rows_per_sec']:.1f}" if group["rows_per_sec"] else ""
+        compared = ""
+        if baseline and phase in baseline["phases"]:
+            base_seconds = baseline["phases"][phase]["seconds"]
+            if base_seconds > 0:
+                compared = f"{(group['seconds'] - base_seconds) / base_seconds:+.1%}"
+        print(f"{phase:<20}{group['seconds']:>12.3f}{group['rows']:>12}{rows_per_sec:>14}{compared:>14}")
+    print("")
+
+    for side in ["source", "destination"]:
+        stats = report[side]
+        print(
+            f"{side}: {stats['round_trips']} round trips, {stats['statements']} statements, "
+            f"{stats['rows_sent']} rows sent, {stats['rows_received']} rows received"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the migration pipeline on a synthetic schema"
+    )
+    parser.add_argument("--base-rows", type=int, default=1000, help="rows in each top level table")
+    parser.add_argument("--fanout", type=int, default=3, help="child rows per parent row")
+    parser.add_argument("--string-width", type=int, default=40, help="length of generated strings")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--chunk-size", type=int, default=utils.RunSettings.chunk_size)
+    parser.add_argument("--memory-budget-mb", type=int, default=None)
+    parser.add_argument(
+        "--prefetch-chunks", type=int, default=utils.RunSettings.prefetch_chunks
+    )
+    parser.add_argument("--merge-batch-size", type=int, default=None)
+    parser.add_argument("--server-batch", action="store_true")
+    parser.add_argument("--copy-connections", type=int, default=1)
+    parser.add_argument(
+        "--stage-load",
+        choices=["indexed", "heap"],
+        default="indexed",
+        help="the fake servers keep no indexes or log, so this compares client overhead only",
+    )
+    parser.add_argument("--merge-engine", choices=["merge", "insert"], default="merge")
+    parser.add_argument("--disable-indexes", action="store_true")
+    parser.add_argument(
+        "--spool", action="store_true", help="extract through spool files in a temp directory"
+    )
+    parser.add_argument(
+        "--copy-partition-min-rows",
+        type=int,
+        default=0,
+        help="tables with fewer rows are copied on one connection",
+    )
+    parser.add_argument(
+        "--stage-writer",
+        choices=["auto", "executemany", "tvp"],
+        default="executemany",
+        help="the fake servers do no work per row, so this compares client overhead only",
+    )
+    parser.add_argument(
+        "--latency-ms", type=float, default=0.0, help="simulated cost of each round trip"
+    )
+    parser.add_argument(
+        "--row-cost-us", type=float, default=0.0, help="simulated cost of each row sent or received"
+    )
+    parser.add_argument("--output", help="write the report to this JSON file")
+    parser.add_argument("--compare", help="a previous report to compare against")
+    parser.add_argument("--verbose", action="store_true", help="show the pipeline output")
+    args = parser.parse_args()
+
+    repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+    spec = SchemaSpec(
+        base_rows=args.base_rows, fanout=args.fanout, string_width=args.string_width
+    )
+    settings = utils.RunSettings(
+        workers=args.workers,
+        chunk_size=args.chunk_size,
+        memory_budget_mb=args.memory_budget_mb,
+        prefetch_chunks=args.prefetch_chunks,
+        merge_batch_size=args.merge_batch_size,
+        server_batch=args.server_batch,
+        stage_writer=args.stage_writer,
+        copy_connections=args.copy_connections,
+        copy_partition_min_rows=args.copy_partition_min_rows,
+        stage_load=args.stage_load,
+        merge_engine=args.merge_engine,
+        defer_constraints=args.disable_indexes,
+    )
+
+    with tempfile.TemporaryDirectory() as spool_dir:
+        if args.spool:
+            settings.spool_dir = spool_dir
+        report = run_benchmark(
+            spec,
+            settings,
+            latency_ms=args.latency_ms,
+            row_cost_us=args.row_cost_us,
+            quiet=not args.verbose,
+        )
+    report["commit"] = get_git_commit(repo_dir)
+    report["finished_at"] = datetime.now(timezone.utc).isoformat()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, "r") as f:
+            baseline = json.load(f)
+
+    print_report(report, baseline=baseline)
+
+    if args.output:
+        output_dir = os.path.dirname(args.output)
+        if output_dir:
+            os.makedirs(output_dir, exist_ok=True)
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=4)
+        print(f"Report written to {args.output}")
@@ -0,0 +1,264 @@
+import random
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from decimal import Decimal
+from utils.catalog import Catalog, catalog_key
+
+
+@dataclass
+class SchemaSpec:
+    "sizes of the synthetic MusicPlatform schema"
+
+    base_rows: int = 1000  # rows in each top level table
+    fanout: int = 3  # child rows per parent row for each FK level
+    string_width: int = 40  # length of generated nvarchar values
+    seed: int = 42
+
+
+def column(name, data_type, is_identity=False):
+    return {
+        "name": name,
+        "data_type": data_type,
+        "is_identity": is_identity,
+        "is_computed": False,
+    }
+
+
+def build_synthetic_schema(spec: SchemaSpec):
+    """Describe a MusicPlatform style schema covering every table type the migration
+    handles: identity, composite, unique (non identity PK), heap, and a temporal table
+    with its history table.  Returns the table definitions, waves and row counts."""
+    width = spec.string_width
+    base = spec.base_rows
+    child = base * spec.fanout
+    grandchild = child * spec.fanout
+
+    tables = {
+        "Subscription": {
+            "columns": [
+                column("SubscriptionId", "int", is_identity=True),
+                column("Name", f"nvarchar({width})"),
+                column("Price", "decimal"),
+            ],
+            "pk": ["SubscriptionId"],
+            "fks": [],
+            "uniques": {"UQ_Subscription_Name": ["Name"]},
+            "rows": max(1, base // 100),
+        },
+        "Genre": {
+            "columns": [
+                column("GenreCode", "varchar(10)"),
+                column("Description", f"nvarchar({width})"),
+            ],
+            "pk": ["GenreCode"],
+            "fks": [],
+            "uniques": {},
+            "rows": max(1, base // 10),
+        },
+        "User": {
+            "columns": [
+                column("UserId", "int", is_identity=True),
+                column("SubscriptionId", "int"),
+                column("Email", f"nvarchar({width})"),
+                column("ValidFrom", "datetime2"),
+                column("ValidTo", "datetime2"),
+            ],
+            "pk": ["UserId"],
+            "fks": [("SubscriptionId", "Subscription", "SubscriptionId")],
+            "uniques": {"UQ_User_Email": ["Email"]},
+            "temporal": {"type": "TEMPORAL", "history_table": "UserHistory"},
+            "rows": base,
+        },
+        "UserHistory": {
+            "columns": [
+                column("UserId", "int"),
+                column("SubscriptionId", "int"),
+                column("Email", f"nvarchar({width})"),
+                column("ValidFrom", "datetime2"),
+                column("ValidTo", "datetime2"),
+            ],
+            "pk": [],
+            "fks": [],
+            "uniques": {},
+            "temporal": {"type": "HISTORY", "master_table": "User"},
+            "rows": base,
+        },
+        "Artist": {
+            "columns": [
+                column("ArtistId", "int", is_identity=True),
+                column("Name", f"nvarchar({width})"),
+                # Never copied, the incremental watermark of the table
+                column("RowVersion", "timestamp"),
+            ],
+            "pk": ["ArtistId"],
+            "fks": [],
+            "uniques": {},
+            "rows": base,
+        },
+        "Album": {
+            "columns": [
+                column("AlbumId", "int", is_identity=True),
+                column("ArtistId", "int"),
+                column("Title", f"nvarchar({width})"),
+                column("ReleasedOn", "datetime2"),
+                column("Notes", "nvarchar(max)"),
+            ],
+            "pk": ["AlbumId"],
+            "fks": [("ArtistId", "Artist", "ArtistId")],
+            "uniques": {},
+            "rows": child,
+        },
+        "Song": {
+            "columns": [
+                column("SongId", "int", is_identity=True),
+                column("AlbumId", "int"),
+                column("Title", f"nvarchar({width})"),
+                column("Seconds", "int"),
+            ],
+            "pk": ["SongId"],
+            "fks": [("AlbumId", "Album", "AlbumId")],
+            "uniques": {"UQ_Song_Album_Title": ["AlbumId", "Title"]},
+            "rows": grandchild,
+        },
+        "SongGenre": {
+            "columns": [
+                column("SongId", "int"),
+                column("GenreCode", "varchar(10)"),
+            ],
+            "pk": ["SongId", "GenreCode"],
+            "fks": [
+                ("SongId", "Song", "SongId"),
+                ("GenreCode", "Genre", "GenreCode"),
+            ],
+            "uniques": {},
+            "rows": grandchild,
+        },
+        "PlayLog": {
+            "columns": [
+                column("UserId", "int"),
+                column("SongId", "int"),
+                column("PlayedAt", "datetime2"),
+            ],
+            "pk": [],
+            "fks": [
+                ("UserId", "User", "UserId"),
+                ("SongId", "Song", "SongId"),
+            ],
+            "uniques": {},
+            "rows": grandchild * spec.fanout,
+        },
+    }
+
+    # Same shape as the waves in tables.json
+    waves = [
+        {"wave_num": 1, "tables": ["Subscription", "Genre", "Artist"]},
+        {"wave_num": 2, "tables": ["User", "Album"]},
+        {"wave_num": 3, "tables": ["UserHistory", "Song"]},
+        {"wave_num": 4, "tables": ["SongGenre", "PlayLog"]},
+    ]
+
+    return {"spec": spec, "tables": tables, "waves": waves}
+
+
+def build_catalog(schema, schema_name="dbo"):
+    "the Catalog load_catalog would return for the synthetic schema"
+    catalog = Catalog()
+
+    for table_name, definition in schema["tables"].items():
+        key = catalog_key(schema_name, table_name)
+        catalog.columns[key] = [dict(col) for col in definition["columns"]]
+        catalog.clustered[key] = list(definition["pk"])
+
+        if definition["pk"]:
+            identity_columns = {
+                col["name"] for col in definition["columns"] if col["is_identity"]
+            }
+            base_types = {
+                col["name"]: col["data_type"].split("(")[0]
+                for col in definition["columns"]
+            }
+            catalog.primary_keys[key] = [
+                {
+                    "PrimaryKeyName": pk_column,
+                    "ColumnId": number,
+                    "ColumnType": base_types[pk_column],
+                    "Identity": pk_column in identity_columns,
+                }
+                for number, pk_column in enumerate(definition["pk"], start=1)
+            ]
+
+        if definition["fks"]:
+            catalog.foreign_keys[key] = [
+                {
+                    "name": f"FK_{table_name}_{referenced_table}_{parent_column}",
+                    "parent_table": table_name,
+                    "parent_column": parent_column,
+                    "referenced_table": referenced_table,
+                    "referenced_column": referenced_column,
+                }
+                for parent_column, referenced_table, referenced_column in definition["fks"]
+            ]
+
+        if definition["uniques"]:
+            catalog.uniques[key] = {
+                name: list(columns) for name, columns in definition["uniques"].items()
+            }
+
+        temporal = definition.get("temporal")
+        if temporal:
+            master_table = temporal.get("master_table", table_name)
+            history_table = temporal.get(
+                "history_table",
+                table_name if temporal["type"] == "HISTORY" else None,
+            )
+            catalog.temporal[key] = {
+                "master_schema": schema_name,
+                "master_table": master_table,
+                "temporal_type": temporal["type"],
+                "history_schema": schema_name,
+                "history_table": history_table,
+                "validity_period_start": "ValidFrom",
+                "validity_period_end": "ValidTo",
+            }
+
+    return catalog
+
+
+def generate_rows(schema, table_name, column_list):
+    """Yield deterministic rows for a table, in column_list order.  FK values stay inside
+    the row count of the referenced table so every FK resolves."""
+    spec = schema["spec"]
+    definition = schema["tables"][table_name]
+    types = {col["name"]: col["data_type"] for col in definition["columns"]}
+    references = {
+        parent_column: schema["tables"][referenced_table]["rows"]
+        for parent_column, referenced_table, _ in definition["fks"]
+    }
+    rng = random.Random(f"{spec.seed}:{table_name}")
+    start_date = datetime(2020, 1, 1)
+    text = "x" * spec.string_width
+
+    for number in range(1, definition["rows"] + 1):
+        row = []
+        for col in column_list:
+            data_type = types[col]
+            if col in references:
+                parent_rows = references[col]
+                if data_type.startswith("varchar"):
+                    row.append(f"G{rng.randint(1, parent_rows)}")
+                else:
+                    row.append(rng.randint(1, parent_rows))
+            elif data_type == "int":
+                row.append(number)
+            elif data_type == "decimal":
+                row.append(Decimal(number % 100))
+            elif data_type == "datetime2":
+                row.append(start_date + timedelta(minutes=number))
+            elif data_type.endswith("(max)"):
+                row.append(text * 10)
+            elif data_type.startswith("varchar"):
+                row.append(f"G{number}")
+            else:
+                # Unique string columns get the row number so they never collide
+                row.append(f"{number}-{text}"[: spec.string_width])
+        yield tuple(row)
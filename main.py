@@ -1,21 +1,137 @@
+import argparse
 import json
 import os
 import utils
-import pyodbc
-from time import gmtime, strftime, time
+from time import time
 from datetime import datetime
 
 # Script Timer
 start_time = time()
 
+parser = argparse.ArgumentParser(description="Merge a source database into a destination")
+parser.add_argument(
+    "--workers",
+    type=int,
+    default=1,
+    help="number of tables of the same wave to process at the same time",
+)
+parser.add_argument(
+    "--refresh-catalog",
+    action="store_true",
+    help="ignore the on-disk catalog cache and introspect the destination again",
+)
+parser.add_argument(
+    "--merge-batch-size",
+    type=int,
+    default=None,
+    help="merge identity tables in key ranges of this size, committing each batch",
+)
+parser.add_argument(
+    "--merge-throttle",
+    type=float,
+    default=0,
+    help="seconds to sleep between merge batches to limit load on a live destination",
+)
+parser.add_argument(
+    "--server-batch",
+    action="store_true",
+    help="send each table's indexing, FK remap and merge to the server as one batch",
+)
+parser.add_argument(
+    "--stage-writer",
+    choices=["auto", "executemany", "tvp"],
+    default="executemany",
+    help="how rows are written to stage; auto uses a table-valued parameter for (max) and sql_variant columns",
+)
+parser.add_argument(
+    "--copy-connections",
+    type=int,
+    default=1,
+    help="split the copy of large clustered tables into key ranges over this many connection pairs",
+)
+parser.add_argument(
+    "--stage-load",
+    choices=["indexed", "heap"],
+    default="indexed",
+    help="heap loads stage tables without their PK, WITH (TABLOCK), and builds the PK after the copy",
+)
+parser.add_argument(
+    "--merge-engine",
+    choices=["merge", "insert"],
+    default="merge",
+    help="insert replaces each MERGE with an UPDATE and an anti-join INSERT ... SELECT",
+)
+parser.add_argument(
+    "--disable-indexes",
+    action="store_true",
+    help="disable nonclustered indexes and FK checks of each wave's tables while they merge, then rebuild them",
+)
+parser.add_argument(
+    "--spool",
+    action="store_true",
+    help="extract each table to a compressed local spool file once, then load stage from it",
+)
+parser.add_argument(
+    "--spool-dir",
+    default=None,
+    help="directory of the spool files, defaults to .spool next to main.py",
+)
+parser.add_argument(
+    "--incremental",
+    action="store_true",
+    help="only copy rows past each table's watermark from the previous run, updating changed rows",
+)
+parser.add_argument(
+    "--watermarks",
+    default=None,
+    help="path of the per-table watermark store, defaults to migration_watermarks.json",
+)
+parser.add_argument(
+    "--retry-attempts",
+    type=int,
+    default=3,
+    help="attempts at a chunk, merge batch or table failing on a deadlock, timeout or dropped connection",
+)
+parser.add_argument(
+    "--resume",
+    action="store_true",
+    help="continue every table from the first phase the run journal has not finished",
+)
+parser.add_argument(
+    "--journal",
+    default=None,
+    help="path of the run journal, defaults to migration_journal.jsonl next to main.py",
+)
+parser.add_argument(
+    "--metrics",
+    default=None,
+    help="path of the per-phase timing JSON lines, defaults to migration_metrics.jsonl",
+)
+args = parser.parse_args()
+
 # Constants
 SCHEMA = "dbo"
 STAGE_SCHEMA = "STAGE"
+COPY_CHUNK_SIZE = 10000  # max rows per fetchmany/executemany when copying to stage
+COPY_MEMORY_BUDGET_MB = 256  # shrink copy chunks so the chunks in flight fit in this budget
+COPY_PREFETCH_CHUNKS = 2  # chunks read ahead of the stage writer, 0 to copy sequentially
+COPY_PARTITION_MIN_ROWS = 1000000  # smaller tables are copied on one connection
+KEY_BACKFILL_BATCH_SIZE = None  # key range per New_ identity back-fill, None for one update
+WATERMARK_LAG_SECONDS = 300  # date and time watermarks stop this far behind the source clock
+RETRY_BACKOFF_SECONDS = 1.0  # first wait before retrying a transient failure, doubled each time
 
 # Get directory of current script and construct paths for configs
 script_dir = os.path.dirname(__file__)
 config_path = os.path.join(script_dir, "config.json")
 table_config_path = os.path.join(script_dir, "tables.json")
+cache_dir = os.path.join(script_dir, ".cache")
+journal_path = args.journal or os.path.join(script_dir, "migration_journal.jsonl")
+metrics_path = args.metrics or os.path.join(script_dir, "migration_metrics.jsonl")
+spool_dir = args.spool_dir or os.path.join(script_dir, ".spool")
+deferred_constraints_path = os.path.join(script_dir, "migration_deferred_constraints.json")
+watermarks_path = args.watermarks or os.path.join(script_dir, "migration_watermarks.json")
+utils.telemetry.enable(metrics_path)
+utils.retry.configure(attempts=args.retry_attempts, backoff_seconds=RETRY_BACKOFF_SECONDS)
 
 # Load config files
 with open(config_path, "r") as f:
@@ -24,149 +140,107 @@ with open(config_path, "r") as f:
 with open(table_config_path, "r") as f:
     tables = json.load(f)
 
-# Establish DB connections, pass in Connection object to functions instead
-src_conn_string = utils.get_conn_string(config=config, type="source")
-dest_conn_string = utils.get_conn_string(config=config, type="destination")
-
-src_conn = pyodbc.connect(src_conn_string, autocommit=True)
-dest_conn = pyodbc.connect(dest_conn_string, autocommit=True)
-
-# Before starting loop ensure STAGE schema exists at Destination
-utils.create_stage_schema(conn=dest_conn)
-
 # Loop through databases, waves, and tables
 dest_db = config["destination"]["database"]
 db_dict = [d for d in tables["databases"] if d["db_name"] == dest_db]
 waves_list = [d["waves"] for d in db_dict][0]
-for wave in waves_list:
-    print(f"Processing Wave # {wave['wave_num']}...")
-    print(strftime("%Y-%m-%d %H:%M:%S", gmtime()))
-    print("#####################################################")
-    for table in wave["tables"]:
-        current_table = utils.Table(SCHEMA, STAGE_SCHEMA, table)
-
-        utils.create_stage_table(conn=dest_conn, table=current_table, recreate=True)
-
-        # Gather the table details
-        current_table.pk_column_list = utils.get_primary_key(
-            conn=dest_conn, table=current_table
-        )
-        current_table.fk_column_list = utils.get_foreign_keys(
-            conn=dest_conn, table=current_table
-        )
-        current_table.uniques = utils.get_uniques(conn=dest_conn, table=current_table)
-        current_table.column_list = utils.get_column_list(
-            conn=dest_conn, table=current_table
-        )
-        current_table.column_list_without_identity = utils.get_column_list(
-            conn=dest_conn, table=current_table, include_identity=False
-        )
-        current_table.get_identity(conn=dest_conn)
-        current_table.column_list_with_new_keys = utils.columns_with_new_keys(
-            table=current_table, include_identity=True
-        )
-        current_table.column_list_new_keys_without_identity = (
-            utils.columns_with_new_keys(table=current_table, include_identity=False)
-        )
-        current_table.get_clustered_on(conn=dest_conn)
-        is_pk_composite = current_table.is_pk_entirely_fks()
-        temporal_info = utils.get_temporal_info(conn=dest_conn, table=current_table)
-
-        if temporal_info:
-            temporal_type = temporal_info["temporal_type"]
-
-        # Check for table type and update current Table variables
-
-        if current_table.identity:
-            current_table.update_type("IDENTITY")
-        elif is_pk_composite:
-            current_table.update_type("COMPOSITE")
-        elif current_table.uniques or current_table.pk_column_list:
-            current_table.update_type("UNIQUE")
-        else:
-            current_table.update_type("HEAP")
-
-        # Stage table setup for PK and FKs
-        if current_table.pk_column_list:
-            utils.create_stage_table_pk(conn=dest_conn, table=current_table)
-            utils.create_stage_table_newpk(conn=dest_conn, table=current_table)
-
-        if current_table.fk_column_list:
-            utils.create_stage_table_fks(conn=dest_conn, table=current_table)
-
-        # Handle rare scenario where the identity column is not part of the PK
-        if current_table.identity and current_table.identity not in [
-            column["PrimaryKeyName"] for column in current_table.pk_column_list
-        ]:
-            utils.create_stage_table_identity(conn=dest_conn, table=current_table)
-
-        # If table is a Temporal History table, add keys in Stage
-        if temporal_type == "HISTORY":
-            combined_keys = utils.get_temporal_combined_keys(
-                conn=dest_conn, stage_schema=STAGE_SCHEMA, temporal_info=temporal_info
-            )
-            utils.create_stage_temporal_history_keys(
-                conn=dest_conn,
-                table=current_table,
-                temporal_info=temporal_info,
-                combined_keys=combined_keys,
-            )
-
-        # Disable SYSTEM_VERSIONING in order to Process Temporal Tables
-        if temporal_type in ["TEMPORAL", "HISTORY"]:
-            utils.change_temporal_state(
-                conn=dest_conn, temporal_info=temporal_info, state="OFF"
-            )
-
-        utils.copy_src_table_to_stage(
-            src_conn=src_conn,
-            dest_conn=dest_conn,
-            table=current_table,
+table_options = [d.get("table_options", {}) for d in db_dict][0]
+deferred_fks = [d.get("deferred_fks", []) for d in db_dict][0]
+
+# Every connection comes from a pool per endpoint, reconnecting dropped connections
+src_pool = utils.get_connection_pool(config=config, type="source")
+dest_pool = utils.get_connection_pool(config=config, type="destination")
+
+settings = utils.RunSettings(
+    schema_name=SCHEMA,
+    stage_schema=STAGE_SCHEMA,
+    workers=args.workers,
+    chunk_size=COPY_CHUNK_SIZE,
+    memory_budget_mb=COPY_MEMORY_BUDGET_MB,
+    prefetch_chunks=COPY_PREFETCH_CHUNKS,
+    backfill_batch_size=KEY_BACKFILL_BATCH_SIZE,
+    merge_batch_size=args.merge_batch_size,
+    merge_throttle_seconds=args.merge_throttle,
+    server_batch=args.server_batch,
+    stage_writer=args.stage_writer,
+    incremental=args.incremental,
+    table_options=table_options,
+    copy_connections=args.copy_connections,
+    copy_partition_min_rows=COPY_PARTITION_MIN_ROWS,
+    spool_dir=spool_dir if args.spool or args.spool_dir else None,
+    stage_load=args.stage_load,
+    merge_engine=args.merge_engine,
+    defer_constraints=args.disable_indexes,
+    deferred_constraints_path=deferred_constraints_path,
+    deferred_fks=deferred_fks,
+    watermark_lag_seconds=WATERMARK_LAG_SECONDS,
+)
+
+if args.server_batch and args.merge_batch_size:
+    print("--merge-batch-size commits batch by batch, running without --server-batch")
+
+# Before starting loop ensure STAGE schema exists at Destination
+with dest_pool.connection() as dest_conn:
+    utils.create_stage_schema(conn=dest_conn)
+
+    # Snapshot the destination catalog once instead of querying it for every table,
+    # reusing the on-disk cache when the schema fingerprint has not changed
+    catalog_cache_path = os.path.join(cache_dir, f"catalog_{dest_db}.json")
+    if args.refresh_catalog and os.path.exists(catalog_cache_path):
+        os.remove(catalog_cache_path)
+    with utils.telemetry.span(utils.telemetry.RUN_SPAN, "catalog_load"):
+        catalog = utils.get_catalog(
+            conn=dest_conn, stage_schema=STAGE_SCHEMA, cache_path=catalog_cache_path
         )
 
-        # Before the table merge update any FKs in Stage
-        if current_table.fk_column_list:
-            utils.update_fks_in_stage(conn=dest_conn, table=current_table)
-
-        # If temporal_type = HISTORY, treat master_table's PK as a FK in History to be updated accordingly
-        # This must be done before re-enabling SYSTEM_VERSIONING
-        if temporal_type == "HISTORY":
-            utils.update_temporal_history_stage_keys(
-                conn=dest_conn, table=current_table, key_list=combined_keys
-            )
-
-        # Call correct merge function based on TableType
-        match current_table.type:
-            case "IDENTITY":
-                utils.merge_identity_table_data(conn=dest_conn, table=current_table)
-            case "UNIQUE":
-                utils.update_pk_columns_in_unique_stage(
-                    conn=dest_conn, table=current_table
-                )
-                utils.merge_unique_table_data(conn=dest_conn, table=current_table)
-            case "COMPOSITE":
-                utils.merge_composite_table_data(conn=dest_conn, table=current_table)
-            case "HEAP":
-                if temporal_type == "HISTORY":
-                    utils.insert_temporal_history_table_data(
-                        conn=dest_conn,
-                        table=current_table,
-                        combined_keys=combined_keys,
-                    )
-                else:
-                    utils.merge_heap_table_data(conn=dest_conn, table=current_table)
-
-        # Re-Enable SYSTEM_VERSIONING after MERGE is finished
-        if temporal_type in ["TEMPORAL", "HISTORY"]:
-            utils.change_temporal_state(
-                conn=dest_conn, temporal_info=temporal_info, state="ON"
-            )
-
-        print("")
-
-# Close connections
-src_conn.close()
-dest_conn.close()
+    # Taken without the tables the run alters itself, so the cache is only re-stamped
+    # afterwards when nobody else changed the schema meanwhile
+    altered_tables = utils.get_altered_tables(
+        catalog=catalog,
+        schema_name=SCHEMA,
+        table_names=[table_name for wave in waves_list for table_name in wave["tables"]],
+        alters_indexes=args.disable_indexes,
+    )
+    run_fingerprint = utils.get_schema_fingerprint(
+        conn=dest_conn, stage_schema=STAGE_SCHEMA, exclude_tables=altered_tables
+    )
+
+# The journal records each finished table phase so a crashed run can be resumed
+journal = utils.RunJournal(path=journal_path, resume=args.resume)
+
+# High-water marks of finished tables, a full run starts them over
+watermarks = utils.WatermarkStore(
+    path=watermarks_path, reset=not (args.incremental or args.resume)
+)
+
+utils.run_waves(
+    waves_list=waves_list,
+    settings=settings,
+    catalog=catalog,
+    journal=journal,
+    src_pool=src_pool,
+    dest_pool=dest_pool,
+    watermarks=watermarks,
+)
+
+# Our own temporal toggles and index rebuilds bump modify_date, so re-stamp the cache
+# for the next run unless another session changed the schema meanwhile
+with dest_pool.connection() as dest_conn:
+    utils.refresh_catalog_cache_fingerprint(
+        conn=dest_conn,
+        stage_schema=STAGE_SCHEMA,
+        cache_path=catalog_cache_path,
+        catalog=catalog,
+        run_fingerprint=run_fingerprint,
+        altered_tables=altered_tables,
+    )
+src_pool.close()
+dest_pool.close()
+
+# Rank tables and phases by time spent
+utils.telemetry.print_summary()
+if utils.retry.retry_count():
+    print(f"Retried {utils.retry.retry_count()} transient failures")
 
 # End the timer
 end_time = time()
@@ -0,0 +1,71 @@
+import argparse
+import json
+import os
+import utils
+
+# Constants
+SCHEMA = "dbo"
+
+# Get directory of current script and construct paths for configs
+script_dir = os.path.dirname(__file__)
+config_path = os.path.join(script_dir, "config.json")
+
+parser = argparse.ArgumentParser(
+    description="Plan migration waves from the destination FK graph"
+)
+parser.add_argument(
+    "--output",
+    default=os.path.join(script_dir, "tables.json"),
+    help="where to write the planned tables.json",
+)
+parser.add_argument(
+    "--dry-run",
+    action="store_true",
+    help="print the plan without writing it",
+)
+args = parser.parse_args()
+
+# Load config file
+with open(config_path, "r") as f:
+    config = json.load(f)
+
+dest_pool = utils.get_connection_pool(config=config, type="destination")
+with dest_pool.connection() as dest_conn:
+    tables, dependencies, nullable_dependencies = utils.get_table_dependencies(
+        conn=dest_conn, schema_name=SCHEMA
+    )
+dest_pool.close()
+
+plan = utils.plan_waves(
+    tables=tables, dependencies=dependencies, nullable_dependencies=nullable_dependencies
+)
+
+for wave_index, wave in enumerate(plan["waves"]):
+    serial = " (one table at a time)" if wave_index in plan["serial_waves"] else ""
+    print(f"Wave # {wave_index + 1}: {', '.join(wave)}{serial}")
+
+for table_name in plan["self_references"]:
+    print(f"WARNING: [{table_name}] references itself, its self FK is not remapped")
+
+for fk in plan["deferred_fks"]:
+    print(
+        f"WARNING: FK cycle split on [{fk['table']}] -> [{fk['referenced_table']}], its FK "
+        f"is loaded as NULL and set once [{fk['referenced_table']}] is merged"
+    )
+
+for cycle in plan["cycles"]:
+    print(
+        f"WARNING: FK cycle between {', '.join(cycle)} has no nullable FK to split on, "
+        "placed in one wave that runs its tables one at a time"
+    )
+
+if not args.dry_run:
+    # Other databases and the hand written table options are kept, see write_tables_config
+    utils.write_tables_config(
+        path=args.output,
+        db_name=config["destination"]["database"],
+        waves=plan["waves"],
+        serial_waves=plan["serial_waves"],
+        deferred_fks=plan["deferred_fks"],
+    )
+    print(f"Wrote {len(plan['waves'])} waves to {args.output}")
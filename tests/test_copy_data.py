@@ -0,0 +1,39 @@
+import pytest
+from utils.Table import Table
+from utils.copy_data import build_counted_batch, get_identity_merge_sql
+
+
+def artist_table():
+    return Table(
+        schema_name="dbo",
+        stage_schema="STAGE",
+        table_name="Artist",
+        identity="ArtistId",
+        column_list_without_identity=["Name"],
+        column_list_new_keys_without_identity=["Name"],
+    )
+
+
+@pytest.mark.parametrize("merge_engine", ["merge", "insert"])
+def test_identity_tables_pair_keys_through_merge_output(merge_engine):
+    merge_query, _ = get_identity_merge_sql(artist_table(), merge_engine=merge_engine)
+
+    assert "ON 1 = 0" in merge_query
+    assert "OUTPUT inserted.ArtistId, source.ArtistId" in merge_query
+    assert "ROW_NUMBER" not in merge_query
+
+
+def test_unknown_merge_engine():
+    with pytest.raises(ValueError):
+        get_identity_merge_sql(artist_table(), merge_engine="bulk")
+
+
+def test_counted_batch_resets_session_settings_on_both_paths():
+    batch = build_counted_batch("DELETE FROM [dbo].[Artist];")
+    catch_block = batch[batch.index("BEGIN CATCH") : batch.index("END CATCH")]
+    after_catch = batch[batch.index("END CATCH") :]
+
+    for block in (catch_block, after_catch):
+        assert "SET XACT_ABORT OFF;" in block
+        assert "SET NOCOUNT OFF;" in block
+    assert catch_block.index("SET NOCOUNT OFF;") < catch_block.index("THROW;")
@@ -0,0 +1,66 @@
+from utils.Table import Table
+from utils.copy_data import build_mark_duplicates_sql
+from utils.create_stage import DUPLICATE_FLAG_COLUMN, get_stage_new_columns
+from utils.update_keys import build_deferred_fk_update_sql
+
+
+def song_table(**overrides):
+    "a unique PK table whose AlbumId FK was deferred to split an FK cycle"
+    table = Table(
+        schema_name="dbo",
+        stage_schema="STAGE",
+        table_name="Song",
+        type="UNIQUE",
+        pk_column_list=[{"PrimaryKeyName": "SongCode"}],
+        column_list=["SongCode", "AlbumId"],
+        column_types={"SongCode": "varchar(20)", "AlbumId": "int"},
+        fk_column_list=[
+            {
+                "name": "FK_Song_Album",
+                "parent_column": "AlbumId",
+                "referenced_table": "Album",
+                "referenced_column": "AlbumId",
+                "deferred": True,
+            }
+        ],
+    )
+    for name, value in overrides.items():
+        setattr(table, name, value)
+    return table
+
+
+def test_deferred_fk_tables_get_the_duplicate_flag():
+    assert DUPLICATE_FLAG_COLUMN in get_stage_new_columns(song_table())
+    assert DUPLICATE_FLAG_COLUMN not in get_stage_new_columns(
+        song_table(fk_column_list=[dict(song_table().fk_column_list[0], deferred=False)])
+    )
+
+
+def test_rows_already_in_the_destination_are_flagged():
+    statements = build_mark_duplicates_sql(song_table())
+
+    assert f"SET [{DUPLICATE_FLAG_COLUMN}] = 0" in statements[0]
+    assert "INNER JOIN [dbo].[Song] AS target ON source.SongCode = target.SongCode" in statements[-1]
+    assert f"SET [{DUPLICATE_FLAG_COLUMN}] = 1" in statements[-1]
+
+
+def test_rows_a_delta_merge_updates_are_not_flagged():
+    statements = build_mark_duplicates_sql(song_table(), update_matched=True)
+
+    assert len(statements) == 1
+
+
+def test_identity_rows_are_only_flagged_on_their_uniques():
+    table = song_table(type="IDENTITY", identity="SongId")
+
+    assert len(build_mark_duplicates_sql(table)) == 1
+
+
+def test_deferred_fk_update_only_sets_rows_this_run_merged():
+    update_sql = build_deferred_fk_update_sql(
+        song_table(), song_table().fk_column_list[0], {"KeyMap_Album_AlbumId"}
+    )
+
+    assert "INNER JOIN [STAGE].[KeyMap_Album_AlbumId] km" in update_sql
+    assert "target.[AlbumId] IS NULL" in update_sql
+    assert f"COALESCE(stage.[{DUPLICATE_FLAG_COLUMN}], 0) = 0" in update_sql
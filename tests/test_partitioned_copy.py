@@ -0,0 +1,90 @@
+import sqlite3
+from utils.Table import Table
+from utils.partitioned_copy import build_key_range_filters, plan_copy_ranges, plan_key_ranges
+
+
+def test_plan_key_ranges_balances_rows():
+    histogram = [(10, 100), (20, 100), (30, 100), (40, 100)]
+
+    assert plan_key_ranges(histogram, 4) == [10, 20, 30]
+    assert plan_key_ranges(histogram, 2) == [20]
+
+
+def test_plan_key_ranges_never_splits_on_the_last_step():
+    assert plan_key_ranges([(10, 100), (20, 100)], 4) == [10]
+    assert plan_key_ranges([(10, 1), (20, 1000)], 4) == []
+
+
+def test_plan_key_ranges_without_rows_or_ranges():
+    assert plan_key_ranges([], 4) == []
+    assert plan_key_ranges([(10, 0), (20, 0)], 4) == []
+    assert plan_key_ranges([(10, 100), (20, 100)], 1) == []
+
+
+def test_key_range_filters_without_bounds_cover_everything():
+    assert build_key_range_filters("ArtistId", []) == [(None, ())]
+
+
+def test_key_range_filters_cover_each_key_once():
+    bounds = [10, 20, 30]
+    filters = build_key_range_filters("ArtistId", bounds)
+    assert len(filters) == len(bounds) + 1
+
+    conn = sqlite3.connect(":memory:")
+    conn.execute("CREATE TABLE Artist (ArtistId INTEGER)")
+    keys = [None, 1, 10, 15, 20, 29, 30, 99]
+    conn.executemany("INSERT INTO Artist VALUES (?)", [(key,) for key in keys])
+
+    ranges = [
+        [row[0] for row in conn.execute(f"SELECT ArtistId FROM Artist WHERE {where}", params)]
+        for where, params in filters
+    ]
+
+    assert ranges == [[None, 1], [10, 15], [20, 29], [30, 99]]
+
+
+class HistogramCursor:
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def execute(self, query):
+        pass
+
+    def fetchall(self):
+        return self.histogram
+
+    def close(self):
+        pass
+
+
+class HistogramConnection:
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def cursor(self):
+        return HistogramCursor(self.histogram)
+
+
+def test_plan_copy_ranges_uses_one_connection_for_small_tables():
+    table = Table(
+        schema_name="dbo",
+        stage_schema="STAGE",
+        table_name="Artist",
+        clustered=["ArtistId"],
+        column_types={"ArtistId": "int"},
+    )
+    histogram = [(key, 100) for key in range(10, 110, 10)]
+
+    assert plan_copy_ranges(HistogramConnection(histogram), table, 2, min_rows=5000) is None
+    assert plan_copy_ranges(HistogramConnection([]), table, 2) is None
+    assert plan_copy_ranges(HistogramConnection(histogram), table, 1) is None
+
+    filters = plan_copy_ranges(HistogramConnection(histogram), table, 2, min_rows=500)
+    assert filters[0][0] == "([ArtistId] < ? OR [ArtistId] IS NULL)"
+    assert len(filters) > 1
+
+
+def test_plan_copy_ranges_needs_a_clustered_key():
+    table = Table(schema_name="dbo", stage_schema="STAGE", table_name="Artist")
+
+    assert plan_copy_ranges(HistogramConnection([(10, 100)]), table, 4) is None
@@ -0,0 +1,104 @@
+import pytest
+from utils import retry
+from utils.retry import is_connection_error, is_transient_error, retry_transient
+
+
+class Error(Exception):
+    "stands in for pyodbc.Error, which carries (sqlstate, message) as its arguments"
+
+
+DEADLOCK = Error(
+    "40001",
+    "[40001] [Microsoft][ODBC Driver 18 for SQL Server][SQL Server]Transaction (Process ID 62) "
+    "was deadlocked on lock resources with another process and has been chosen as the deadlock "
+    "victim. Rerun the transaction. (1205) (SQLExecDirectW)",
+)
+LOCK_TIMEOUT = Error(
+    "HY000",
+    "[HY000] [Microsoft][ODBC Driver 18 for SQL Server][SQL Server]Lock request time out period "
+    "exceeded. (1222) (SQLExecDirectW)",
+)
+LINK_FAILURE = Error(
+    "08S01",
+    "[08S01] [Microsoft][ODBC Driver 18 for SQL Server]Communication link failure (0) (SQLExecute)",
+)
+DUPLICATE_KEY = Error(
+    "23000",
+    "[23000] [Microsoft][ODBC Driver 18 for SQL Server][SQL Server]Violation of PRIMARY KEY "
+    "constraint 'PK_Artist'. Cannot insert duplicate key in object 'dbo.Artist'. The duplicate "
+    "key value is (1205). (2627) (SQLExecDirectW)",
+)
+
+
+@pytest.fixture(autouse=True)
+def no_backoff():
+    retry.configure(attempts=3, backoff_seconds=0)
+    yield
+    retry.configure()
+
+
+def test_transient_errors():
+    assert is_transient_error(DEADLOCK)
+    assert is_transient_error(LOCK_TIMEOUT)
+    assert is_transient_error(LINK_FAILURE)
+
+
+def test_only_the_native_error_code_counts():
+    assert not is_transient_error(DUPLICATE_KEY)
+    assert not is_transient_error(ValueError("invalid literal (1205)"))
+
+
+def test_connection_errors():
+    assert is_connection_error(LINK_FAILURE)
+    assert not is_connection_error(DEADLOCK)
+    assert not is_connection_error(LOCK_TIMEOUT)
+
+
+def failing(errors, result="done"):
+    "an action that raises each of errors in turn, then returns result"
+    calls = []
+
+    def action():
+        calls.append(len(calls))
+        if len(calls) <= len(errors):
+            raise errors[len(calls) - 1]
+        return result
+
+    return action, calls
+
+
+def test_retries_transient_errors_in_place():
+    action, calls = failing([DEADLOCK, LOCK_TIMEOUT])
+    undone = []
+
+    assert retry_transient(action, "test", on_retry=lambda: undone.append(True)) == "done"
+    assert len(calls) == 3
+    assert len(undone) == 2
+    assert retry.retry_count() == 2
+
+
+def test_raises_the_last_transient_error():
+    action, calls = failing([DEADLOCK, DEADLOCK, DEADLOCK])
+
+    with pytest.raises(Error):
+        retry_transient(action, "test")
+    assert len(calls) == 3
+
+
+def test_does_not_retry_other_errors():
+    action, calls = failing([DUPLICATE_KEY])
+
+    with pytest.raises(Error):
+        retry_transient(action, "test")
+    assert len(calls) == 1
+
+
+def test_connection_errors_need_a_new_connection():
+    action, calls = failing([LINK_FAILURE])
+    with pytest.raises(Error):
+        retry_transient(action, "test")
+    assert len(calls) == 1
+
+    action, calls = failing([LINK_FAILURE])
+    assert retry_transient(action, "test", reconnects=True) == "done"
+    assert len(calls) == 2
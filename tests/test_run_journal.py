@@ -0,0 +1,54 @@
+from utils.run_journal import RunJournal
+
+
+def test_resume_reads_back_finished_phases(tmp_path):
+    path = str(tmp_path / "journal" / "migration_journal.jsonl")
+    journal = RunJournal(path)
+    journal.mark_done("dbo.Artist", "stage_build")
+    journal.mark_done("dbo.Artist", "copy")
+
+    resumed = RunJournal(path, resume=True)
+
+    assert resumed.is_done("dbo.Artist", "stage_build")
+    assert resumed.is_done("dbo.Artist", "copy")
+    assert not resumed.is_done("dbo.Artist", "merge")
+    assert not resumed.is_done("dbo.Album", "stage_build")
+
+
+def test_resume_skips_a_partial_last_line(tmp_path):
+    path = tmp_path / "migration_journal.jsonl"
+    journal = RunJournal(str(path))
+    journal.mark_done("dbo.Artist", "copy")
+    with open(path, "a") as f:
+        f.write('{"table": "dbo.Artist", "pha')
+
+    resumed = RunJournal(str(path), resume=True)
+
+    assert resumed.is_done("dbo.Artist", "copy")
+    assert not resumed.is_done("dbo.Artist", "merge")
+
+
+def test_fresh_run_starts_the_journal_over(tmp_path):
+    path = str(tmp_path / "migration_journal.jsonl")
+    RunJournal(path).mark_done("dbo.Artist", "done")
+
+    journal = RunJournal(path)
+
+    assert not journal.is_done("dbo.Artist", "done")
+    assert not RunJournal(path, resume=True).is_done("dbo.Artist", "done")
+
+
+def test_resume_without_a_journal_file_starts_empty(tmp_path):
+    path = tmp_path / "migration_journal.jsonl"
+
+    journal = RunJournal(str(path), resume=True)
+
+    assert not journal.is_done("dbo.Artist", "copy")
+    assert path.exists()
+
+
+def test_journal_without_a_path_is_kept_in_memory():
+    journal = RunJournal()
+    journal.mark_done("dbo.Artist", "copy")
+
+    assert journal.is_done("dbo.Artist", "copy")
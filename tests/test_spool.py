@@ -0,0 +1,80 @@
+import os
+import pickle
+import stat
+import zlib
+from datetime import date, datetime, timedelta, timezone
+from decimal import Decimal
+from uuid import UUID
+import pytest
+from utils.spool import FRAME_HEADER, SPOOL_MAGIC, read_spool_frames, write_spool_frames
+
+
+def test_spool_frames_round_trip(tmp_path):
+    spool_path = str(tmp_path / "dbo.Artist.spool")
+    chunks = [
+        [
+            (1, "AC/DC", Decimal("1.99"), datetime(2024, 5, 1, 13, 45, tzinfo=timezone.utc)),
+            (2, None, Decimal("0.99"), datetime(2024, 5, 2)),
+        ],
+        [
+            (3, b"\x00\x01", bytearray(b"\x02"), date(2024, 5, 3)),
+            (4, UUID(int=4), timedelta(seconds=5), True),
+        ],
+    ]
+
+    rows, spool_bytes = write_spool_frames(spool_path, chunks)
+
+    assert rows == 4
+    assert spool_bytes == os.path.getsize(spool_path)
+    assert list(read_spool_frames(spool_path)) == chunks
+    assert not os.path.exists(f"{spool_path}.tmp")
+
+
+def test_spool_files_are_owner_only(tmp_path):
+    spool_dir = tmp_path / "spool"
+    spool_path = str(spool_dir / "dbo.Artist.spool")
+
+    write_spool_frames(spool_path, [[(1, "AC/DC")]])
+
+    assert stat.S_IMODE(os.stat(spool_dir).st_mode) & 0o077 == 0
+    assert stat.S_IMODE(os.stat(spool_path).st_mode) == 0o600
+
+
+def test_empty_spool_file_has_no_frames(tmp_path):
+    spool_path = str(tmp_path / "dbo.Artist.spool")
+
+    write_spool_frames(spool_path, [])
+
+    assert list(read_spool_frames(spool_path)) == []
+
+
+def test_spool_file_must_start_with_the_magic(tmp_path):
+    spool_path = tmp_path / "dbo.Artist.spool"
+    spool_path.write_bytes(b"NOT A SPOOL FILE\n" + FRAME_HEADER.pack(0))
+
+    with pytest.raises(ValueError, match="is not a spool file"):
+        list(read_spool_frames(str(spool_path)))
+
+
+def test_spool_file_with_a_partial_frame(tmp_path):
+    spool_path = str(tmp_path / "dbo.Artist.spool")
+    write_spool_frames(spool_path, [[(1, "AC/DC")]])
+    with open(spool_path, "r+b") as f:
+        f.truncate(os.path.getsize(spool_path) - 1)
+
+    with pytest.raises(ValueError, match="partial frame"):
+        list(read_spool_frames(spool_path))
+
+
+class RunsCode:
+    def __reduce__(self):
+        return (os.getcwd, ())
+
+
+def test_spool_frames_cannot_load_other_classes(tmp_path):
+    spool_path = tmp_path / "dbo.Artist.spool"
+    frame = zlib.compress(pickle.dumps([(1, RunsCode())]))
+    spool_path.write_bytes(SPOOL_MAGIC + FRAME_HEADER.pack(len(frame)) + frame)
+
+    with pytest.raises(pickle.UnpicklingError, match="getcwd is not allowed"):
+        list(read_spool_frames(str(spool_path)))
@@ -0,0 +1,38 @@
+from utils.Table import Table
+from utils.update_keys import build_update_new_pk_sql
+
+
+def artist_table(identity_data_type):
+    return Table(
+        schema_name="dbo",
+        stage_schema="STAGE",
+        table_name="Artist",
+        identity="ArtistId",
+        column_types={"ArtistId": identity_data_type, "Name": "nvarchar(120)"},
+    )
+
+
+def test_single_back_fill_update():
+    update_sql = build_update_new_pk_sql(artist_table("int"))
+
+    assert "SET stage.[New_ArtistId] = km.[new_id]" in update_sql
+    assert "NOCOUNT" not in update_sql
+
+
+def test_batched_back_fill_uses_the_identity_type():
+    update_sql = build_update_new_pk_sql(artist_table("smallint"), batch_size=500)
+
+    assert "DECLARE @range_start smallint, @range_end smallint" in update_sql
+    assert "@max_key smallint" in update_sql
+    assert "BIGINT" not in update_sql
+    assert "ELSE @range_start + 499" in update_sql
+
+
+def test_batched_back_fill_puts_nocount_back():
+    update_sql = build_update_new_pk_sql(artist_table("bigint"), batch_size=500)
+    catch_block = update_sql[update_sql.index("BEGIN CATCH") : update_sql.index("END CATCH")]
+
+    assert "SET NOCOUNT ON;" in update_sql
+    assert "IF @nocount_was_on = 0 SET NOCOUNT OFF;" in catch_block
+    assert "THROW;" in catch_block
+    assert update_sql.rstrip().endswith("IF @nocount_was_on = 0 SET NOCOUNT OFF;")
@@ -0,0 +1,182 @@
+import json
+from datetime import date, datetime
+from utils.Table import Table
+from utils.catalog import Catalog, catalog_key
+from utils.watermarks import (
+    WatermarkStore,
+    build_high_water_mark_query,
+    build_watermark_filter,
+    decode_watermark,
+    encode_watermark,
+    get_source_high_water_mark,
+    get_watermark_column,
+)
+
+
+def artist_table():
+    return Table(
+        schema_name="dbo",
+        stage_schema="STAGE",
+        table_name="Artist",
+        column_types={
+            "ArtistId": "int",
+            "RowVersion": "timestamp",
+            "ValidFrom": "datetime2",
+            "PlayedOn": "date",
+        },
+    )
+
+
+def test_watermarks_round_trip_through_json():
+    for value in [
+        b"\x00\x00\x00\x00\x00\x00\x07\xd1",
+        datetime(2024, 5, 1, 13, 45, 30, 123456),
+        date(2024, 5, 1),
+        42,
+        None,
+    ]:
+        encoded = json.loads(json.dumps(encode_watermark(value)))
+        assert decode_watermark(encoded) == value
+
+
+def test_rowversion_watermark_is_bytes():
+    encoded = encode_watermark(bytearray(b"\x00\x00\x00\x00\x00\x00\x07\xd1"))
+
+    assert encoded == {"kind": "rowversion", "value": "00000000000007d1"}
+    assert isinstance(decode_watermark(encoded), bytes)
+
+
+def test_watermark_column_prefers_configured_then_rowversion():
+    table = Table(
+        schema_name="dbo",
+        stage_schema="STAGE",
+        table_name="Artist",
+        column_types={"ArtistId": "int", "RowVersion": "timestamp"},
+        temporal_info={"temporal_type": "TEMPORAL", "validity_period_start": "ValidFrom"},
+    )
+
+    assert get_watermark_column(table, "ModifiedAt") == "ModifiedAt"
+    assert get_watermark_column(table) == "RowVersion"
+
+
+def test_watermark_column_of_temporal_tables():
+    master = Table(
+        schema_name="dbo",
+        stage_schema="STAGE",
+        table_name="Artist",
+        column_types={"ArtistId": "int"},
+        temporal_info={"temporal_type": "TEMPORAL", "validity_period_start": "ValidFrom"},
+    )
+    history = Table(
+        schema_name="dbo",
+        stage_schema="STAGE",
+        table_name="ArtistHistory",
+        column_types={"ArtistId": "int"},
+        temporal_info={"temporal_type": "HISTORY", "validity_period_end": "ValidTo"},
+    )
+    plain = Table(schema_name="dbo", stage_schema="STAGE", table_name="Genre")
+
+    assert get_watermark_column(master) == "ValidFrom"
+    assert get_watermark_column(history) == "ValidTo"
+    assert get_watermark_column(plain) is None
+
+
+def test_rowversion_columns_are_not_copied():
+    columns = [
+        {"name": "ArtistId", "data_type": "int", "is_computed": False, "is_identity": True},
+        {"name": "Name", "data_type": "nvarchar", "is_computed": False, "is_identity": False},
+        {"name": "RowVersion", "data_type": "timestamp", "is_computed": False, "is_identity": False},
+    ]
+    catalog = Catalog(columns={catalog_key("dbo", "Artist"): columns})
+
+    assert catalog.column_list("dbo", "Artist") == ["ArtistId", "Name"]
+    assert catalog.column_list("dbo", "Artist", include_identity=False) == ["Name"]
+    assert catalog.column_types("dbo", "Artist")["RowVersion"] == "timestamp"
+
+
+def test_pending_watermark_is_only_kept_once_committed(tmp_path):
+    path = str(tmp_path / "migration_watermarks.json")
+    store = WatermarkStore(path)
+    store.set_pending("dbo.Artist", "RowVersion", b"\x00\x00\x00\x00\x00\x00\x07\xd1")
+
+    assert WatermarkStore(path).get("dbo.Artist", "RowVersion") is None
+    assert not WatermarkStore(path).has_run("dbo.Artist")
+
+    store.commit("dbo.Artist")
+    reloaded = WatermarkStore(path)
+
+    assert reloaded.get("dbo.Artist", "RowVersion") == b"\x00\x00\x00\x00\x00\x00\x07\xd1"
+    assert reloaded.get("dbo.Artist", "ValidFrom") is None
+    assert reloaded.has_run("dbo.Artist")
+    assert not WatermarkStore(path, reset=True).has_run("dbo.Artist")
+
+
+class MarkCursor:
+    def __init__(self, queries):
+        self.queries = queries
+
+    def execute(self, query):
+        self.queries.append(query)
+
+    def fetchone(self):
+        return (b"\x00\x00\x00\x00\x00\x00\x07\xd1",)
+
+    def close(self):
+        pass
+
+
+class MarkConnection:
+    def __init__(self):
+        self.queries = []
+
+    def cursor(self):
+        return MarkCursor(self.queries)
+
+
+def test_rowversion_mark_is_the_lowest_active_rowversion():
+    conn = MarkConnection()
+
+    mark = get_source_high_water_mark(conn, artist_table(), "RowVersion")
+
+    assert conn.queries == ["SELECT MIN_ACTIVE_ROWVERSION()"]
+    assert mark == b"\x00\x00\x00\x00\x00\x00\x07\xd1"
+
+
+def test_rowversion_runs_copy_half_open_ranges():
+    table = artist_table()
+    first_mark = b"\x00\x00\x00\x00\x00\x00\x07\xd1"
+    second_mark = b"\x00\x00\x00\x00\x00\x00\x0b\xb9"
+
+    # The full run stops below the first mark, the next run starts at it
+    assert build_watermark_filter(table, "RowVersion", None, first_mark) == (
+        "([RowVersion] < ? OR [RowVersion] IS NULL)",
+        (first_mark,),
+    )
+    assert build_watermark_filter(table, "RowVersion", first_mark, second_mark) == (
+        "[RowVersion] >= ? AND [RowVersion] < ?",
+        (first_mark, second_mark),
+    )
+
+
+def test_date_and_time_marks_lag_the_source_clock():
+    table = artist_table()
+
+    query = build_high_water_mark_query(table, "ValidFrom", lag_seconds=60)
+    assert "DATEADD(SECOND, -60," in query
+    assert "SYSUTCDATETIME()" in query
+    assert query.rstrip().endswith("AS datetime2)")
+    assert "AS date)" in build_high_water_mark_query(table, "PlayedOn")
+
+    where, _ = build_watermark_filter(table, "ValidFrom", datetime(2024, 5, 1), datetime(2024, 5, 2))
+    assert where == "[ValidFrom] >= ? AND [ValidFrom] < ?"
+
+
+def test_other_marks_are_the_highest_value():
+    table = artist_table()
+
+    assert build_high_water_mark_query(table, "ArtistId") == "SELECT MAX([ArtistId]) FROM [dbo].[Artist]"
+    assert build_watermark_filter(table, "ArtistId", 10, 20) == (
+        "[ArtistId] > ? AND [ArtistId] <= ?",
+        (10, 20),
+    )
+    assert build_watermark_filter(table, "ArtistId", None, None) == (None, ())
@@ -0,0 +1,135 @@
+import json
+from utils.wave_planner import find_cycles, plan_waves, split_cycles, write_tables_config
+
+
+def test_find_cycles_groups_tables_of_a_cycle():
+    tables = ["Artist", "Album", "Track"]
+    dependencies = {"Artist": {"Album"}, "Album": {"Artist"}, "Track": {"Album"}}
+
+    components = find_cycles(tables, dependencies)
+
+    assert ["Album", "Artist"] in components
+    assert ["Track"] in components
+    # Dependencies come out before the tables that reference them
+    assert components.index(["Album", "Artist"]) < components.index(["Track"])
+
+
+def test_find_cycles_handles_deep_chains():
+    tables = [f"T{i}" for i in range(5000)]
+    dependencies = {table: {f"T{i + 1}"} if i < 4999 else set() for i, table in enumerate(tables)}
+
+    components = find_cycles(tables, dependencies)
+
+    assert len(components) == 5000
+    assert components[0] == ["T4999"]
+
+
+def test_plan_waves_orders_tables_after_their_dependencies():
+    tables = ["Artist", "Album", "Track", "Genre"]
+    dependencies = {"Artist": set(), "Genre": set(), "Album": {"Artist"}, "Track": {"Album", "Genre"}}
+
+    plan = plan_waves(tables, dependencies)
+
+    assert plan["waves"] == [["Artist", "Genre"], ["Album"], ["Track"]]
+    assert plan["cycles"] == []
+    assert plan["serial_waves"] == []
+    assert plan["deferred_fks"] == []
+
+
+def test_plan_waves_ignores_self_references():
+    tables = ["Employee", "Customer"]
+    dependencies = {"Employee": {"Employee"}, "Customer": {"Employee"}}
+
+    plan = plan_waves(tables, dependencies)
+
+    assert plan["waves"] == [["Employee"], ["Customer"]]
+    assert plan["self_references"] == ["Employee"]
+
+
+def test_split_cycles_drops_a_nullable_fk():
+    tables = ["Artist", "Album"]
+    dependencies = {"Artist": {"Album"}, "Album": {"Artist"}}
+
+    remaining, deferred = split_cycles(tables, dependencies, {("Artist", "Album")})
+
+    assert deferred == [("Artist", "Album")]
+    assert remaining == {"Artist": set(), "Album": {"Artist"}}
+    # The caller's dependencies are left alone
+    assert dependencies["Artist"] == {"Album"}
+
+
+def test_plan_waves_splits_a_cycle_into_consecutive_waves():
+    tables = ["Artist", "Album", "Track"]
+    dependencies = {"Artist": {"Album"}, "Album": {"Artist"}, "Track": {"Album"}}
+
+    plan = plan_waves(tables, dependencies, {("Artist", "Album")})
+
+    assert plan["waves"] == [["Artist"], ["Album"], ["Track"]]
+    assert plan["cycles"] == []
+    assert plan["serial_waves"] == []
+    assert plan["deferred_fks"] == [{"table": "Artist", "referenced_table": "Album"}]
+
+
+def test_plan_waves_marks_an_unsplittable_cycle_serial():
+    tables = ["Artist", "Album", "Track"]
+    dependencies = {"Artist": {"Album"}, "Album": {"Artist"}, "Track": {"Album"}}
+
+    plan = plan_waves(tables, dependencies)
+
+    assert plan["waves"] == [["Album", "Artist"], ["Track"]]
+    assert plan["cycles"] == [["Album", "Artist"]]
+    assert plan["serial_waves"] == [0]
+    assert plan["deferred_fks"] == []
+
+
+def test_write_tables_config_keeps_serial_waves_and_deferred_fks(tmp_path):
+    path = tmp_path / "tables.json"
+    deferred_fks = [{"table": "Artist", "referenced_table": "Album"}]
+
+    write_tables_config(
+        path,
+        "Music",
+        [["Album", "Artist"], ["Track"]],
+        table_options={"Track": {"merge_engine": "insert"}},
+        serial_waves=[0],
+        deferred_fks=deferred_fks,
+    )
+
+    database = json.loads(path.read_text())["databases"][0]
+    assert database["db_name"] == "Music"
+    assert database["waves"] == [
+        {"wave_num": "1", "tables": ["Album", "Artist"], "serial": True},
+        {"wave_num": "2", "tables": ["Track"]},
+    ]
+    assert database["deferred_fks"] == deferred_fks
+    assert database["table_options"] == {"Track": {"merge_engine": "insert"}}
+
+
+def test_write_tables_config_keeps_other_databases(tmp_path):
+    path = tmp_path / "tables.json"
+    path.write_text(
+        json.dumps(
+            {
+                "databases": [
+                    {"db_name": "Podcasts", "waves": [{"wave_num": "1", "tables": ["Show"]}]},
+                    {
+                        "db_name": "Music",
+                        "waves": [{"wave_num": "1", "tables": ["Artist"]}],
+                        "table_options": {"Artist": {"copy_connections": 4}},
+                    },
+                ]
+            }
+        )
+    )
+
+    write_tables_config(path, "Music", [["Artist"], ["Album"]])
+    write_tables_config(path, "Video", [["Film"]])
+
+    databases = json.loads(path.read_text())["databases"]
+    assert [database["db_name"] for database in databases] == ["Podcasts", "Music", "Video"]
+    assert databases[0]["waves"] == [{"wave_num": "1", "tables": ["Show"]}]
+    assert databases[1]["waves"] == [
+        {"wave_num": "1", "tables": ["Artist"]},
+        {"wave_num": "2", "tables": ["Album"]},
+    ]
+    assert databases[1]["table_options"] == {"Artist": {"copy_connections": 4}}
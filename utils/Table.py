@@ -24,6 +24,7 @@ class Table:
     column_list_with_new_keys: list = None
     column_list_new_keys_without_identity: list = None
     uniques: dict = None
+    column_types: dict = None
     combined_keys: list = None
     temporal_info: dict = None
 
@@ -36,6 +37,13 @@ class Table:
     def quoted_full_name(self):
         return f"[{self.schema_name}].[{self.table_name}]"
 
+    def key_map_name(self, column_name):
+        "narrow old -> new key map kept in the stage schema for the whole run"
+        return f"KeyMap_{self.table_name}_{column_name}"
+
+    def quoted_key_map_name(self, column_name):
+        return f"[{self.stage_schema}].[{self.key_map_name(column_name)}]"
+
     def is_pk_entirely_fks(self):
         # Extract the column names from the PK and FK lists
         pk_columns = [pk["PrimaryKeyName"] for pk in self.pk_column_list]
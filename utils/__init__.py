@@ -1,5 +1,8 @@
 from .Table import Table
+from . import telemetry
+from . import retry
 from .get_conns import get_conn_string
+from .connections import ConnectionPool, get_session_settings, get_connection_pool
 from .table_details import (
     get_column_list,
     columns_with_new_keys,
@@ -8,13 +11,15 @@ from .table_details import (
     change_temporal_state,
 )
 from .create_stage import (
+    DUPLICATE_FLAG_COLUMN,
     create_stage_schema,
     create_stage_table,
     create_stage_table_pk,
-    create_stage_table_newpk,
-    create_stage_table_identity,
-    create_stage_table_fks,
-    create_stage_temporal_history_keys,
+    drop_stage_table_pk,
+    truncate_stage_table,
+    get_stage_new_columns,
+    add_stage_new_columns,
+    has_duplicate_flag,
 )
 from .constraint_details import (
     get_primary_key,
@@ -22,50 +27,174 @@ from .constraint_details import (
     get_uniques,
     get_temporal_combined_keys,
 )
+from .stage_writers import (
+    StageWriter,
+    ExecutemanyWriter,
+    TvpWriter,
+    choose_stage_writer,
+    get_stage_writer,
+)
 from .copy_data import (
+    MERGE_ENGINES,
     copy_src_table_to_stage,
     merge_identity_table_data,
     merge_composite_table_data,
     merge_unique_table_data,
     merge_heap_table_data,
     insert_temporal_history_table_data,
+    mark_duplicate_stage_rows,
+)
+from .partitioned_copy import (
+    get_key_histogram,
+    plan_key_ranges,
+    plan_copy_ranges,
+    copy_src_table_partitioned,
+)
+from .spool import (
+    get_spool_path,
+    write_spool_frames,
+    read_spool_frames,
+    spool_src_table,
+    load_spool_to_stage,
+)
+from .catalog import (
+    Catalog,
+    load_catalog,
+    get_schema_fingerprint,
+    get_altered_tables,
+    save_catalog_cache,
+    load_catalog_cache,
+    get_catalog,
+    refresh_catalog_cache_fingerprint,
+)
+from .wave_planner import (
+    get_table_dependencies,
+    find_cycles,
+    split_cycles,
+    plan_waves,
+    write_tables_config,
+)
+from .stage_indexes import (
+    plan_stage_indexes,
+    create_stage_indexes,
+    drop_stage_indexes,
+)
+from .table_batch import build_table_batch, run_table_batch
+from .wave_constraints import (
+    get_wave_indexes,
+    get_wave_foreign_keys,
+    disable_wave_constraints,
+    restore_wave_constraints,
+)
+from .run_journal import PHASES, RunJournal
+from .watermarks import (
+    WatermarkStore,
+    get_watermark_column,
+    get_source_high_water_mark,
+    build_high_water_mark_query,
+    build_watermark_filter,
 )
+from .pipeline import STAGE_LOADS, RunSettings, migrate_table, run_waves
 from .update_keys import (
-    create_key_stage,
+    create_key_map,
+    drop_key_map,
     update_new_pk_in_stage,
+    get_key_maps,
+    build_key_remap_query,
     update_fks_in_stage,
+    update_deferred_fks,
     update_pk_columns_in_unique_stage,
     update_temporal_history_stage_keys,
 )
 
 __all__ = [
     Table,
+    telemetry,
+    retry,
     get_conn_string,
+    ConnectionPool,
+    get_session_settings,
+    get_connection_pool,
     get_column_list,
     columns_with_new_keys,
     get_column_data_type,
     get_temporal_info,
     change_temporal_state,
+    DUPLICATE_FLAG_COLUMN,
     create_stage_schema,
     create_stage_table,
     create_stage_table_pk,
-    create_stage_table_newpk,
-    create_stage_table_identity,
-    create_stage_table_fks,
-    create_stage_temporal_history_keys,
+    drop_stage_table_pk,
+    truncate_stage_table,
+    get_stage_new_columns,
+    add_stage_new_columns,
+    has_duplicate_flag,
     get_primary_key,
     get_foreign_keys,
     get_uniques,
     get_temporal_combined_keys,
+    StageWriter,
+    ExecutemanyWriter,
+    TvpWriter,
+    choose_stage_writer,
+    get_stage_writer,
+    MERGE_ENGINES,
     copy_src_table_to_stage,
     merge_identity_table_data,
     merge_composite_table_data,
     merge_unique_table_data,
     merge_heap_table_data,
     insert_temporal_history_table_data,
-    create_key_stage,
+    mark_duplicate_stage_rows,
+    get_key_histogram,
+    plan_key_ranges,
+    plan_copy_ranges,
+    copy_src_table_partitioned,
+    get_spool_path,
+    write_spool_frames,
+    read_spool_frames,
+    spool_src_table,
+    load_spool_to_stage,
+    create_key_map,
+    drop_key_map,
     update_new_pk_in_stage,
+    get_key_maps,
+    build_key_remap_query,
     update_fks_in_stage,
+    update_deferred_fks,
     update_pk_columns_in_unique_stage,
     update_temporal_history_stage_keys,
+    Catalog,
+    load_catalog,
+    get_schema_fingerprint,
+    get_altered_tables,
+    save_catalog_cache,
+    load_catalog_cache,
+    get_catalog,
+    refresh_catalog_cache_fingerprint,
+    get_table_dependencies,
+    find_cycles,
+    split_cycles,
+    plan_waves,
+    write_tables_config,
+    plan_stage_indexes,
+    create_stage_indexes,
+    drop_stage_indexes,
+    build_table_batch,
+    run_table_batch,
+    get_wave_indexes,
+    get_wave_foreign_keys,
+    disable_wave_constraints,
+    restore_wave_constraints,
+    PHASES,
+    RunJournal,
+    WatermarkStore,
+    get_watermark_column,
+    get_source_high_water_mark,
+    build_high_water_mark_query,
+    build_watermark_filter,
+    STAGE_LOADS,
+    RunSettings,
+    migrate_table,
+    run_waves,
 ]
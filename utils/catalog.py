@@ -0,0 +1,394 @@
+import json
+import os
+from dataclasses import asdict, dataclass, field
+from utils.Table import Table
+
+
+# Row version columns are set by the server on every write, no INSERT may name them
+ROWVERSION_TYPES = ("timestamp", "rowversion")
+
+
+def catalog_key(schema_name, table_name):
+    return f"{schema_name}.{table_name}"
+
+
+@dataclass
+class Catalog:
+    """In-memory snapshot of the destination catalog, keyed by "schema.table".
+    Loaded once with a handful of bulk queries so per-table metadata does not need
+    its own round trips."""
+
+    columns: dict = field(default_factory=dict)
+    primary_keys: dict = field(default_factory=dict)
+    foreign_keys: dict = field(default_factory=dict)
+    uniques: dict = field(default_factory=dict)
+    clustered: dict = field(default_factory=dict)
+    temporal: dict = field(default_factory=dict)
+
+    def column_list(self, schema_name, table_name, include_identity=True):
+        "the columns a migration copies, computed and row version columns left out"
+        return [
+            column["name"]
+            for column in self.columns.get(catalog_key(schema_name, table_name), [])
+            if not column["is_computed"]
+            and column["data_type"] not in ROWVERSION_TYPES
+            and (include_identity or not column["is_identity"])
+        ]
+
+    def column_types(self, schema_name, table_name):
+        return {
+            column["name"]: column["data_type"]
+            for column in self.columns.get(catalog_key(schema_name, table_name), [])
+        }
+
+    def identity(self, schema_name, table_name):
+        for column in self.columns.get(catalog_key(schema_name, table_name), []):
+            if column["is_identity"]:
+                return column["name"]
+        return None
+
+    def primary_key(self, schema_name, table_name):
+        return self.primary_keys.get(catalog_key(schema_name, table_name), [])
+
+    def foreign_key_list(self, schema_name, table_name):
+        return self.foreign_keys.get(catalog_key(schema_name, table_name), [])
+
+    def temporal_info(self, schema_name, table_name):
+        return self.temporal.get(
+            catalog_key(schema_name, table_name),
+            {
+                "master_schema": schema_name,
+                "master_table": table_name,
+                "temporal_type": "NON_TEMPORAL",
+                "history_schema": None,
+                "history_table": None,
+                "validity_period_start": None,
+                "validity_period_end": None,
+            },
+        )
+
+    def populate(self, table: Table):
+        "fill the catalog driven fields of a Table"
+        key = catalog_key(table.schema_name, table.table_name)
+        if key not in self.columns:
+            raise KeyError(f"Table {table.quoted_full_name()} not found in catalog")
+
+        table.pk_column_list = self.primary_key(table.schema_name, table.table_name)
+        table.fk_column_list = self.foreign_key_list(
+            table.schema_name, table.table_name
+        )
+        table.uniques = self.uniques.get(key, {})
+        table.column_list = self.column_list(table.schema_name, table.table_name)
+        table.column_list_without_identity = self.column_list(
+            table.schema_name, table.table_name, include_identity=False
+        )
+        table.column_types = self.column_types(table.schema_name, table.table_name)
+        table.identity = self.identity(table.schema_name, table.table_name)
+        table.clustered = self.clustered.get(key, [])
+        table.temporal_info = self.temporal_info(table.schema_name, table.table_name)
+
+
+def load_catalog(conn, stage_schema):
+    "load columns, keys, uniques, identities, clustered indexes and temporal info for every table"
+    crsr = conn.cursor()
+    catalog = Catalog()
+
+    columns_query = f"""
+    SELECT c.TABLE_SCHEMA AS table_schema, c.TABLE_NAME AS table_name,
+        c.COLUMN_NAME AS column_name,
+        c.DATA_TYPE + CASE
+            WHEN c.CHARACTER_MAXIMUM_LENGTH = -1 THEN '(max)'
+            WHEN c.CHARACTER_MAXIMUM_LENGTH IS NOT NULL
+            THEN '(' + CAST(c.CHARACTER_MAXIMUM_LENGTH AS VARCHAR) + ')'
+            ELSE '' END AS data_type,
+        COLUMNPROPERTY(
+            OBJECT_ID(QUOTENAME(c.TABLE_SCHEMA) + '.' + QUOTENAME(c.TABLE_NAME)),
+            c.COLUMN_NAME, 'IsIdentity'
+        ) AS is_identity,
+        COLUMNPROPERTY(
+            OBJECT_ID(QUOTENAME(c.TABLE_SCHEMA) + '.' + QUOTENAME(c.TABLE_NAME)),
+            c.COLUMN_NAME, 'IsComputed'
+        ) AS is_computed
+    FROM INFORMATION_SCHEMA.COLUMNS AS c
+    INNER JOIN INFORMATION_SCHEMA.TABLES AS t ON c.TABLE_SCHEMA = t.TABLE_SCHEMA
+        AND c.TABLE_NAME = t.TABLE_NAME
+    WHERE t.TABLE_TYPE = 'BASE TABLE'
+        AND c.TABLE_SCHEMA <> '{stage_schema}'
+    ORDER BY c.TABLE_SCHEMA, c.TABLE_NAME, c.ORDINAL_POSITION;
+    """
+    crsr.execute(columns_query)
+    for row in crsr.fetchall():
+        key = catalog_key(row.table_schema, row.table_name)
+        catalog.columns.setdefault(key, []).append(
+            {
+                "name": row.column_name,
+                "data_type": row.data_type,
+                "is_identity": row.is_identity == 1,
+                "is_computed": row.is_computed == 1,
+            }
+        )
+
+    pk_query = f"""
+    SELECT OBJECT_SCHEMA_NAME(kc.parent_object_id) AS table_schema,
+        OBJECT_NAME(kc.parent_object_id) AS table_name,
+        c.name AS PrimaryKeyName, c.column_id AS ColumnId,
+        TYPE_NAME(c.system_type_id) AS ColumnType, c.is_identity AS [Identity]
+    FROM sys.key_constraints kc
+    INNER JOIN sys.index_columns ic ON kc.parent_object_id = ic.object_id  and kc.unique_index_id = ic.index_id
+    INNER JOIN sys.columns c ON ic.object_id = c.object_id AND ic.column_id = c.column_id
+    WHERE kc.type = 'PK' AND OBJECT_SCHEMA_NAME(kc.parent_object_id) <> '{stage_schema}'
+    ORDER BY table_schema, table_name, ic.key_ordinal;
+    """
+    crsr.execute(pk_query)
+    for row in crsr.fetchall():
+        key = catalog_key(row.table_schema, row.table_name)
+        catalog.primary_keys.setdefault(key, []).append(
+            {
+                "PrimaryKeyName": row.PrimaryKeyName,
+                "ColumnId": row.ColumnId,
+                "ColumnType": row.ColumnType,
+                "Identity": row.Identity,
+            }
+        )
+
+    foreign_keys_query = f"""
+    SELECT
+        OBJECT_SCHEMA_NAME(FK.parent_object_id) AS table_schema,
+        FK.name AS foreign_key_name,
+        OBJECT_NAME(FKC.parent_object_id) AS parent_table,
+        C.name AS parent_column,
+        OBJECT_NAME(FKC.referenced_object_id) AS referenced_table,
+        CR.name AS referenced_column
+    FROM sys.foreign_keys AS FK
+    JOIN sys.foreign_key_columns AS FKC ON FK.object_id = FKC.constraint_object_id
+    JOIN sys.columns AS C ON FKC.parent_column_id = C.column_id
+        AND FKC.parent_object_id = C.object_id
+    JOIN sys.columns AS CR ON FKC.referenced_column_id = CR.column_id
+        AND FKC.referenced_object_id = CR.object_id
+    WHERE OBJECT_SCHEMA_NAME(FK.parent_object_id) <> '{stage_schema}'
+    ORDER BY table_schema, parent_table, foreign_key_name;
+    """
+    crsr.execute(foreign_keys_query)
+    for row in crsr.fetchall():
+        key = catalog_key(row.table_schema, row.parent_table)
+        catalog.foreign_keys.setdefault(key, []).append(
+            {
+                "name": row.foreign_key_name,
+                "parent_table": row.parent_table,
+                "parent_column": row.parent_column,
+                "referenced_table": row.referenced_table,
+                "referenced_column": row.referenced_column,
+            }
+        )
+
+    unique_constraints_query = f"""
+    SELECT DISTINCT OBJECT_SCHEMA_NAME(i.object_id) AS table_schema,
+        OBJECT_NAME(i.object_id) AS table_name,
+        i.name AS constraint_name, c.name AS column_name
+    FROM sys.indexes AS i
+    JOIN sys.index_columns AS ic ON i.object_id = ic.object_id
+            AND i.index_id = ic.index_id
+    JOIN sys.columns AS c ON ic.object_id = c.object_id
+            AND ic.column_id = c.column_id
+    WHERE i.is_unique = 1
+        AND OBJECTPROPERTY(i.object_id, 'IsUserTable') = 1
+        AND OBJECT_SCHEMA_NAME(i.object_id) <> '{stage_schema}'
+        AND ic.is_included_column = 0 -- Exclude included columns
+    ORDER BY table_schema, table_name, constraint_name, column_name;
+    """
+    crsr.execute(unique_constraints_query)
+    for row in crsr.fetchall():
+        key = catalog_key(row.table_schema, row.table_name)
+        unique_constraints = catalog.uniques.setdefault(key, {})
+
+        # Exclude constraints that match the primary key, same as get_uniques
+        pk_columns = ", ".join(
+            item["PrimaryKeyName"] for item in catalog.primary_keys.get(key, [])
+        )
+        if row.column_name not in pk_columns:
+            if row.constraint_name not in unique_constraints:
+                unique_constraints[row.constraint_name] = []
+            unique_constraints[row.constraint_name].append(row.column_name)
+
+    clustered_query = f"""
+    SELECT OBJECT_SCHEMA_NAME(tbl.object_id) AS table_schema, tbl.name AS table_name,
+        col.name AS clustered_column_name
+    FROM sys.indexes AS idx
+    INNER JOIN sys.tables AS tbl ON idx.object_id = tbl.object_id
+    INNER JOIN sys.index_columns AS ic ON idx.object_id = ic.object_id AND idx.index_id = ic.index_id
+    INNER JOIN sys.columns AS col ON ic.object_id = col.object_id AND ic.column_id = col.column_id
+    WHERE idx.index_id = 1   -- Clustered index has index_id 1
+    AND OBJECT_SCHEMA_NAME(tbl.object_id) <> '{stage_schema}'
+    ORDER BY table_schema, table_name, ic.key_ordinal;
+    """
+    crsr.execute(clustered_query)
+    for row in crsr.fetchall():
+        key = catalog_key(row.table_schema, row.table_name)
+        catalog.clustered.setdefault(key, []).append(row.clustered_column_name)
+
+    # For a history table the master is the table pointing at it through history_table_id
+    temporal_query = f"""
+        SELECT
+            SCHEMA_NAME(t.schema_id) AS table_schema,
+            t.name AS table_name,
+            CASE
+                WHEN t.temporal_type = 1 THEN 'HISTORY'
+                WHEN t.temporal_type = 2 THEN 'TEMPORAL'
+                ELSE 'NON_TEMPORAL'
+            END AS temporal_type,
+            SCHEMA_NAME(m.schema_id) AS master_schema,
+            m.name AS master_table,
+            SCHEMA_NAME(h.schema_id) AS history_schema,
+            h.name AS history_table,
+            (
+                SELECT c.name
+                FROM sys.columns c
+                WHERE c.object_id = m.object_id AND c.column_id = p.start_column_id
+            ) AS validity_period_start,
+            (
+                SELECT c.name
+                FROM sys.columns c
+                WHERE c.object_id = m.object_id AND c.column_id = p.end_column_id
+            ) AS validity_period_end
+        FROM sys.tables AS t
+        INNER JOIN sys.tables AS m ON (t.temporal_type = 1 AND m.history_table_id = t.object_id)
+            OR (t.temporal_type = 2 AND m.object_id = t.object_id)
+        LEFT JOIN sys.periods AS p ON m.object_id = p.object_id
+        LEFT JOIN sys.tables AS h ON m.history_table_id = h.object_id
+        WHERE SCHEMA_NAME(t.schema_id) <> '{stage_schema}';
+        """
+    crsr.execute(temporal_query)
+    for row in crsr.fetchall():
+        key = catalog_key(row.table_schema, row.table_name)
+        catalog.temporal[key] = {
+            "master_schema": row.master_schema,
+            "master_table": row.master_table,
+            "temporal_type": row.temporal_type,
+            "history_schema": row.history_schema,
+            "history_table": row.history_table,
+            "validity_period_start": row.validity_period_start,
+            "validity_period_end": row.validity_period_end,
+        }
+
+    crsr.close()
+
+    print(f"Loaded catalog for {len(catalog.columns)} tables")
+    return catalog
+
+
+def get_schema_fingerprint(conn, stage_schema, exclude_tables=None):
+    """Cheap fingerprint of the destination schema: user object count plus the latest
+    modify_date.  The STAGE schema is excluded since the migration itself churns it.
+    exclude_tables ("schema.table" names) leaves the modify_date of those tables and
+    their constraints out, see get_altered_tables."""
+    crsr = conn.cursor()
+
+    modify_date = "modify_date"
+    if exclude_tables:
+        table_list = ", ".join(f"'{table}'" for table in sorted(exclude_tables))
+        owner_id = "COALESCE(NULLIF(parent_object_id, 0), object_id)"
+        modify_date = f"""CASE WHEN OBJECT_SCHEMA_NAME({owner_id}) + '.' + OBJECT_NAME({owner_id})
+            IN ({table_list}) THEN NULL ELSE modify_date END"""
+
+    fingerprint_query = f"""
+    SELECT COUNT(*) AS object_count,
+        CONVERT(VARCHAR(33), MAX({modify_date}), 126) AS max_modify_date
+    FROM sys.objects
+    WHERE is_ms_shipped = 0
+        AND schema_id <> SCHEMA_ID('{stage_schema}');
+    """
+    crsr.execute(fingerprint_query)
+    result = crsr.fetchone()
+
+    crsr.close()
+    return f"{result.object_count}:{result.max_modify_date}"
+
+
+def get_altered_tables(catalog: Catalog, schema_name, table_names, alters_indexes=False):
+    """The "schema.table" names of the tables a run alters itself.  Temporal tables and
+    their history tables have SYSTEM_VERSIONING toggled, and with alters_indexes every
+    table has its indexes and FK checks disabled and rebuilt."""
+    altered_tables = set()
+    for table_name in table_names:
+        if alters_indexes:
+            altered_tables.add(catalog_key(schema_name, table_name))
+
+        temporal_info = catalog.temporal_info(schema_name, table_name)
+        if temporal_info["temporal_type"] in ("TEMPORAL", "HISTORY"):
+            altered_tables.add(
+                catalog_key(temporal_info["master_schema"], temporal_info["master_table"])
+            )
+            altered_tables.add(
+                catalog_key(temporal_info["history_schema"], temporal_info["history_table"])
+            )
+    return altered_tables
+
+
+def save_catalog_cache(cache_path, catalog: Catalog, fingerprint):
+    "write the catalog snapshot to disk along with the fingerprint it was taken at"
+    cache_dir = os.path.dirname(cache_path)
+    if cache_dir:
+        os.makedirs(cache_dir, exist_ok=True)
+
+    # Write to a temp file first so a crash never leaves a half written cache
+    temp_path = f"{cache_path}.tmp"
+    with open(temp_path, "w") as f:
+        json.dump({"fingerprint": fingerprint, "catalog": asdict(catalog)}, f)
+    os.replace(temp_path, cache_path)
+
+
+def load_catalog_cache(cache_path, fingerprint):
+    "returns the cached catalog if it was taken at this fingerprint, otherwise None"
+    if not os.path.exists(cache_path):
+        return None
+
+    try:
+        with open(cache_path, "r") as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    if cached.get("fingerprint") != fingerprint:
+        return None
+
+    return Catalog(**cached["catalog"])
+
+
+def get_catalog(conn, stage_schema, cache_path=None):
+    """Load the catalog from the on-disk cache when the schema fingerprint still matches,
+    otherwise introspect the destination and refresh the cache."""
+    if cache_path is None:
+        return load_catalog(conn=conn, stage_schema=stage_schema)
+
+    fingerprint = get_schema_fingerprint(conn=conn, stage_schema=stage_schema)
+    catalog = load_catalog_cache(cache_path=cache_path, fingerprint=fingerprint)
+    if catalog is not None:
+        print(f"Using cached catalog for {len(catalog.columns)} tables from {cache_path}")
+        return catalog
+
+    print("Schema changed or no catalog cache found, loading catalog")
+    catalog = load_catalog(conn=conn, stage_schema=stage_schema)
+    save_catalog_cache(cache_path=cache_path, catalog=catalog, fingerprint=fingerprint)
+    return catalog
+
+
+def refresh_catalog_cache_fingerprint(
+    conn, stage_schema, cache_path, catalog: Catalog, run_fingerprint, altered_tables
+):
+    """Re-stamp the cache after a run.  Toggling SYSTEM_VERSIONING and rebuilding indexes
+    bump the modify_date of the altered_tables without changing anything the catalog
+    holds.  run_fingerprint was taken without them before the run; when anything else
+    changed since, another session changed the schema and the cache is dropped instead.
+    Returns whether the cache was kept."""
+    fingerprint = get_schema_fingerprint(
+        conn=conn, stage_schema=stage_schema, exclude_tables=altered_tables
+    )
+    if fingerprint != run_fingerprint:
+        print("Destination schema changed during the run, dropping the catalog cache")
+        if os.path.exists(cache_path):
+            os.remove(cache_path)
+        return False
+
+    fingerprint = get_schema_fingerprint(conn=conn, stage_schema=stage_schema)
+    save_catalog_cache(cache_path=cache_path, catalog=catalog, fingerprint=fingerprint)
+    return True
@@ -0,0 +1,142 @@
+import threading
+from contextlib import contextmanager
+from time import monotonic
+from utils.get_conns import get_conn_string
+
+ISOLATION_LEVELS = (
+    "READ UNCOMMITTED",
+    "READ COMMITTED",
+    "REPEATABLE READ",
+    "SNAPSHOT",
+    "SERIALIZABLE",
+)
+# Idle connections older than this are checked with a round trip before reuse
+DEFAULT_HEALTH_CHECK_SECONDS = 30
+
+
+def get_session_settings(config, type):
+    """SET statements run on every new connection of an endpoint, from its optional
+    "arithabort" and "isolation_level" config entries"""
+    endpoint = config[f"{type}"]
+    session_settings = []
+
+    if "arithabort" in endpoint:
+        session_settings.append(f"SET ARITHABORT {'ON' if endpoint['arithabort'] else 'OFF'}")
+
+    isolation_level = endpoint.get("isolation_level")
+    if isolation_level:
+        isolation_level = isolation_level.upper()
+        if isolation_level not in ISOLATION_LEVELS:
+            raise ValueError(f"Unknown isolation level: {isolation_level}")
+        session_settings.append(f"SET TRANSACTION ISOLATION LEVEL {isolation_level}")
+
+    return session_settings
+
+
+class ConnectionPool:
+    """Connections to one endpoint, opened by connect and reused once released.
+    New connections get the session settings applied.  A connection idle for longer
+    than health_check_seconds is checked before it is handed out, and replaced by a
+    new one when the check fails, so a dropped connection only costs a reconnect.
+    The pool is not bounded, callers holding a connection may take another."""
+
+    def __init__(
+        self,
+        connect,
+        session_settings=None,
+        health_check_seconds=DEFAULT_HEALTH_CHECK_SECONDS,
+        name="",
+    ):
+        self.connect = connect
+        self.session_settings = session_settings or []
+        self.health_check_seconds = health_check_seconds
+        self.name = name
+        self.lock = threading.Lock()
+        self.idle = []
+        self.opened = 0
+        self.reconnects = 0
+
+    def open_connection(self):
+        conn = self.connect()
+        if self.session_settings:
+            crsr = conn.cursor()
+            for statement in self.session_settings:
+                crsr.execute(statement)
+            crsr.close()
+        with self.lock:
+            self.opened += 1
+        return conn
+
+    def is_healthy(self, conn):
+        try:
+            crsr = conn.cursor()
+            crsr.execute("SELECT 1")
+            crsr.fetchall()
+            crsr.close()
+            return True
+        except Exception:
+            return False
+
+    def acquire(self):
+        "an idle connection that passed its health check, or a new one"
+        while True:
+            with self.lock:
+                if not self.idle:
+                    break
+                conn, released_at = self.idle.pop()
+
+            if monotonic() - released_at < self.health_check_seconds or self.is_healthy(conn):
+                return conn
+
+            print(f"Reconnecting a dropped {self.name} connection")
+            with self.lock:
+                self.reconnects += 1
+            self.discard(conn)
+
+        return self.open_connection()
+
+    def release(self, conn, discard=False):
+        "hand a connection back, discard drops it instead when it may be unusable"
+        if discard:
+            self.discard(conn)
+            return
+        with self.lock:
+            self.idle.append((conn, monotonic()))
+
+    def discard(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    @contextmanager
+    def connection(self):
+        "a pooled connection for the with block, dropped when the block raises"
+        conn = self.acquire()
+        try:
+            yield conn
+        except BaseException:
+            self.release(conn, discard=True)
+            raise
+        self.release(conn)
+
+    def close(self):
+        "close every idle connection"
+        with self.lock:
+            idle = self.idle
+            self.idle = []
+        for conn, _ in idle:
+            self.discard(conn)
+
+
+def get_connection_pool(config, type, health_check_seconds=DEFAULT_HEALTH_CHECK_SECONDS):
+    "a ConnectionPool for the source or destination in config, see get_conn_string"
+    import pyodbc
+
+    conn_string = get_conn_string(config=config, type=type)
+    return ConnectionPool(
+        connect=lambda: pyodbc.connect(conn_string, autocommit=True),
+        session_settings=get_session_settings(config=config, type=type),
+        health_check_seconds=health_check_seconds,
+        name=type,
+    )
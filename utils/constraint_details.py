@@ -1,4 +1,5 @@
 from utils.Table import Table
+from utils.table_details import get_column_data_type
 
 
 def get_primary_key(conn, table: Table):
@@ -100,7 +101,8 @@ def get_uniques(conn, table: Table):
     return unique_constraints
 
 
-def get_temporal_combined_keys(conn, stage_schema, temporal_info):
+def get_temporal_combined_keys(conn, stage_schema, temporal_info, catalog=None):
+    "PK and FKs of a temporal master table, which act as the keys of its history table"
     temporal_master_schema = temporal_info["master_schema"]
     temporal_master_table = temporal_info["master_table"]
     temporal_history_table = temporal_info["history_table"]
@@ -111,8 +113,17 @@ def get_temporal_combined_keys(conn, stage_schema, temporal_info):
         table_name=temporal_master_table,
     )
 
-    temporal_pk = get_primary_key(conn=conn, table=master_table)
-    temporal_fks = get_foreign_keys(conn=conn, table=master_table)
+    if catalog is not None:
+        temporal_pk = catalog.primary_key(temporal_master_schema, temporal_master_table)
+        temporal_fks = catalog.foreign_key_list(
+            temporal_master_schema, temporal_master_table
+        )
+        master_table.column_types = catalog.column_types(
+            temporal_master_schema, temporal_master_table
+        )
+    else:
+        temporal_pk = get_primary_key(conn=conn, table=master_table)
+        temporal_fks = get_foreign_keys(conn=conn, table=master_table)
 
     # Add primary and foreign keys to the list of combined_keys
     combined_keys = []
@@ -124,6 +135,9 @@ def get_temporal_combined_keys(conn, stage_schema, temporal_info):
                 "parent_column": pk["PrimaryKeyName"],
                 "referenced_table": temporal_master_table,
                 "referenced_column": pk["PrimaryKeyName"],
+                "data_type": get_column_data_type(
+                    conn=conn, table=master_table, column_name=pk["PrimaryKeyName"]
+                ),
             }
         )
     for fk in temporal_fks:
@@ -134,6 +148,9 @@ def get_temporal_combined_keys(conn, stage_schema, temporal_info):
                 "parent_column": fk["parent_column"],
                 "referenced_table": fk["referenced_table"],
                 "referenced_column": fk["referenced_column"],
+                "data_type": get_column_data_type(
+                    conn=conn, table=master_table, column_name=fk["parent_column"]
+                ),
             }
         )
 
@@ -1,168 +1,529 @@
-from utils.update_keys import create_key_stage, update_new_pk_in_stage
+import queue
+import sys
+import threading
+from time import perf_counter, sleep
+from utils import telemetry
+from utils.update_keys import create_key_map, update_new_pk_in_stage
+from utils.create_stage import DUPLICATE_FLAG_COLUMN, has_duplicate_flag
+from utils.stage_writers import get_stage_writer
+from utils.retry import retry_transient
 from utils.Table import Table
 
+# Rows per fetchmany/executemany round trip when streaming source to stage
+DEFAULT_CHUNK_SIZE = 10000
+# Rows fetched up front to estimate row width for the memory budget
+SAMPLE_ROWS = 100
+# Chunks the source reader may fetch ahead of the stage writer, 0 to copy sequentially
+DEFAULT_PREFETCH_CHUNKS = 2
+# How stage rows get into the destination: "merge" runs MERGE, "insert" runs an anti-join
+# INSERT ... SELECT.  Identity tables always MERGE ON 1 = 0 to fill their key map
+MERGE_ENGINES = ("merge", "insert")
+
+
+def estimate_row_bytes(rows):
+    "rough in-memory size of a fetched row, used to size chunks against a memory budget"
+    if not rows:
+        return 0
+
+    total = 0
+    for row in rows:
+        total += sys.getsizeof(row) + sum(sys.getsizeof(value) for value in row)
+
+    return total // len(rows)
+
+
+def get_fetch_size(rows, chunk_size, memory_budget_mb=None, prefetch_chunks=0):
+    """Rows per fetch: chunk_size, reduced when memory_budget_mb is given so every chunk
+    in flight fits in the budget.  rows is a sample of the source rows."""
+    if not memory_budget_mb or not rows:
+        return chunk_size
+
+    row_bytes = estimate_row_bytes(rows)
+    # The chunk being written is held twice: once as python rows and once in the
+    # ODBC parameter array.  Queued chunks and the one being fetched are held once.
+    chunks_in_memory = 2 + (prefetch_chunks + 1 if prefetch_chunks else 0)
+    budget_rows = (memory_budget_mb * 1024 * 1024) // max(
+        chunks_in_memory * row_bytes, 1
+    )
+    fetch_size = max(1, min(chunk_size, budget_rows))
+    print(f"Copying in chunks of {fetch_size} rows (~{row_bytes} bytes per row)")
+    return fetch_size
+
+
+def fetch_chunks(src_crsr, first_rows, fetch_size, timings):
+    "yield first_rows then every further chunk of the source cursor, timing the reads"
+    rows = first_rows
+    while rows:
+        yield rows
+
+        read_start = perf_counter()
+        rows = src_crsr.fetchmany(fetch_size)
+        timings["read"] += perf_counter() - read_start
+
+
+def read_chunks_ahead(src_crsr, first_rows, fetch_size, timings, prefetch):
+    """Same as fetch_chunks, but a reader thread keeps fetching while the caller writes.
+    At most prefetch chunks wait in the queue, so a slow destination holds the reader
+    back instead of letting fetched rows pile up.  A source error is raised in the caller,
+    and closing the generator early stops the reader."""
+    chunk_queue = queue.Queue(maxsize=prefetch)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                chunk_queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def reader():
+        try:
+            rows = first_rows
+            while rows and not stop.is_set():
+                read_start = perf_counter()
+                rows = src_crsr.fetchmany(fetch_size)
+                timings["read"] += perf_counter() - read_start
+                if rows:
+                    put(rows)
+            put(None)
+        except Exception as e:
+            put(e)
+
+    reader_thread = threading.Thread(target=reader, daemon=True)
+    reader_thread.start()
+    try:
+        yield first_rows
+        while True:
+            item = chunk_queue.get()
+            if item is None:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stop.set()
+        reader_thread.join()
+
 
 def copy_src_table_to_stage(
     src_conn,
     dest_conn,
     table: Table,
+    chunk_size=DEFAULT_CHUNK_SIZE,
+    memory_budget_mb=None,
+    writer_name="executemany",
+    prefetch_chunks=DEFAULT_PREFETCH_CHUNKS,
+    source_filter=None,
+    source_params=(),
+    writer_id=None,
+    tablock=False,
 ):
-    "copy a tables data from src_conn to dest_conn in stage schema"
+    """copy a tables data from src_conn to dest_conn in stage schema
+    Rows are streamed in chunks of at most chunk_size rows.  When memory_budget_mb
+    is given the chunk size is reduced so all chunks in flight stay within the budget.
+    Chunks are written by the stage writer writer_name, see choose_stage_writer.
+    With prefetch_chunks above 0 the source is read on its own thread while the
+    destination is written, see read_chunks_ahead.  source_filter is an optional WHERE
+    clause, with ? placeholders bound to source_params, limiting the rows copied.
+    Copies of the same table running at once pass their own writer_id.  tablock
+    loads a stage heap with a table lock, see StageWriter."""
     src_crsr = src_conn.cursor()
 
     print(f"Starting source to stage table copy of [{table.table_name}]...")
 
     columns = ",".join(table.column_list)
-    placeholders = ",".join(["?" for _ in table.column_list])
 
     quoted_stage_name = table.quoted_stage_name()
     quoted_full_name = table.quoted_full_name()
 
     # Get table data
+    timings = {"read": 0.0, "write": 0.0}
+    copy_start = perf_counter()
     get_data_sql = f"SELECT {columns} FROM {quoted_full_name}"
-    src_crsr.execute(get_data_sql)
-    records = src_crsr.fetchall()
+    if source_filter:
+        get_data_sql += f" WHERE {source_filter}"
+    src_crsr.execute(get_data_sql, *source_params)
+
+    writer = get_stage_writer(
+        conn=dest_conn,
+        table=table,
+        writer_name=writer_name,
+        writer_id=writer_id,
+        tablock=tablock,
+    )
 
-    src_crsr.close()
+    # Size the chunks off a small sample so a chunk fits inside the memory budget
+    rows = src_crsr.fetchmany(min(chunk_size, SAMPLE_ROWS))
+    timings["read"] += perf_counter() - copy_start
+    fetch_size = get_fetch_size(
+        rows=rows,
+        chunk_size=chunk_size,
+        memory_budget_mb=memory_budget_mb,
+        prefetch_chunks=prefetch_chunks,
+    )
 
-    dest_crsr = dest_conn.cursor()
+    if prefetch_chunks and rows:
+        chunks = read_chunks_ahead(
+            src_crsr, rows, fetch_size, timings, prefetch=prefetch_chunks
+        )
+    else:
+        chunks = fetch_chunks(src_crsr, rows, fetch_size, timings)
+
+    # Insert records into STAGE table as they arrive
+    total_rows = 0
+    try:
+        if rows:
+            write_start = perf_counter()
+            writer.open()
+            timings["write"] += perf_counter() - write_start
+
+        for rows in chunks:
+            write_start = perf_counter()
+            writer.write_chunk(rows)
+            timings["write"] += perf_counter() - write_start
+            total_rows += len(rows)
+    finally:
+        chunks.close()
+        writer.close()
+        src_crsr.close()
+
+    telemetry.record_span(table.table_name, "source_read", timings["read"], rows=total_rows)
+    telemetry.record_span(
+        table.table_name, "stage_write", timings["write"], rows=total_rows, detail=writer.name
+    )
+    # With prefetching the reads overlap the writes, so this is less than their sum
+    telemetry.record_span(
+        table.table_name,
+        "copy",
+        perf_counter() - copy_start,
+        rows=total_rows,
+        detail=None if writer_id is None else f"range {writer_id}",
+    )
 
-    # Insert records into STAGE table
-    if records:
-        if table.identity:
-            dest_crsr.execute(f"SET IDENTITY_INSERT {quoted_stage_name} ON")
-        dest_crsr.fast_executemany = True
-        sql = f"INSERT INTO {quoted_stage_name} ({columns}) VALUES ({placeholders})"
-        dest_crsr.executemany(sql, records)
-        if table.identity:
-            dest_crsr.execute(f"SET IDENTITY_INSERT {quoted_stage_name} OFF")
+    print(f"Copied {total_rows} rows into {quoted_stage_name} with the {writer.name} writer")
+    return total_rows
 
-    dest_crsr.close()
 
+def build_unique_match_conditions(table: Table, uq_columns):
+    "join a stage row to destination rows holding the same values of a unique constraint"
+    return " AND ".join(
+        f"existing.[{col}] = stage.[{col if col in table.column_list_with_new_keys else 'New_' + col}]"
+        for col in uq_columns
+    )
 
-def build_unique_conditions(table: Table):
-    "build the WHEN condition based on uniques"
+
+def build_mark_duplicates_sql(table: Table, source_filter=None, update_matched=False):
+    """Statements flagging the stage rows the merge must skip in their Stage_Duplicate
+    column: rows with a NULL in a unique constraint column, then rows whose values of a
+    unique constraint are already in the destination, with one join per constraint.
+    A non identity table with a deferred FK also flags the rows whose PK is already in
+    the destination, unless update_matched merges them as well.
+    source_filter limits the rows marked, as a condition on the stage alias stage."""
+    if not has_duplicate_flag(table):
+        return []
+
+    quoted_stage_name = table.quoted_stage_name()
     quoted_full_name = table.quoted_full_name()
+    row_filter = source_filter or "1 = 1"
 
-    when_conditions = []
-    for constraint_name, uq_columns in table.uniques.items():
-        # Create a list of conditions for each column in the unique constraint
-        column_conditions = []
-        for col in uq_columns:
-            # Check that the source column is not NULL
-            column_conditions.append(f"source.[{col}] IS NOT NULL")
-
-        combined_condition = " AND ".join(column_conditions)
-
-        # Include the duplicate checking logic using NOT EXISTS
-        condition_parts = []
-        for col in uq_columns:
-            source_col = f"source.[{col if col in table.column_list_with_new_keys else 'New_' + col}]"
-            existing_col = f"existing.[{col}]"
-            condition = f"{existing_col} = {source_col}"
-            condition_parts.append(condition)
-
-        conditions = ' AND '.join(condition_parts)
-
-        duplicate_check = f"""
-            NOT EXISTS (SELECT 1
-            FROM {quoted_full_name} AS existing
-            WHERE {conditions}
-            )
+    flag_value = "0"
+    if table.uniques:
+        # Rows with a NULL unique column were never inserted, they stay skipped
+        unique_columns = dict.fromkeys(
+            col for uq_columns in table.uniques.values() for col in uq_columns
+        )
+        null_conditions = " OR ".join(f"stage.[{col}] IS NULL" for col in unique_columns)
+        flag_value = f"CASE WHEN {null_conditions} THEN 1 ELSE 0 END"
+
+    statements = [
+        f"""
+        UPDATE stage
+        SET [{DUPLICATE_FLAG_COLUMN}] = {flag_value}
+        FROM {quoted_stage_name} AS stage
+        WHERE {row_filter};
         """
+    ]
+    for uq_columns in (table.uniques or {}).values():
+        statements.append(
+            f"""
+            UPDATE stage
+            SET [{DUPLICATE_FLAG_COLUMN}] = 1
+            FROM {quoted_stage_name} AS stage
+            INNER JOIN {quoted_full_name} AS existing
+                ON {build_unique_match_conditions(table=table, uq_columns=uq_columns)}
+            WHERE stage.[{DUPLICATE_FLAG_COLUMN}] = 0 AND {row_filter};
+            """
+        )
+
+    # The merge matches these rows on the PK and leaves them, so must the deferred FK update
+    has_deferred_fk = any(fk.get("deferred") for fk in table.fk_column_list or [])
+    if has_deferred_fk and not table.identity and not update_matched:
+        pk_conditions, _ = build_pk_conditions(
+            table=table, new_keys=table.type == "COMPOSITE"
+        )
+        if pk_conditions:
+            statements.append(
+                f"""
+                UPDATE source
+                SET [{DUPLICATE_FLAG_COLUMN}] = 1
+                FROM {quoted_stage_name} AS source
+                INNER JOIN {quoted_full_name} AS target ON {pk_conditions}
+                WHERE source.[{DUPLICATE_FLAG_COLUMN}] = 0;
+                """
+            )
+    return statements
 
-        # Combine the source column condition and duplicate check with AND
-        full_condition = f"({combined_condition}) AND {duplicate_check}"
-
-        # Add the full condition to the list of when_conditions
-        when_conditions.append(full_condition)
-    return when_conditions
 
+def mark_duplicate_stage_rows(
+    conn, table: Table, source_filter=None, params=(), update_matched=False
+):
+    """flag the stage rows the merge skips, see build_mark_duplicates_sql
+    params fill the placeholders of source_filter.  Returns the rows flagged by a join."""
+    if not has_duplicate_flag(table):
+        return 0
 
-def merge_identity_table_data(conn, table: Table):
-    "take data from stage and insert it into destination tables returning PK values to stage"
     crsr = conn.cursor()
 
-    quoted_stage_name = table.quoted_stage_name()
-    quoted_full_name = table.quoted_full_name()
+    start = perf_counter()
+    marked_rows = 0
+    first_statement, *join_statements = build_mark_duplicates_sql(
+        table=table, source_filter=source_filter, update_matched=update_matched
+    )
+    crsr.execute(first_statement, *params)
+    for statement in join_statements:
+        crsr.execute(statement, *params)
+        marked_rows += max(crsr.rowcount, 0)
 
-    new_identity_column, source_identity_column = create_key_stage(
-        conn=conn,
-        table=table,
+    telemetry.record_span(
+        table.table_name, "mark_duplicates", perf_counter() - start, rows=marked_rows
     )
+    crsr.close()
+    return marked_rows
 
-    # build the WHEN condition based on uniques
-    if table.uniques:
-        when_conditions = build_unique_conditions(table=table)
 
-        # Combine all conditions with OR since any of them can apply
-        if when_conditions:
-            when_condition = f"WHEN NOT MATCHED AND {' AND '.join(when_conditions)}"
-        else:
-            when_condition = "WHEN NOT MATCHED"
-    else:
-        when_condition = "WHEN NOT MATCHED"
+def build_matched_assignments(target_columns, source_columns, key_columns):
+    "target = source assignments of the non key columns, see build_matched_update"
+    return [
+        f"target.[{target_col}] = source.[{source_col}]"
+        for target_col, source_col in zip(target_columns, source_columns)
+        if target_col not in key_columns
+    ]
+
+
+def build_matched_update(target_columns, source_columns, key_columns):
+    """WHEN MATCHED clause updating the non key columns of rows merged by an earlier run,
+    used by incremental runs where stage holds changed rows as well as new ones"""
+    assignments = build_matched_assignments(target_columns, source_columns, key_columns)
+    if not assignments:
+        return ""
+    return f"WHEN MATCHED THEN UPDATE SET {', '.join(assignments)}"
+
 
-    # Perform the MERGE operation with OUTPUT to the StagingTable
+def build_not_matched_filter(table: Table):
+    """the unique constraint check of the rows to insert, as a WHERE filter on the stage
+    alias source.  It reads the flags mark_duplicate_stage_rows set before the merge."""
+    if not table.uniques:
+        return "1 = 1"
+    return f"source.[{DUPLICATE_FLAG_COLUMN}] = 0"
+
+
+def build_not_matched_clause(table: Table):
+    "the WHEN NOT MATCHED clause of a MERGE, skipping stage rows flagged as duplicates"
+    if not table.uniques:
+        return "WHEN NOT MATCHED"
+    return f"WHEN NOT MATCHED AND {build_not_matched_filter(table=table)}"
+
+
+def build_identity_merge_sql(table: Table):
+    """the MERGE of an identity table with OUTPUT to its key map, with a {source}
+    placeholder, and the filter that skips stage rows the key map already has"""
+    quoted_full_name = table.quoted_full_name()
+    quoted_key_map_name = table.quoted_key_map_name(table.identity)
+
+    # Stage rows conflicting with a unique constraint were flagged before the merge
+    when_condition = build_not_matched_clause(table=table)
+
+    # Perform the MERGE operation with OUTPUT to the tables key map
     merge_query = f"""
     MERGE INTO {quoted_full_name} AS target
-    USING {quoted_stage_name} AS source
+    USING {{source}} AS source
     ON 1 = 0  -- Ensures the INSERT part of the MERGE is executed for all rows
     {when_condition} THEN
         INSERT ({', '.join(table.column_list_without_identity)})
         VALUES ({', '.join('source.' + col for col in table.column_list_new_keys_without_identity)})
-    OUTPUT inserted.{table.identity} AS [{new_identity_column}],
-        source.{table.identity} AS [{source_identity_column}]
-    INTO [{table.stage_schema}].[KeyStage];
+    OUTPUT inserted.{table.identity}, source.{table.identity}
+    INTO {quoted_key_map_name} ([new_id], [old_id]);
     """
-    crsr.execute(merge_query)
 
-    # Retrieve data from the StagingTable
-    select_staging_data_sql = f"""
-        SELECT [{new_identity_column}], [{source_identity_column}]
-        FROM [{table.stage_schema}].[KeyStage]
-    """
-    crsr.execute(select_staging_data_sql)
+    # Rows already in the key map were merged by an earlier batch or run, skipping
+    # them keeps a repeated merge from inserting twice
+    unmerged_filter = f"""
+        NOT EXISTS (
+            SELECT 1 FROM {quoted_key_map_name} km
+            WHERE km.[old_id] = stage.{table.identity}
+        )"""
 
-    # Fetch the results into Python variables
-    key_arrays = {
-        "column_name": table.identity,
-        "inserted_identity_values": [],
-        "source_identity_values": [],
-    }
+    return merge_query, unmerged_filter
 
-    for row in crsr:
-        key_arrays["inserted_identity_values"].append(row[0])
-        key_arrays["source_identity_values"].append(row[1])
 
-    update_new_pk_in_stage(
-        conn=conn,
-        table=table,
-        key_arrays=key_arrays,
+def get_identity_merge_sql(table: Table, merge_engine="merge"):
+    """the identity merge query and unmerged filter of the merge engine, see MERGE_ENGINES
+    Both engines run the MERGE.  Only the OUTPUT of a MERGE can return a source column
+    next to the inserted identity; the OUTPUT rows of INSERT ... SELECT are not guaranteed
+    to come back in insert order, so its new ids could not be paired with their old ids."""
+    if merge_engine not in MERGE_ENGINES:
+        raise ValueError(f"Unknown merge engine: {merge_engine}")
+    return build_identity_merge_sql(table=table)
+
+
+def build_skipped_rows_key_map_sql(table: Table):
+    """Identify any stage rows the MERGE skipped and assume these are duplicates
+    from a UNIQUE constraint so map the New_ PK to the original PK
+    Tables with unique constraints map the rows mark_duplicate_stage_rows flagged."""
+    quoted_stage_name = table.quoted_stage_name()
+    quoted_key_map_name = table.quoted_key_map_name(table.identity)
+
+    # With unique constraints the rows skipped are the ones flagged before the merge
+    duplicate_filter = ""
+    if table.uniques:
+        duplicate_filter = f"stage.[{DUPLICATE_FLAG_COLUMN}] = 1 AND "
+
+    return f"""
+    INSERT INTO {quoted_key_map_name} ([old_id], [new_id])
+    SELECT stage.{table.identity}, stage.{table.identity}
+    FROM {quoted_stage_name} stage
+    WHERE {duplicate_filter}NOT EXISTS (
+        SELECT 1 FROM {quoted_key_map_name} km WHERE km.[old_id] = stage.{table.identity}
+    );
+    """
+
+
+def build_update_mapped_rows_sql(table: Table):
+    """UPDATE of destination rows whose stage row is already in the key map, i.e. rows an
+    earlier run inserted that changed in the source since"""
+    assignments = ", ".join(
+        f"target.[{target_col}] = stage.[{source_col}]"
+        for target_col, source_col in zip(
+            table.column_list_without_identity,
+            table.column_list_new_keys_without_identity,
+        )
     )
 
-    # Identify any remaining null PKs that didnt get updated above
-    # and assume these are duplicates from a UNIQUE constraint so set the New_
-    # PK equal to the original PK
-    # TODO: There's probably a better way to do this, might fix later
-    unique_null_pks_sql = f"""
-    UPDATE {quoted_stage_name}
-    SET New_{table.identity} = {table.identity}
-    WHERE New_{table.identity} IS NULL
+    return f"""
+    UPDATE target
+    SET {assignments}
+    FROM {table.quoted_full_name()} target
+    INNER JOIN {table.quoted_key_map_name(table.identity)} km
+    ON target.[{table.identity}] = km.[new_id]
+    INNER JOIN {table.quoted_stage_name()} stage
+    ON stage.[{table.identity}] = km.[old_id];
     """
-    crsr.execute(unique_null_pks_sql)
 
+
+def update_mapped_identity_rows(conn, table: Table):
+    "update the destination rows of stage rows merged by an earlier run, returns the row count"
+    crsr = conn.cursor()
+
+    create_key_map(conn=conn, table=table, recreate=False)
+    crsr.execute(build_update_mapped_rows_sql(table=table))
+    updated_rows = crsr.rowcount
+
+    print(f"Updated {updated_rows} changed rows of {table.quoted_full_name()}")
     crsr.close()
+    return updated_rows
 
 
-def merge_composite_table_data(conn, table: Table):
-    "take composite pk data from stage and insert it into destination table"
-    print(f"Merging composite table: {table.table_name}")
+def merge_identity_table_data(
+    conn,
+    table: Table,
+    backfill_batch_size=None,
+    merge_batch_size=None,
+    merge_throttle_seconds=0,
+    merge_engine="merge",
+):
+    """take data from stage and insert it into destination tables returning PK values to stage
+    With merge_batch_size the stage table is merged in identity key ranges of that size,
+    each committed on its own, sleeping merge_throttle_seconds between batches.
+    Rows already in the key map are never merged again, so a merge interrupted part
+    way can simply be run again.  Both merge engines run the MERGE, see get_identity_merge_sql.
+    Stage rows conflicting with a unique constraint are flagged before each merge."""
     crsr = conn.cursor()
 
     quoted_stage_name = table.quoted_stage_name()
-    quoted_full_name = table.quoted_full_name()
 
+    # The key map is reset when the stage table is built, keep what is in it
+    create_key_map(conn=conn, table=table, recreate=False)
+
+    merge_query, unmerged_filter = get_identity_merge_sql(
+        table=table, merge_engine=merge_engine
+    )
+
+    def run_merge(query, *params, source_filter=unmerged_filter):
+        # The merge skips rows already in the key map, running it again is safe
+        mark_duplicate_stage_rows(
+            conn=conn, table=table, source_filter=source_filter, params=params
+        )
+        return run_merge_query(crsr, query, merge_engine, params)
+
+    merged_rows = 0
+    if not merge_batch_size:
+        merged_rows = retry_transient(
+            lambda: run_merge(
+                merge_query.format(
+                    source=f"(SELECT * FROM {quoted_stage_name} stage WHERE {unmerged_filter})"
+                )
+            ),
+            f"the merge of {quoted_stage_name}",
+        )
+    else:
+        batch_filter = f"""stage.{table.identity} >= ? AND stage.{table.identity} < ?
+            AND {unmerged_filter}"""
+        batch_query = merge_query.format(
+            source=f"(SELECT * FROM {quoted_stage_name} stage WHERE {batch_filter})"
+        )
+
+        crsr.execute(
+            f"SELECT MIN({table.identity}), MAX({table.identity}) FROM {quoted_stage_name}"
+        )
+        min_key, max_key = crsr.fetchone()
+
+        batch_count = 0
+        range_start = min_key
+        while range_start is not None and range_start <= max_key:
+            range_end = range_start + merge_batch_size
+            merged_rows += retry_transient(
+                lambda: run_merge(
+                    batch_query, range_start, range_end, source_filter=batch_filter
+                ),
+                f"merge batch {range_start} of {quoted_stage_name}",
+            )
+            batch_count += 1
+            range_start = range_end
+
+            # Give a live destination room between batches
+            if merge_throttle_seconds and range_start <= max_key:
+                sleep(merge_throttle_seconds)
+
+        print(f"Merged {quoted_stage_name} in {batch_count} batches of {merge_batch_size} keys")
+
+    crsr.execute(build_skipped_rows_key_map_sql(table=table))
+
+    # Write the new identity values back to stage on the server
+    with telemetry.span(table.table_name, "key_backfill"):
+        update_new_pk_in_stage(
+            conn=conn,
+            table=table,
+            batch_size=backfill_batch_size,
+        )
+
+    crsr.close()
+    return merged_rows
+
+
+def build_pk_conditions(table: Table, new_keys=False):
+    """Match of stage (source) rows to destination (target) rows on the PK, and the PK
+    columns.  new_keys matches on the New_ columns, as composite PKs made of FKs do."""
     # Construct the list of PK columns in the format:
     # "source.New_column1 = target.column1 AND source.New_column2 = target.column2"
     pk_conditions = []
@@ -170,73 +531,168 @@ def merge_composite_table_data(conn, table: Table):
     for pk_col in table.pk_column_list:
         col_name = pk_col["PrimaryKeyName"]
         if col_name in table.column_list:
-            pk_conditions.append(f"source.New_{col_name} = target.{col_name}")
+            source_col = f"New_{col_name}" if new_keys else col_name
+            pk_conditions.append(f"source.{source_col} = target.{col_name}")
             values_columns.append(col_name)
 
-    pk_conditions = " AND ".join(pk_conditions)
+    return " AND ".join(pk_conditions), values_columns
+
+
+def build_counted_batch(query):
+    """Wrap statements in one transaction that returns the row count of the last
+    statement as a result set.  A failure rolls every statement back, as it would a
+    single MERGE.  NOCOUNT and XACT_ABORT are turned back off either way, since the
+    connection goes back to the pool or is retried on."""
+    return f"""
+    SET NOCOUNT ON;
+    SET XACT_ABORT ON;
+    DECLARE @counted_rows BIGINT;
+
+    BEGIN TRY
+        BEGIN TRANSACTION;
+        {query}
+        SET @counted_rows = @@ROWCOUNT;
+        COMMIT TRANSACTION;
+    END TRY
+    BEGIN CATCH
+        IF @@TRANCOUNT > 0 ROLLBACK TRANSACTION;
+        SET XACT_ABORT OFF;
+        SET NOCOUNT OFF;
+        THROW;
+    END CATCH;
+
+    SET XACT_ABORT OFF;
+    SET NOCOUNT OFF;
+    SELECT @counted_rows AS counted_rows;
+    """
 
-    # build the WHEN condition based on uniques
-    if table.uniques:
-        when_conditions = build_unique_conditions(table=table)
 
-        # Combine all conditions with OR since any of them can apply
-        if when_conditions:
-            when_condition = f"WHEN NOT MATCHED AND {' AND '.join(when_conditions)}"
-        else:
-            when_condition = "WHEN NOT MATCHED"
-    else:
-        when_condition = "WHEN NOT MATCHED"
+def run_merge_query(crsr, merge_query, merge_engine="merge", params=()):
+    "run a merge query of the merge engine and return its row count"
+    if merge_engine == "insert":
+        crsr.execute(build_counted_batch(merge_query), *params)
+        return crsr.fetchone()[0]
+    crsr.execute(merge_query, *params)
+    return crsr.rowcount
+
+
+def build_anti_join_insert_sql(table: Table, pk_conditions, source_columns, assignments):
+    """INSERT ... SELECT of the stage rows not yet in the destination, checked on the PK
+    and the unique constraints, after an UPDATE of the matched rows when there are
+    assignments.  The INSERT is last, so its row count ends the batch."""
+    quoted_stage_name = table.quoted_stage_name()
+    quoted_full_name = table.quoted_full_name()
+
+    # A table known only by its uniques has no PK to match, its unique checks decide
+    pk_match = pk_conditions or "1 = 0"
+
+    update_query = ""
+    if assignments:
+        update_query = f"""
+        UPDATE target
+        SET {', '.join(assignments)}
+        FROM {quoted_full_name} AS target
+        INNER JOIN {quoted_stage_name} AS source ON {pk_match};
+        """
+
+    return f"""
+    {update_query}
+    INSERT INTO {quoted_full_name} ({', '.join(table.column_list)})
+    SELECT {', '.join(f"source.{col}" for col in source_columns)}
+    FROM {quoted_stage_name} AS source
+    WHERE NOT EXISTS (SELECT 1 FROM {quoted_full_name} AS target WHERE {pk_match})
+    AND {build_not_matched_filter(table=table)};
+    """
+
+
+def build_composite_merge_sql(table: Table, update_matched=False):
+    "the MERGE of a composite pk table, see merge_composite_table_data"
+    quoted_stage_name = table.quoted_stage_name()
+    quoted_full_name = table.quoted_full_name()
+
+    pk_conditions, values_columns = build_pk_conditions(table=table, new_keys=True)
+
+    # Stage rows conflicting with a unique constraint were flagged before the merge
+    when_condition = build_not_matched_clause(table=table)
 
     # Construct the VALUES part
-    values_part = ", ".join(
-        f"source.New_{col}" if col in values_columns else f"source.{col}"
-        for col in table.column_list
-    )
+    source_columns = [
+        f"New_{col}" if col in values_columns else col for col in table.column_list
+    ]
+    values_part = ", ".join(f"source.{col}" for col in source_columns)
+
+    matched_update = ""
+    if update_matched:
+        matched_update = build_matched_update(
+            table.column_list, source_columns, values_columns
+        )
 
     merge_query = f"""
     MERGE INTO {quoted_full_name} AS target
     USING {quoted_stage_name} AS source
     ON {pk_conditions}
+    {matched_update}
     {when_condition} THEN
         INSERT ({', '.join(table.column_list)})
         VALUES ({values_part});
     """
-    crsr.execute(merge_query)
+    return merge_query
+
+
+def build_composite_insert_sql(table: Table, update_matched=False):
+    "the insert engine version of build_composite_merge_sql, see build_anti_join_insert_sql"
+    pk_conditions, values_columns = build_pk_conditions(table=table, new_keys=True)
+    source_columns = [
+        f"New_{col}" if col in values_columns else col for col in table.column_list
+    ]
+    assignments = []
+    if update_matched:
+        assignments = build_matched_assignments(
+            table.column_list, source_columns, values_columns
+        )
+    return build_anti_join_insert_sql(
+        table=table,
+        pk_conditions=pk_conditions,
+        source_columns=source_columns,
+        assignments=assignments,
+    )
 
-    crsr.close()
 
+def get_composite_merge_sql(table: Table, update_matched=False, merge_engine="merge"):
+    "the composite table merge query of the merge engine, see MERGE_ENGINES and run_merge_query"
+    if merge_engine not in MERGE_ENGINES:
+        raise ValueError(f"Unknown merge engine: {merge_engine}")
+    if merge_engine == "insert":
+        return build_composite_insert_sql(table=table, update_matched=update_matched)
+    return build_composite_merge_sql(table=table, update_matched=update_matched)
 
-def merge_unique_table_data(conn, table: Table):
-    "Merge unique PK table data from stage into destination table"
-    print(f"Merging unique table: {table.table_name}")
+
+def merge_composite_table_data(conn, table: Table, update_matched=False, merge_engine="merge"):
+    """take composite pk data from stage and insert it into destination table
+    With update_matched rows already in the destination are updated from stage.
+    The insert engine reports the inserted rows only."""
+    print(f"Merging composite table: {table.table_name}")
     crsr = conn.cursor()
 
-    quoted_stage_name = table.quoted_stage_name()
-    quoted_full_name = table.quoted_full_name()
+    merge_query = get_composite_merge_sql(
+        table=table, update_matched=update_matched, merge_engine=merge_engine
+    )
+    mark_duplicate_stage_rows(conn=conn, table=table, update_matched=update_matched)
+    merged_rows = run_merge_query(crsr, merge_query, merge_engine)
 
-    # Construct the list of PK columns in the format:
-    # "source.column1 = target.column1 AND source.column2 = target.column2"
-    pk_conditions = []
-    values_columns = []
-    for pk_col in table.pk_column_list:
-        col_name = pk_col["PrimaryKeyName"]
-        if col_name in table.column_list:
-            pk_conditions.append(f"source.{col_name} = target.{col_name}")
-            values_columns.append(col_name)
+    crsr.close()
+    return merged_rows
 
-    pk_conditions = " AND ".join(pk_conditions)
 
-    # build the WHEN condition based on uniques
-    if table.uniques:
-        when_conditions = build_unique_conditions(table=table)
+def build_unique_merge_sql(table: Table, update_matched=False):
+    "the MERGE of a unique PK table, see merge_unique_table_data"
+    quoted_stage_name = table.quoted_stage_name()
+    quoted_full_name = table.quoted_full_name()
 
-        # Combine all conditions with OR since any of them can apply
-        if when_conditions:
-            when_condition = f"WHEN NOT MATCHED AND {' AND '.join(when_conditions)}"
-        else:
-            when_condition = "WHEN NOT MATCHED"
-    else:
-        when_condition = "WHEN NOT MATCHED"
+    pk_conditions, values_columns = build_pk_conditions(table=table)
+
+    # Stage rows conflicting with a unique constraint were flagged before the merge
+    when_condition = build_not_matched_clause(table=table)
 
     # Construct the VALUES part
     values_part = ", ".join(
@@ -244,17 +700,78 @@ def merge_unique_table_data(conn, table: Table):
         for col in table.column_list_with_new_keys
     )
 
+    matched_update = ""
+    if update_matched:
+        matched_update = build_matched_update(
+            table.column_list, table.column_list_with_new_keys, values_columns
+        )
+
     merge_query = f"""
     MERGE INTO {quoted_full_name} AS target
     USING {quoted_stage_name} AS source
     ON {pk_conditions}
+    {matched_update}
     {when_condition} THEN
         INSERT ({', '.join(table.column_list)})
         VALUES ({values_part});
     """
-    crsr.execute(merge_query)
+    return merge_query
+
+
+def build_unique_insert_sql(table: Table, update_matched=False):
+    "the insert engine version of build_unique_merge_sql, see build_anti_join_insert_sql"
+    pk_conditions, values_columns = build_pk_conditions(table=table)
+    assignments = []
+    if update_matched:
+        assignments = build_matched_assignments(
+            table.column_list, table.column_list_with_new_keys, values_columns
+        )
+    return build_anti_join_insert_sql(
+        table=table,
+        pk_conditions=pk_conditions,
+        source_columns=table.column_list_with_new_keys,
+        assignments=assignments,
+    )
+
+
+def get_unique_merge_sql(table: Table, update_matched=False, merge_engine="merge"):
+    "the unique table merge query of the merge engine, see MERGE_ENGINES and run_merge_query"
+    if merge_engine not in MERGE_ENGINES:
+        raise ValueError(f"Unknown merge engine: {merge_engine}")
+    if merge_engine == "insert":
+        return build_unique_insert_sql(table=table, update_matched=update_matched)
+    return build_unique_merge_sql(table=table, update_matched=update_matched)
+
+
+def merge_unique_table_data(conn, table: Table, update_matched=False, merge_engine="merge"):
+    """Merge unique PK table data from stage into destination table
+    With update_matched rows already in the destination are updated from stage.
+    The insert engine reports the inserted rows only."""
+    print(f"Merging unique table: {table.table_name}")
+    crsr = conn.cursor()
+
+    merge_query = get_unique_merge_sql(
+        table=table, update_matched=update_matched, merge_engine=merge_engine
+    )
+    mark_duplicate_stage_rows(conn=conn, table=table, update_matched=update_matched)
+    merged_rows = run_merge_query(crsr, merge_query, merge_engine)
 
     crsr.close()
+    return merged_rows
+
+
+def build_heap_insert_sql(table: Table):
+    "the INSERT of a heap table, None when the heap has uniques, see merge_heap_table_data"
+    # The only way to merge heap data is if there's a unique constraint
+    if table.uniques:
+        return None
+
+    # If there are no uniques, then just straight insert all rows
+    return f"""
+    INSERT INTO {table.quoted_full_name()} ({', '.join(table.column_list)})
+    SELECT {', '.join(table.column_list_with_new_keys)}
+    FROM {table.quoted_stage_name()};
+    """
 
 
 def merge_heap_table_data(conn, table: Table):
@@ -262,30 +779,21 @@ def merge_heap_table_data(conn, table: Table):
     print(f"Merging heap table: {table.table_name}")
     crsr = conn.cursor()
 
-    quoted_stage_name = table.quoted_stage_name()
-    quoted_full_name = table.quoted_full_name()
+    merged_rows = 0
 
-    # The only way to merge heap data is if there's a unique constraint
-    if table.uniques:
+    insert_heap_query = build_heap_insert_sql(table=table)
+    if insert_heap_query is None:
         print("This heap has uniques")
-
-    # If there are no uniques, then just straight insert all rows
     else:
-        insert_heap_query = f"""
-        INSERT INTO {quoted_full_name} ({', '.join(table.column_list)})
-        SELECT {', '.join(table.column_list_with_new_keys)}
-        FROM {quoted_stage_name};
-        """
         crsr.execute(insert_heap_query)
+        merged_rows = crsr.rowcount
 
     crsr.close()
+    return merged_rows
 
 
-def insert_temporal_history_table_data(conn, table: Table, combined_keys):
-    "Insert data from stage for a temporal history table data into destination table"
-    print(f"Inserting data for temporal history table table: [{table.table_name}]")
-    crsr = conn.cursor()
-
+def build_temporal_history_insert_sql(table: Table, combined_keys):
+    "the INSERT of a temporal history table, see insert_temporal_history_table_data"
     quoted_stage_name = table.quoted_stage_name()
     quoted_full_name = table.quoted_full_name()
 
@@ -314,8 +822,19 @@ def insert_temporal_history_table_data(conn, table: Table, combined_keys):
     SELECT {modified_columns}
     FROM {quoted_stage_name};
     """
+    return insert_query
+
+
+def insert_temporal_history_table_data(conn, table: Table, combined_keys):
+    "Insert data from stage for a temporal history table data into destination table"
+    print(f"Inserting data for temporal history table table: [{table.table_name}]")
+    crsr = conn.cursor()
 
     # Execute the insert query
-    crsr.execute(insert_query)
+    crsr.execute(
+        build_temporal_history_insert_sql(table=table, combined_keys=combined_keys)
+    )
+    merged_rows = crsr.rowcount
 
     crsr.close()
+    return merged_rows
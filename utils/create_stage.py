@@ -1,6 +1,18 @@
-from utils.table_details import get_column_data_type
 from utils.Table import Table
 
+# Set on stage rows that conflict with a unique constraint of the destination, so the
+# merge skips them, see mark_duplicate_stage_rows
+DUPLICATE_FLAG_COLUMN = "Stage_Duplicate"
+
+
+def has_duplicate_flag(table: Table):
+    """whether the tables stage rows carry the DUPLICATE_FLAG_COLUMN: tables with unique
+    constraints, and tables with an FK deferred to split an FK cycle, whose deferred FK
+    update must leave the rows the merge skipped alone"""
+    return bool(table.uniques) or any(
+        fk.get("deferred") for fk in table.fk_column_list or []
+    )
+
 
 def create_stage_schema(conn):
     "create stage schema if it doesnt exist"
@@ -15,16 +27,56 @@ def create_stage_schema(conn):
     crsr.close()
 
 
-def create_stage_table(conn, table: Table, recreate=False):
-    "create table in STAGE schema from it's dbo equivalant"
+def get_stage_new_columns(table: Table, combined_keys=None):
+    """Work out every New_ column the stage table needs up front, so they can be
+    created in a single statement.  Returns an ordered dict of New_ column -> data type
+    for the PK columns, FK columns, an identity outside the PK, and for a temporal
+    history table the keys of its master table.  Tables with unique constraints or a
+    deferred FK also get the DUPLICATE_FLAG_COLUMN, see has_duplicate_flag."""
+    new_column_prefix = "New_"  # Prefix for the new columns
+    key_columns = {}
+
+    if table.pk_column_list:
+        for pk in table.pk_column_list:
+            key_columns[pk["PrimaryKeyName"]] = table.column_types[pk["PrimaryKeyName"]]
+
+    for fk in table.fk_column_list or []:
+        key_columns[fk["parent_column"]] = table.column_types[fk["parent_column"]]
+
+    # Handle rare scenario where the identity column is not part of the PK
+    if table.identity:
+        key_columns[table.identity] = table.column_types[table.identity]
+
+    # Temporal history keys take the data type of the key on the master table
+    for key in combined_keys or []:
+        key_columns[key["parent_column"]] = key["data_type"]
+
+    new_columns = {
+        f"{new_column_prefix}{column_name}": data_type
+        for column_name, data_type in key_columns.items()
+    }
+    if has_duplicate_flag(table):
+        new_columns[DUPLICATE_FLAG_COLUMN] = "BIT"
+    return new_columns
+
+
+def create_stage_table(conn, table: Table, recreate=False, new_columns=None):
+    """create table in STAGE schema from it's dbo equivalant
+    new_columns (New_ column -> data type) are created as part of the SELECT INTO,
+    so the stage table never needs an ALTER per key column"""
     crsr = conn.cursor()
 
     quoted_stage_name = table.quoted_stage_name()
     quoted_full_name = table.quoted_full_name()
     table_name = table.table_name
+    new_columns = new_columns or {}
 
+    new_column_select = "".join(
+        f", CAST(NULL AS {data_type}) AS [{column_name}]"
+        for column_name, data_type in new_columns.items()
+    )
     create_table_query = (
-        f"SELECT TOP 0 * INTO {quoted_stage_name} FROM {quoted_full_name}"
+        f"SELECT TOP 0 *{new_column_select} INTO {quoted_stage_name} FROM {quoted_full_name}"
     )
 
     # Check if the table exists
@@ -47,221 +99,79 @@ def create_stage_table(conn, table: Table, recreate=False):
             print(
                 f"Table {quoted_stage_name} already exists and recreate is False, skipping table creation."
             )
+            add_stage_new_columns(conn=conn, table=table, new_columns=new_columns)
 
     crsr.close()
 
 
-def create_stage_table_pk(conn, table: Table):
-    "create the same PK on the stage table"
-    crsr = conn.cursor()
-
-    quoted_stage_name = table.quoted_stage_name()
-    table_name = table.table_name
-
-    pk_columns = ", ".join(item["PrimaryKeyName"] for item in table.pk_column_list)
-    create_pk_query = f"""
-    ALTER TABLE {quoted_stage_name} ADD CONSTRAINT PK_STAGE_{table_name}
-    PRIMARY KEY ({pk_columns})
-    """
-
-    crsr.execute(create_pk_query)
-    crsr.close()
-
+def add_stage_new_columns(conn, table: Table, new_columns):
+    "add any missing New_ (or duplicate flag) columns to an existing stage table in a single ALTER"
+    if not new_columns:
+        return
 
-def create_stage_table_newpk(conn, table: Table):
-    "create new column on stage table of the pk column"
     crsr = conn.cursor()
 
-    quoted_full_name = table.quoted_full_name()
     quoted_stage_name = table.quoted_stage_name()
 
-    # Retrieve primary key column information from sys schema
-    query = f"""
-    SELECT c.name AS ColumnName,
-        CASE
-            WHEN ty.name IN ('varchar', 'char', 'nvarchar', 'nchar')
-            THEN ty.name + '(' + CAST(c.max_length AS VARCHAR) + ')'
-            ELSE ty.name
-        END AS DataType
-    FROM sys.columns c
-    INNER JOIN sys.tables t ON c.object_id = t.object_id
-    INNER JOIN sys.schemas s ON t.schema_id = s.schema_id
-    INNER JOIN sys.types ty ON c.system_type_id = ty.system_type_id AND c.user_type_id = ty.user_type_id
-    INNER JOIN sys.index_columns ic ON c.object_id = ic.object_id AND c.column_id = ic.column_id
-    WHERE s.name = '{table.stage_schema}'
-        AND t.name = '{table.table_name}'
-        AND ic.index_id = 1  -- Assuming the primary key index is always 1
-    """
-    crsr.execute(query)
-    pk_info = crsr.fetchall()
-
-    new_column_prefix = "New_"  # Prefix for the new columns
-
-    if pk_info:
-        for info in pk_info:
-            new_column_name = f"{new_column_prefix}{info.ColumnName}"
-            data_type = info.DataType
-
-            # Construct and execute the ALTER TABLE query for each new column
-            alter_query = f"""
-                ALTER TABLE {quoted_stage_name}
-                ADD [{new_column_name}] {data_type} NULL
-            """
-            crsr.execute(alter_query)
-            print(
-                f"New column '{new_column_name}' added to '{quoted_full_name}' with data type '{data_type}'."
-            )
-
-        crsr.commit()
-
-    crsr.close()
-
-
-def create_stage_table_identity(conn, table: Table):
-    "create new column on stage table of the identity column"
-    crsr = conn.cursor()
-
-    quoted_stage_name = table.quoted_stage_name()
-
-    # Retrieve identity column information from sys schema
-    data_type = get_column_data_type(
-            conn=conn,
-            table=table,
-            column_name=table.identity,
-        )
-
-    new_column_prefix = "New_"  # Prefix for the new columns
-    new_column_name = f"{new_column_prefix}{table.identity}"
-
-    # Check if the new column already exists
-    check_query = f"""
-        SELECT COUNT(*)
+    existing_query = f"""
+        SELECT c.name
         FROM sys.columns c
-        INNER JOIN sys.tables t ON c.object_id = t.object_id
-        INNER JOIN sys.schemas s ON t.schema_id = s.schema_id
-        WHERE s.name = '{table.stage_schema}'
-            AND t.name = '{table.table_name}'
-            AND c.name = '{new_column_name}'
+        WHERE c.object_id = OBJECT_ID('{table.stage_schema}.{table.table_name}', 'U')
     """
-    crsr.execute(check_query)
-    column_exists = crsr.fetchone()[0]
+    crsr.execute(existing_query)
+    existing_columns = {row[0] for row in crsr.fetchall()}
 
-    if not column_exists:
-        # Construct and execute the ALTER TABLE query for each new column
+    missing_columns = [
+        f"[{column_name}] {data_type} NULL"
+        for column_name, data_type in new_columns.items()
+        if column_name not in existing_columns
+    ]
+
+    if missing_columns:
         alter_query = f"""
             ALTER TABLE {quoted_stage_name}
-            ADD [{new_column_name}] {data_type} NULL
+            ADD {', '.join(missing_columns)}
         """
         crsr.execute(alter_query)
-        print(
-            f"New column '{new_column_name}' added to '{quoted_stage_name}', data type '{data_type}'."
-        )
-
+        print(f"Added {len(missing_columns)} columns to '{quoted_stage_name}'.")
 
-def create_stage_table_fks(conn, table: Table):
-    "create new columns on stage table for the fk columns"
-    crsr = conn.cursor()
+    crsr.close()
 
-    quoted_stage_name = table.quoted_stage_name()
 
-    new_column_prefix = "New_"  # Prefix for the new columns
+def truncate_stage_table(conn, table: Table):
+    "empty a stage table before it is loaded again"
+    crsr = conn.cursor()
 
-    for fk in table.fk_column_list:
-        column_name = fk["parent_column"]
-
-        # Get the data type of the foreign key column
-        data_type = get_column_data_type(
-            conn=conn,
-            table=table,
-            column_name=column_name,
-        )
-
-        new_column_name = f"{new_column_prefix}{column_name}"
-
-        # Check if the new column already exists
-        check_query = f"""
-            SELECT COUNT(*)
-            FROM sys.columns c
-            INNER JOIN sys.tables t ON c.object_id = t.object_id
-            INNER JOIN sys.schemas s ON t.schema_id = s.schema_id
-            WHERE s.name = '{table.stage_schema}'
-                AND t.name = '{table.table_name}'
-                AND c.name = '{new_column_name}'
-        """
-        crsr.execute(check_query)
-        column_exists = crsr.fetchone()[0]
-
-        if not column_exists:
-            # Construct and execute the ALTER TABLE query for each new column
-            alter_query = f"""
-                ALTER TABLE {quoted_stage_name}
-                ADD [{new_column_name}] {data_type} NULL
-            """
-            crsr.execute(alter_query)
-            print(
-                f"New column '{new_column_name}' added to '{quoted_stage_name}', data type '{data_type}'."
-            )
-        else:
-            print(
-                f"Column '{new_column_name}' already exists in table '{quoted_stage_name}'."
-            )
+    print(f"Truncating Table: {table.quoted_stage_name()}")
+    crsr.execute(f"TRUNCATE TABLE {table.quoted_stage_name()}")
 
     crsr.close()
 
 
-def create_stage_temporal_history_keys(
-    conn, table: Table, temporal_info, combined_keys
-):
-    "create new columns on stage table for a temporal history table based on it's masters pk and fks"
+def create_stage_table_pk(conn, table: Table):
+    "create the same PK on the stage table"
     crsr = conn.cursor()
 
-    new_column_prefix = "New_"  # Prefix for the new columns
-
-    temporal_master_schema = temporal_info["master_schema"]
-    temporal_master_table = temporal_info["master_table"]
-
-    master_table = Table(
-        schema_name=temporal_master_schema,
-        stage_schema=table.stage_schema,
-        table_name=temporal_master_table,
-    )
+    quoted_stage_name = table.quoted_stage_name()
+    table_name = table.table_name
 
-    for key in combined_keys:
-        column_name = key["parent_column"]
+    pk_columns = ", ".join(item["PrimaryKeyName"] for item in table.pk_column_list)
+    create_pk_query = f"""
+    ALTER TABLE {quoted_stage_name} ADD CONSTRAINT PK_STAGE_{table_name}
+    PRIMARY KEY ({pk_columns})
+    """
 
-        # Check if the column already exists in the table
-        check_column_query = f"""
-            SELECT COUNT(*)
-            FROM INFORMATION_SCHEMA.COLUMNS
-            WHERE TABLE_SCHEMA = '{table.stage_schema}'
-                AND TABLE_NAME = '{table.table_name}'
-                AND COLUMN_NAME = '{new_column_prefix}{column_name}'
-        """
-        crsr.execute(check_column_query)
-        column_exists = crsr.fetchone()[0]
-
-        if not column_exists:
-            # Get the data type of the key from the master table
-            data_type = get_column_data_type(
-                conn=conn,
-                table=master_table,
-                column_name=column_name,
-            )
+    crsr.execute(create_pk_query)
+    crsr.close()
 
-            new_column_name = f"{new_column_prefix}{column_name}"
 
-            full_name = table.quoted_stage_name()
+def drop_stage_table_pk(conn, table: Table):
+    "drop the stage PK, if there is one, so the stage table is loaded as a bare heap"
+    crsr = conn.cursor()
 
-            # Construct and execute the ALTER TABLE query for each new column
-            alter_query = f"""
-                ALTER TABLE {full_name}
-                ADD [{new_column_name}] {data_type} NULL
-            """
-            crsr.execute(alter_query)
-            print(
-                f"New column '{new_column_name}' added to '{full_name}', data type '{data_type}'."
-            )
-        else:
-            print(f"Column '{new_column_prefix}{column_name}' already exists in '{table.quoted_stage_name()}'.")
+    drop_pk_query = f"""
+    ALTER TABLE {table.quoted_stage_name()} DROP CONSTRAINT IF EXISTS PK_STAGE_{table.table_name}
+    """
 
+    crsr.execute(drop_pk_query)
     crsr.close()
@@ -20,4 +20,8 @@ def get_conn_string(config, type):
         f"Encrypt={encrypt};"
         "MARS_Connection=yes;"  # this is needed to handle Multiple Active Result Sets
     )
+    # Larger TDS packets cut round trips on bulk copies, the server default is 4096
+    packet_size = config[f"{type}"].get("packet_size")
+    if packet_size:
+        conn += f"PacketSize={packet_size};"
     return conn
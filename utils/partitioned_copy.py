@@ -0,0 +1,164 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from utils.Table import Table
+from utils.connections import ConnectionPool
+from utils.copy_data import (
+    DEFAULT_CHUNK_SIZE,
+    DEFAULT_PREFETCH_CHUNKS,
+    copy_src_table_to_stage,
+)
+
+# Key ranges planned per connection pair, so a pair that finishes early takes more work
+RANGES_PER_CONNECTION = 4
+# Tables with fewer rows in their statistics are copied on a single connection
+DEFAULT_PARTITION_MIN_ROWS = 1000000
+
+
+def get_key_histogram(src_conn, table: Table, column_name):
+    """The statistics histogram of the tables clustered index on the source, as
+    (range_high_key, rows) steps in key order.  Empty when there are no statistics."""
+    crsr = src_conn.cursor()
+
+    data_type = (table.column_types or {}).get(column_name, "sql_variant")
+
+    # The clustered index is index 1, and its statistics share the id
+    histogram_query = f"""
+    SELECT CAST(h.range_high_key AS {data_type}) AS range_high_key,
+        h.range_rows + h.equal_rows AS step_rows
+    FROM sys.dm_db_stats_histogram(OBJECT_ID('{table.schema_name}.{table.table_name}'), 1) AS h
+    ORDER BY h.step_number;
+    """
+    crsr.execute(histogram_query)
+    histogram = [(row[0], row[1]) for row in crsr.fetchall()]
+
+    crsr.close()
+    return histogram
+
+
+def plan_key_ranges(histogram, ranges):
+    """Pick up to ranges - 1 boundary keys from a histogram so each range holds about
+    the same number of rows.  The keys stay in the servers collation order."""
+    total_rows = sum(rows for _, rows in histogram)
+    if ranges < 2 or total_rows == 0:
+        return []
+
+    rows_per_range = total_rows / ranges
+    bounds = []
+    cumulative_rows = 0
+    # The last step is the top of the key space, a boundary there would leave an empty range
+    for high_key, rows in histogram[:-1]:
+        cumulative_rows += rows
+        if len(bounds) == ranges - 1:
+            break
+        if cumulative_rows >= rows_per_range * (len(bounds) + 1):
+            if not bounds or bounds[-1] != high_key:
+                bounds.append(high_key)
+
+    return bounds
+
+
+def build_key_range_filters(column_name, bounds):
+    """WHERE clauses, each with its parameters, that together cover the whole key space.
+    NULL keys go to the first range."""
+    col = f"[{column_name}]"
+    if not bounds:
+        return [(None, ())]
+
+    filters = [(f"({col} < ? OR {col} IS NULL)", (bounds[0],))]
+    for low, high in zip(bounds, bounds[1:]):
+        filters.append((f"{col} >= ? AND {col} < ?", (low, high)))
+    filters.append((f"{col} >= ?", (bounds[-1],)))
+
+    return filters
+
+
+def plan_copy_ranges(src_conn, table: Table, connections, min_rows=0):
+    """Key range filters splitting the tables copy over connections pairs, or None when
+    the table should be copied on one connection: it has no clustered key, no
+    statistics, or fewer rows than min_rows."""
+    if connections < 2 or not table.clustered:
+        return None
+
+    leading_column = table.clustered[0]
+    try:
+        histogram = get_key_histogram(
+            src_conn=src_conn, table=table, column_name=leading_column
+        )
+    except Exception as e:
+        # sys.dm_db_stats_histogram needs SQL Server 2016 SP1 CU2 or later
+        print(f"Could not read statistics of {table.quoted_full_name()}, copying it on one connection: {e}")
+        return None
+
+    total_rows = sum(rows for _, rows in histogram)
+    if total_rows < max(min_rows, 1):
+        return None
+
+    bounds = plan_key_ranges(histogram, connections * RANGES_PER_CONNECTION)
+    if not bounds:
+        return None
+
+    print(
+        f"Copying {table.quoted_full_name()} (~{total_rows} rows) in {len(bounds) + 1} "
+        f"[{leading_column}] ranges over {connections} connections"
+    )
+    return build_key_range_filters(leading_column, bounds)
+
+
+def copy_src_table_partitioned(
+    src_pool: ConnectionPool,
+    dest_pool: ConnectionPool,
+    table: Table,
+    key_ranges,
+    connections,
+    chunk_size=DEFAULT_CHUNK_SIZE,
+    memory_budget_mb=None,
+    writer_name="executemany",
+    prefetch_chunks=DEFAULT_PREFETCH_CHUNKS,
+    source_filter=None,
+    source_params=(),
+):
+    """Copy a table to stage one key range at a time over connections source/destination
+    connection pairs taken from the pools.  Each range runs on its own pair, and the
+    next range starts as soon as a pair is handed back, until every range is loaded.
+    The memory budget is shared between the pairs.  Returns the total rows copied."""
+
+    def copy_range(range_number, range_filter, range_params):
+        # A delta run keeps its watermark filter inside every range
+        if source_filter:
+            range_filter = f"({source_filter}) AND ({range_filter})"
+            range_params = (*source_params, *range_params)
+
+        with src_pool.connection() as src_conn, dest_pool.connection() as dest_conn:
+            return copy_src_table_to_stage(
+                src_conn=src_conn,
+                dest_conn=dest_conn,
+                table=table,
+                chunk_size=chunk_size,
+                memory_budget_mb=max(1, memory_budget_mb // connections)
+                if memory_budget_mb
+                else None,
+                writer_name=writer_name,
+                prefetch_chunks=prefetch_chunks,
+                source_filter=range_filter,
+                source_params=range_params,
+                writer_id=range_number,
+            )
+
+    total_rows = 0
+    with ThreadPoolExecutor(max_workers=connections) as executor:
+        futures = [
+            executor.submit(copy_range, range_number, range_filter, range_params)
+            for range_number, (range_filter, range_params) in enumerate(
+                key_ranges, start=1
+            )
+        ]
+        try:
+            for future in as_completed(futures):
+                total_rows += future.result()
+        except Exception:
+            # Do not start ranges that have not begun, the copy is redone as a whole
+            for future in futures:
+                future.cancel()
+            raise
+
+    print(f"Copied {total_rows} rows into {table.quoted_stage_name()} over {connections} connections")
+    return total_rows
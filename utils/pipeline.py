@@ -0,0 +1,572 @@
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
+from dataclasses import dataclass
+from time import gmtime, strftime
+from utils import telemetry
+from utils.Table import Table
+from utils.catalog import Catalog
+from utils.connections import ConnectionPool
+from utils.retry import retry_transient
+from utils.wave_constraints import (
+    disable_wave_constraints,
+    restore_wave_constraints,
+    save_deferred_constraints,
+    load_deferred_constraints,
+)
+from utils.run_journal import RunJournal
+from utils.watermarks import (
+    WatermarkStore,
+    get_watermark_column,
+    get_source_high_water_mark,
+    build_watermark_filter,
+    DEFAULT_WATERMARK_LAG_SECONDS,
+)
+from utils.table_details import columns_with_new_keys, change_temporal_state
+from utils.create_stage import (
+    create_stage_table,
+    create_stage_table_pk,
+    drop_stage_table_pk,
+    get_stage_new_columns,
+    truncate_stage_table,
+)
+from utils.constraint_details import get_temporal_combined_keys
+from utils.stage_indexes import create_stage_indexes, drop_stage_indexes
+from utils.table_batch import run_table_batch
+from utils.copy_data import (
+    DEFAULT_CHUNK_SIZE,
+    DEFAULT_PREFETCH_CHUNKS,
+    MERGE_ENGINES,
+    copy_src_table_to_stage,
+    merge_identity_table_data,
+    update_mapped_identity_rows,
+    merge_composite_table_data,
+    merge_unique_table_data,
+    merge_heap_table_data,
+    insert_temporal_history_table_data,
+)
+from utils.partitioned_copy import (
+    DEFAULT_PARTITION_MIN_ROWS,
+    plan_copy_ranges,
+    copy_src_table_partitioned,
+)
+from utils.spool import get_spool_path, spool_src_table, load_spool_to_stage
+from utils.update_keys import (
+    drop_key_map,
+    update_fks_in_stage,
+    update_deferred_fks,
+    update_pk_columns_in_unique_stage,
+    update_temporal_history_stage_keys,
+)
+
+
+# How stage tables are loaded: "indexed" creates the stage PK before the copy, "heap"
+# loads a bare heap WITH (TABLOCK), minimally logged where the database allows it, and
+# builds the PK in one pass afterwards
+STAGE_LOADS = ("indexed", "heap")
+
+
+@dataclass
+class RunSettings:
+    schema_name: str = "dbo"
+    stage_schema: str = "STAGE"
+    workers: int = 1
+    chunk_size: int = DEFAULT_CHUNK_SIZE
+    memory_budget_mb: int = None
+    prefetch_chunks: int = DEFAULT_PREFETCH_CHUNKS
+    backfill_batch_size: int = None
+    merge_batch_size: int = None
+    merge_throttle_seconds: float = 0
+    server_batch: bool = False
+    stage_writer: str = "executemany"
+    incremental: bool = False
+    table_options: dict = None
+    copy_connections: int = 1
+    copy_partition_min_rows: int = DEFAULT_PARTITION_MIN_ROWS
+    spool_dir: str = None
+    stage_load: str = "indexed"
+    defer_constraints: bool = False
+    merge_engine: str = "merge"
+    deferred_constraints_path: str = None
+    deferred_fks: list = None
+    watermark_lag_seconds: int = DEFAULT_WATERMARK_LAG_SECONDS
+
+
+def migrate_table(
+    src_conn,
+    dest_conn,
+    table_name,
+    settings: RunSettings,
+    catalog: Catalog,
+    journal: RunJournal,
+    watermarks: WatermarkStore = None,
+    src_pool: ConnectionPool = None,
+    dest_pool: ConnectionPool = None,
+):
+    """run the full stage, copy, key update and merge pipeline for a single table
+    Phases the journal already has for the table are skipped.  The watermark store
+    records the tables high-water mark; in an incremental run a table finished by an
+    earlier run only copies rows past its mark, and updates the rows it merged before.
+    With connection pools, a large table is copied in key ranges over several
+    connections (settings.copy_connections).  With settings.spool_dir the source is
+    extracted to a local spool file once per run and stage is loaded from it."""
+    if journal.is_done(table_name, "done"):
+        print(f"Table [{table_name}] already finished, skipping")
+        return
+
+    current_table = Table(settings.schema_name, settings.stage_schema, table_name)
+
+    # Gather the table details from the catalog snapshot
+    catalog.populate(current_table)
+
+    # FKs an FK cycle was split on are merged as NULL, run_waves sets them afterwards
+    deferred_parents = {
+        fk["referenced_table"]
+        for fk in settings.deferred_fks or []
+        if fk["table"] == table_name
+    }
+    if deferred_parents:
+        current_table.fk_column_list = [
+            dict(fk, deferred=fk["referenced_table"] in deferred_parents)
+            for fk in current_table.fk_column_list
+        ]
+
+    current_table.column_list_with_new_keys = columns_with_new_keys(
+        table=current_table, include_identity=True
+    )
+    current_table.column_list_new_keys_without_identity = columns_with_new_keys(
+        table=current_table, include_identity=False
+    )
+    is_pk_composite = current_table.is_pk_entirely_fks()
+    temporal_info = current_table.temporal_info
+    temporal_type = temporal_info["temporal_type"]
+
+    # Check for table type and update current Table variables
+    if current_table.identity:
+        current_table.update_type("IDENTITY")
+    elif is_pk_composite:
+        current_table.update_type("COMPOSITE")
+    elif current_table.uniques or current_table.pk_column_list:
+        current_table.update_type("UNIQUE")
+    else:
+        current_table.update_type("HEAP")
+
+    # If table is a Temporal History table, its master's keys get New_ columns in Stage
+    combined_keys = None
+    if temporal_type == "HISTORY":
+        combined_keys = get_temporal_combined_keys(
+            conn=dest_conn,
+            stage_schema=settings.stage_schema,
+            temporal_info=temporal_info,
+            catalog=catalog,
+        )
+
+    is_temporal = temporal_type in ["TEMPORAL", "HISTORY"]
+    stage_built = False
+
+    table_options = (settings.table_options or {}).get(table_name, {})
+    watermark_column = get_watermark_column(
+        table=current_table, configured_column=table_options.get("watermark_column")
+    )
+    incremental = (
+        settings.incremental
+        and watermarks is not None
+        and watermarks.has_run(table_name)
+    )
+
+    # A heap has no key to match changed rows on, without a watermark it would be duplicated
+    if incremental and current_table.type == "HEAP" and watermark_column is None:
+        print(f"Heap [{table_name}] has no watermark column, skipping it in an incremental run")
+        journal.mark_done(table_name, "done")
+        return
+
+    # The single server side batch has no room for merge batches committed one by one
+    server_batch = settings.server_batch and not settings.merge_batch_size
+
+    # A heap load leaves the stage PK until the rows are in, see STAGE_LOADS
+    stage_load = table_options.get("stage_load", settings.stage_load)
+    if stage_load not in STAGE_LOADS:
+        raise ValueError(f"Unknown stage load mode for [{table_name}]: {stage_load}")
+    deferred_pk = stage_load == "heap" and bool(current_table.pk_column_list)
+
+    merge_engine = table_options.get("merge_engine", settings.merge_engine)
+    if merge_engine not in MERGE_ENGINES:
+        raise ValueError(f"Unknown merge engine for [{table_name}]: {merge_engine}")
+
+    # Create the stage table with every New_ column in place, then the PK
+    if not journal.is_done(table_name, "stage_build"):
+        with telemetry.span(table_name, "stage_ddl"):
+            new_columns = get_stage_new_columns(
+                table=current_table, combined_keys=combined_keys
+            )
+            create_stage_table(
+                conn=dest_conn,
+                table=current_table,
+                recreate=True,
+                new_columns=new_columns,
+            )
+            if current_table.pk_column_list and not deferred_pk:
+                create_stage_table_pk(conn=dest_conn, table=current_table)
+
+            # Mappings from an older run must not be mistaken for rows merged by this one,
+            # unless this run is a delta on top of it
+            if current_table.identity and not incremental:
+                drop_key_map(conn=dest_conn, table=current_table)
+        stage_built = True
+        journal.mark_done(table_name, "stage_build")
+
+    # Disable SYSTEM_VERSIONING in order to Process Temporal Tables
+    if is_temporal and not journal.is_done(table_name, "temporal_off"):
+        with telemetry.span(table_name, "temporal_off"):
+            change_temporal_state(
+                conn=dest_conn, temporal_info=temporal_info, state="OFF"
+            )
+        journal.mark_done(table_name, "temporal_off")
+
+    if not journal.is_done(table_name, "copy"):
+        # A copy interrupted by the previous run may have left part of the rows behind
+        if not stage_built:
+            truncate_stage_table(conn=dest_conn, table=current_table)
+
+        spool_path = None
+        if settings.spool_dir:
+            spool_path = get_spool_path(settings.spool_dir, current_table)
+        # A spool finished by the previous run is loaded again without reading the source;
+        # its watermark is still the pending one recorded when it was written
+        spooled = (
+            spool_path is not None
+            and journal.is_done(table_name, "spool")
+            and os.path.exists(spool_path)
+        )
+
+        source_filter = None
+        source_params = ()
+        if watermark_column and watermarks is not None and not spooled:
+            low_water_mark = (
+                watermarks.get(table_name, watermark_column) if incremental else None
+            )
+            high_water_mark = get_source_high_water_mark(
+                src_conn=src_conn,
+                table=current_table,
+                column_name=watermark_column,
+                lag_seconds=settings.watermark_lag_seconds,
+            )
+            watermarks.set_pending(table_name, watermark_column, high_water_mark)
+            # Rows changing while the copy runs are past the high mark, the next run copies them
+            source_filter, source_params = build_watermark_filter(
+                table=current_table,
+                column_name=watermark_column,
+                low_water_mark=low_water_mark,
+                high_water_mark=high_water_mark,
+            )
+            if low_water_mark is not None:
+                print(f"Copying rows of [{table_name}] past its [{watermark_column}] watermark")
+
+        if spool_path is not None and not spooled:
+            spool_src_table(
+                src_conn=src_conn,
+                table=current_table,
+                spool_path=spool_path,
+                chunk_size=settings.chunk_size,
+                memory_budget_mb=settings.memory_budget_mb,
+                prefetch_chunks=settings.prefetch_chunks,
+                source_filter=source_filter,
+                source_params=source_params,
+            )
+            journal.mark_done(table_name, "spool")
+
+        # The load is timed with its deferred PK build, so both load modes compare fairly
+        with telemetry.span(table_name, "stage_load", detail=stage_load) as span:
+            if deferred_pk and not stage_built:
+                # A reload must go into a bare heap again
+                drop_stage_table_pk(conn=dest_conn, table=current_table)
+
+            if spool_path is not None:
+                span["rows"] = load_spool_to_stage(
+                    dest_conn=dest_conn,
+                    table=current_table,
+                    spool_path=spool_path,
+                    writer_name=settings.stage_writer,
+                    tablock=stage_load == "heap",
+                )
+            else:
+                # A per-table copy_connections always splits the table, whatever its size
+                copy_connections = table_options.get(
+                    "copy_connections", settings.copy_connections
+                )
+                key_ranges = None
+                if src_pool is not None and dest_pool is not None:
+                    key_ranges = plan_copy_ranges(
+                        src_conn=src_conn,
+                        table=current_table,
+                        connections=copy_connections,
+                        min_rows=0
+                        if "copy_connections" in table_options
+                        else settings.copy_partition_min_rows,
+                    )
+
+                if key_ranges:
+                    # Concurrent writers would queue on a table lock, they load without one
+                    span["rows"] = copy_src_table_partitioned(
+                        src_pool=src_pool,
+                        dest_pool=dest_pool,
+                        table=current_table,
+                        key_ranges=key_ranges,
+                        connections=copy_connections,
+                        chunk_size=settings.chunk_size,
+                        memory_budget_mb=settings.memory_budget_mb,
+                        writer_name=settings.stage_writer,
+                        prefetch_chunks=settings.prefetch_chunks,
+                        source_filter=source_filter,
+                        source_params=source_params,
+                    )
+                else:
+                    span["rows"] = copy_src_table_to_stage(
+                        src_conn=src_conn,
+                        dest_conn=dest_conn,
+                        table=current_table,
+                        chunk_size=settings.chunk_size,
+                        memory_budget_mb=settings.memory_budget_mb,
+                        writer_name=settings.stage_writer,
+                        prefetch_chunks=settings.prefetch_chunks,
+                        source_filter=source_filter,
+                        source_params=source_params,
+                        tablock=stage_load == "heap",
+                    )
+
+            # Build the PK in one pass over the loaded heap
+            if deferred_pk:
+                with telemetry.span(table_name, "stage_pk"):
+                    create_stage_table_pk(conn=dest_conn, table=current_table)
+
+        # Index the loaded stage table for the FK remap and merge joins
+        if not server_batch:
+            with telemetry.span(table_name, "stage_index"):
+                create_stage_indexes(conn=dest_conn, table=current_table)
+        journal.mark_done(table_name, "copy")
+
+    # Indexes, FK remap and merge as one batch, committed or rolled back as a whole
+    if server_batch and not journal.is_done(table_name, "merge"):
+        with telemetry.span(
+            table_name, "table_batch", detail=f"{current_table.type} {merge_engine}"
+        ) as span:
+            span["rows"] = run_table_batch(
+                conn=dest_conn,
+                table=current_table,
+                combined_keys=combined_keys,
+                backfill_batch_size=settings.backfill_batch_size,
+                incremental=incremental,
+                merge_engine=merge_engine,
+            )
+        journal.mark_done(table_name, "fk_remap")
+        journal.mark_done(table_name, "merge")
+
+    if not journal.is_done(table_name, "fk_remap"):
+        # Before the table merge update any FKs in Stage
+        if current_table.fk_column_list:
+            update_fks_in_stage(
+                conn=dest_conn, table=current_table, incremental=incremental
+            )
+
+        # If temporal_type = HISTORY, treat master_table's PK as a FK in History to be updated accordingly
+        # This must be done before re-enabling SYSTEM_VERSIONING
+        if temporal_type == "HISTORY":
+            update_temporal_history_stage_keys(
+                conn=dest_conn, table=current_table, key_list=combined_keys
+            )
+        journal.mark_done(table_name, "fk_remap")
+
+    if not journal.is_done(table_name, "merge"):
+        # Rows an earlier run merged are in the key map, bring them up to date first
+        if incremental and current_table.type == "IDENTITY":
+            with telemetry.span(table_name, "delta_update") as span:
+                span["rows"] = update_mapped_identity_rows(
+                    conn=dest_conn, table=current_table
+                )
+
+        # Call correct merge function based on TableType
+        with telemetry.span(
+            table_name, "merge", detail=f"{current_table.type} {merge_engine}"
+        ) as span:
+            match current_table.type:
+                case "IDENTITY":
+                    # On resume the key map tells which rows an interrupted merge already inserted
+                    span["rows"] = merge_identity_table_data(
+                        conn=dest_conn,
+                        table=current_table,
+                        backfill_batch_size=settings.backfill_batch_size,
+                        merge_batch_size=settings.merge_batch_size,
+                        merge_throttle_seconds=settings.merge_throttle_seconds,
+                        merge_engine=merge_engine,
+                    )
+                case "UNIQUE":
+                    update_pk_columns_in_unique_stage(
+                        conn=dest_conn, table=current_table
+                    )
+                    span["rows"] = merge_unique_table_data(
+                        conn=dest_conn,
+                        table=current_table,
+                        update_matched=incremental,
+                        merge_engine=merge_engine,
+                    )
+                case "COMPOSITE":
+                    span["rows"] = merge_composite_table_data(
+                        conn=dest_conn,
+                        table=current_table,
+                        update_matched=incremental,
+                        merge_engine=merge_engine,
+                    )
+                case "HEAP":
+                    if temporal_type == "HISTORY":
+                        span["rows"] = insert_temporal_history_table_data(
+                            conn=dest_conn,
+                            table=current_table,
+                            combined_keys=combined_keys,
+                        )
+                    else:
+                        span["rows"] = merge_heap_table_data(
+                            conn=dest_conn, table=current_table
+                        )
+
+        # Heap and history inserts are not keyed, a retried table must never run them twice
+        journal.mark_done(table_name, "merge")
+        drop_stage_indexes(conn=dest_conn, table=current_table)
+
+    # Re-Enable SYSTEM_VERSIONING after MERGE is finished
+    if is_temporal and not journal.is_done(table_name, "temporal_on"):
+        with telemetry.span(table_name, "temporal_on"):
+            change_temporal_state(
+                conn=dest_conn, temporal_info=temporal_info, state="ON"
+            )
+        journal.mark_done(table_name, "temporal_on")
+
+    if watermarks is not None:
+        watermarks.commit(table_name)
+    journal.mark_done(table_name, "done")
+    print(f"Finished table [{table_name}]")
+    print("")
+
+
+def set_deferred_fks(
+    dest_pool: ConnectionPool, catalog: Catalog, settings: RunSettings, table_names
+):
+    """Set the FKs merged as NULL to split an FK cycle, see RunSettings.deferred_fks,
+    whose referenced table is one of table_names, once those tables are merged"""
+    referencing = {}
+    for fk in settings.deferred_fks or []:
+        if fk["referenced_table"] in table_names:
+            referencing.setdefault(fk["table"], set()).add(fk["referenced_table"])
+
+    for table_name, referenced_tables in sorted(referencing.items()):
+        table = Table(settings.schema_name, settings.stage_schema, table_name)
+        catalog.populate(table)
+        with dest_pool.connection() as dest_conn:
+            update_deferred_fks(
+                conn=dest_conn, table=table, referenced_tables=referenced_tables
+            )
+
+
+def run_waves(
+    waves_list,
+    settings: RunSettings,
+    catalog: Catalog,
+    journal: RunJournal,
+    src_pool: ConnectionPool,
+    dest_pool: ConnectionPool,
+    watermarks: WatermarkStore = None,
+):
+    """Process waves in order.  Tables inside a wave do not depend on each other, so they
+    are run on settings.workers threads.  Each table takes a source and destination
+    connection from the pools and hands them back when it is done, so a connection
+    dropped between tables is replaced.  A table failing on a transient error is run
+    again on new connections, from the first phase the journal has not finished.  Every
+    phase can be run again after failing part way: stage tables are rebuilt or emptied,
+    remaps and back-fills overwrite, keyed merges skip merged rows and the temporal
+    toggles check the catalog.  A wave is finished only once all of its tables are.
+    With settings.defer_constraints the waves nonclustered indexes and FK checks are
+    turned off while its tables merge, then rebuilt and re-validated.  A wave marked
+    "serial" runs its tables one at a time, and FKs an FK cycle was split on are set
+    once the wave with their referenced table is finished."""
+
+    def migrate_table_once(table_name):
+        with src_pool.connection() as src_conn, dest_pool.connection() as dest_conn:
+            migrate_table(
+                src_conn,
+                dest_conn,
+                table_name,
+                settings,
+                catalog,
+                journal,
+                watermarks,
+                src_pool=src_pool,
+                dest_pool=dest_pool,
+            )
+
+    def run_table(table_name):
+        # A dropped connection is left out of the pool, the next attempt reconnects and
+        # continues the table from the first phase the journal has not finished
+        retry_transient(
+            lambda: migrate_table_once(table_name),
+            f"table [{table_name}]",
+            reconnects=True,
+        )
+
+    if settings.defer_constraints:
+        # A run that crashed mid-wave left that waves indexes and FK checks disabled
+        pending = load_deferred_constraints(settings.deferred_constraints_path)
+        if pending:
+            print(f"Restoring indexes and FK checks left disabled in wave # {pending['wave_num']}")
+            restore_wave_constraints(dest_pool, pending, workers=settings.workers)
+            save_deferred_constraints(settings.deferred_constraints_path, None)
+
+    with ThreadPoolExecutor(max_workers=settings.workers) as executor:
+        for wave in waves_list:
+            print(f"Processing Wave # {wave['wave_num']}...")
+            print(strftime("%Y-%m-%d %H:%M:%S", gmtime()))
+            print("#####################################################")
+
+            deferred = None
+            if settings.defer_constraints:
+                with dest_pool.connection() as dest_conn:
+                    deferred = disable_wave_constraints(
+                        conn=dest_conn,
+                        schema_name=settings.schema_name,
+                        table_names=wave["tables"],
+                        wave_num=wave["wave_num"],
+                    )
+                save_deferred_constraints(settings.deferred_constraints_path, deferred)
+
+            futures = []
+            try:
+                if wave.get("serial"):
+                    # An FK cycle without a nullable FK to split on, no two of its
+                    # tables may read each others stage tables while they are built
+                    for table_name in wave["tables"]:
+                        futures.append(executor.submit(run_table, table_name))
+                        futures[-1].result()
+                else:
+                    futures = [
+                        executor.submit(run_table, table_name)
+                        for table_name in wave["tables"]
+                    ]
+                    for future in as_completed(futures):
+                        future.result()
+            except Exception:
+                # Stop queued tables of the wave, running ones finish on exit
+                for future in futures:
+                    future.cancel()
+                if deferred is not None:
+                    # Best effort once the running tables stop, the waves own error is
+                    # the one to report
+                    wait(futures)
+                    try:
+                        restore_wave_constraints(dest_pool, deferred, workers=settings.workers)
+                        save_deferred_constraints(settings.deferred_constraints_path, None)
+                    except Exception as e:
+                        print(f"Could not restore the indexes and FK checks of wave # {wave['wave_num']}: {e}")
+                raise
+
+            set_deferred_fks(dest_pool, catalog, settings, wave["tables"])
+
+            if deferred is not None:
+                restore_wave_constraints(dest_pool, deferred, workers=settings.workers)
+                save_deferred_constraints(settings.deferred_constraints_path, None)
@@ -0,0 +1,100 @@
+import random
+import re
+import threading
+from time import sleep
+
+# SQL Server errors worth another attempt on the same connection: deadlock victim, lock
+# request timeout, query timeout, resource shortages and Azure SQL throttling
+IN_PLACE_ERROR_CODES = {1205, 1222, -2, 701, 8645, 40501, 49918, 49919, 49920}
+# Errors of a dropped or unusable connection, worth another attempt on a new one only
+CONNECTION_ERROR_CODES = {4060, 40197, 40613, 10053, 10054, 10060, 233, 64, 121}
+TRANSIENT_ERROR_CODES = IN_PLACE_ERROR_CODES | CONNECTION_ERROR_CODES
+# ODBC states of a broken link, a query timeout and a serialization failure
+CONNECTION_SQLSTATES = {"08S01", "08001"}
+TRANSIENT_SQLSTATES = CONNECTION_SQLSTATES | {"HYT00", "HYT01", "40001"}
+# pyodbc ends each diagnostic record with the native error code and the ODBC function,
+# e.g. "... deadlock victim ... (1205) (SQLExecDirectW)".  Other numbers in parentheses
+# are part of the message, such as the key value of a duplicate key error.
+NATIVE_ERROR_CODE = re.compile(r"\((-?\d+)\)\s*\(SQL\w+\)")
+
+DEFAULT_RETRY_ATTEMPTS = 3
+DEFAULT_BACKOFF_SECONDS = 1.0
+
+_lock = threading.Lock()
+_attempts = DEFAULT_RETRY_ATTEMPTS
+_backoff_seconds = DEFAULT_BACKOFF_SECONDS
+_retries = 0
+
+
+def configure(attempts=DEFAULT_RETRY_ATTEMPTS, backoff_seconds=DEFAULT_BACKOFF_SECONDS):
+    "set how often, and how far apart, transient failures are retried for the run"
+    global _attempts, _backoff_seconds, _retries
+
+    with _lock:
+        _attempts = max(1, attempts)
+        _backoff_seconds = backoff_seconds
+        _retries = 0
+
+
+def retry_count():
+    "retries made since the run started"
+    with _lock:
+        return _retries
+
+
+def get_native_error_codes(error):
+    "the SQL Server native error codes of the diagnostic records of a pyodbc error"
+    message = " ".join(str(arg) for arg in getattr(error, "args", ()))
+    return {int(code) for code in NATIVE_ERROR_CODE.findall(message)}
+
+
+def get_sqlstate(error):
+    "the SQLSTATE pyodbc puts first in the arguments of its errors, None for other errors"
+    args = getattr(error, "args", ())
+    if args and isinstance(args[0], str) and len(args[0]) == 5:
+        return args[0]
+    return None
+
+
+def is_connection_error(error):
+    "whether a database error means the connection is gone, so only a new one can retry"
+    return get_sqlstate(error) in CONNECTION_SQLSTATES or bool(
+        get_native_error_codes(error) & CONNECTION_ERROR_CODES
+    )
+
+
+def is_transient_error(error):
+    "whether a database error is worth retrying, from its SQLSTATE or native error code"
+    if get_sqlstate(error) in TRANSIENT_SQLSTATES:
+        return True
+    return bool(get_native_error_codes(error) & TRANSIENT_ERROR_CODES)
+
+
+def retry_transient(action, description, on_retry=None, reconnects=False):
+    """Run action until it succeeds, retrying transient errors with exponential backoff
+    and jitter.  action must be safe to run again after a failed attempt.  on_retry is
+    called before each new attempt, to undo what the failed one left behind.  Errors of
+    a dropped connection are only retried when reconnects says action takes a new
+    connection on every attempt.  Other errors, and the last transient one, are raised."""
+    with _lock:
+        attempts = _attempts
+        backoff_seconds = _backoff_seconds
+
+    global _retries
+    for attempt in range(1, attempts + 1):
+        try:
+            return action()
+        except Exception as e:
+            if attempt == attempts or not is_transient_error(e):
+                raise
+            # Retrying on a dead link cannot succeed, leave it to a caller that reconnects
+            if not reconnects and is_connection_error(e):
+                raise
+
+            delay = backoff_seconds * 2 ** (attempt - 1) * random.uniform(0.5, 1.5)
+            print(f"Transient error in {description}, retrying in {delay:.1f}s: {e}")
+            with _lock:
+                _retries += 1
+            sleep(delay)
+            if on_retry is not None:
+                on_retry()
@@ -0,0 +1,62 @@
+import json
+import os
+import threading
+from datetime import datetime, timezone
+
+# Per-table phases in the order the pipeline finishes them
+PHASES = ["stage_build", "temporal_off", "spool", "copy", "fk_remap", "merge", "temporal_on", "done"]
+
+
+class RunJournal:
+    """Durable record of which phase each table has finished, one JSON line per phase.
+    A resumed run reads it back and continues every table from its first unfinished
+    phase.  Without a path the journal is only kept in memory."""
+
+    def __init__(self, path=None, resume=False):
+        self.path = path
+        self.resume = resume
+        self.finished = {}
+        self.lock = threading.Lock()
+
+        if path is None:
+            return
+
+        if resume and os.path.exists(path):
+            with open(path, "r") as f:
+                for line in f:
+                    line = line.strip()
+                    # A crash mid-write can leave a partial last line
+                    if not line:
+                        continue
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    self.finished.setdefault(entry["table"], set()).add(entry["phase"])
+            print(f"Resuming from journal {path}")
+        else:
+            journal_dir = os.path.dirname(path)
+            if journal_dir:
+                os.makedirs(journal_dir, exist_ok=True)
+            open(path, "w").close()
+
+    def is_done(self, table_name, phase):
+        with self.lock:
+            return phase in self.finished.get(table_name, set())
+
+    def mark_done(self, table_name, phase):
+        "record a finished phase and flush it to disk before moving on"
+        entry = {
+            "table": table_name,
+            "phase": phase,
+            "finished_at": datetime.now(timezone.utc).isoformat(),
+        }
+
+        with self.lock:
+            self.finished.setdefault(table_name, set()).add(phase)
+            if self.path is None:
+                return
+            with open(self.path, "a") as f:
+                f.write(json.dumps(entry) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
@@ -0,0 +1,219 @@
+import io
+import mmap
+import os
+import pickle
+import struct
+import zlib
+from time import perf_counter
+from utils import telemetry
+from utils.Table import Table
+from utils.stage_writers import get_stage_writer
+from utils.copy_data import (
+    DEFAULT_CHUNK_SIZE,
+    DEFAULT_PREFETCH_CHUNKS,
+    SAMPLE_ROWS,
+    get_fetch_size,
+    fetch_chunks,
+    read_chunks_ahead,
+)
+
+# Every spool file starts with this, so a file from another format is never replayed
+SPOOL_MAGIC = b"MSSQLSPOOL1\n"
+# Each frame is its compressed length followed by one zlib compressed, pickled chunk
+FRAME_HEADER = struct.Struct(">Q")
+# zlib level 1 compresses row data well at a fraction of the CPU cost of the default
+DEFAULT_COMPRESS_LEVEL = 1
+# The only classes a frame may load: the column value types pyodbc returns
+SPOOL_CLASSES = {
+    ("datetime", "date"),
+    ("datetime", "time"),
+    ("datetime", "datetime"),
+    ("datetime", "timedelta"),
+    ("datetime", "timezone"),
+    ("decimal", "Decimal"),
+    ("uuid", "UUID"),
+    ("uuid", "SafeUUID"),
+    ("builtins", "bytearray"),
+}
+
+
+class SpoolUnpickler(pickle.Unpickler):
+    "an Unpickler that loads row values only, so a tampered frame cannot run code"
+
+    def find_class(self, module, name):
+        if (module, name) not in SPOOL_CLASSES:
+            raise pickle.UnpicklingError(f"{module}.{name} is not allowed in a spool file")
+        return super().find_class(module, name)
+
+
+def load_spool_frame(frame):
+    "the rows of one compressed frame, see SpoolUnpickler"
+    return SpoolUnpickler(io.BytesIO(zlib.decompress(frame))).load()
+
+
+def get_spool_path(spool_dir, table: Table):
+    "the spool file of a table in spool_dir"
+    return os.path.join(spool_dir, f"{table.schema_name}.{table.table_name}.spool")
+
+
+def write_spool_frames(spool_path, chunks, compress_level=DEFAULT_COMPRESS_LEVEL):
+    """Write chunks of rows to a spool file, one compressed frame per chunk.  The file is
+    written under a temp name and moved into place once complete, so a spool file that
+    exists always holds the whole extract.  The directory and file are created readable by
+    their owner only, they hold a copy of the source data.  Returns the rows and bytes
+    written."""
+    spool_dir = os.path.dirname(spool_path)
+    if spool_dir:
+        os.makedirs(spool_dir, mode=0o700, exist_ok=True)
+
+    total_rows = 0
+    temp_path = f"{spool_path}.tmp"
+    fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "wb") as f:
+        f.write(SPOOL_MAGIC)
+        for rows in chunks:
+            # pyodbc rows are turned into tuples, which every stage writer accepts
+            frame = zlib.compress(
+                pickle.dumps([tuple(row) for row in rows], pickle.HIGHEST_PROTOCOL),
+                compress_level,
+            )
+            f.write(FRAME_HEADER.pack(len(frame)))
+            f.write(frame)
+            total_rows += len(rows)
+        f.flush()
+        os.fsync(f.fileno())
+        spool_bytes = f.tell()
+    os.replace(temp_path, spool_path)
+
+    return total_rows, spool_bytes
+
+
+def read_spool_frames(spool_path):
+    """Yield the chunks of a spool file in the order they were written.  The file is
+    memory-mapped, so frames are read straight from the page cache.  A resumed run reads
+    files an earlier process left behind, so frames are unpickled with SpoolUnpickler,
+    which only loads row values."""
+    with open(spool_path, "rb") as f:
+        if os.fstat(f.fileno()).st_size <= len(SPOOL_MAGIC):
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as spool:
+            if spool[: len(SPOOL_MAGIC)] != SPOOL_MAGIC:
+                raise ValueError(f"{spool_path} is not a spool file")
+
+            offset = len(SPOOL_MAGIC)
+            while offset < len(spool):
+                (frame_size,) = FRAME_HEADER.unpack_from(spool, offset)
+                offset += FRAME_HEADER.size
+                frame = spool[offset : offset + frame_size]
+                if len(frame) != frame_size:
+                    raise ValueError(f"{spool_path} ends in a partial frame")
+                offset += frame_size
+                yield load_spool_frame(frame)
+
+
+def spool_src_table(
+    src_conn,
+    table: Table,
+    spool_path,
+    chunk_size=DEFAULT_CHUNK_SIZE,
+    memory_budget_mb=None,
+    prefetch_chunks=DEFAULT_PREFETCH_CHUNKS,
+    source_filter=None,
+    source_params=(),
+    compress_level=DEFAULT_COMPRESS_LEVEL,
+):
+    """Extract a tables rows from the source into a local spool file, see
+    write_spool_frames.  Chunks are sized as in copy_src_table_to_stage, and with
+    prefetch_chunks above 0 the source is read while earlier chunks are compressed.
+    source_filter and source_params limit the rows as in copy_src_table_to_stage."""
+    src_crsr = src_conn.cursor()
+
+    print(f"Spooling source table [{table.table_name}] to {spool_path}...")
+
+    columns = ",".join(table.column_list)
+
+    timings = {"read": 0.0}
+    spool_start = perf_counter()
+    get_data_sql = f"SELECT {columns} FROM {table.quoted_full_name()}"
+    if source_filter:
+        get_data_sql += f" WHERE {source_filter}"
+    src_crsr.execute(get_data_sql, *source_params)
+
+    rows = src_crsr.fetchmany(min(chunk_size, SAMPLE_ROWS))
+    timings["read"] += perf_counter() - spool_start
+    fetch_size = get_fetch_size(
+        rows=rows,
+        chunk_size=chunk_size,
+        memory_budget_mb=memory_budget_mb,
+        prefetch_chunks=prefetch_chunks,
+    )
+
+    if prefetch_chunks and rows:
+        chunks = read_chunks_ahead(
+            src_crsr, rows, fetch_size, timings, prefetch=prefetch_chunks
+        )
+    else:
+        chunks = fetch_chunks(src_crsr, rows, fetch_size, timings)
+
+    try:
+        total_rows, spool_bytes = write_spool_frames(
+            spool_path=spool_path, chunks=chunks, compress_level=compress_level
+        )
+    finally:
+        chunks.close()
+        src_crsr.close()
+
+    telemetry.record_span(table.table_name, "source_read", timings["read"], rows=total_rows)
+    telemetry.record_span(
+        table.table_name, "spool_write", perf_counter() - spool_start, rows=total_rows
+    )
+
+    print(f"Spooled {total_rows} rows of [{table.table_name}] ({spool_bytes} bytes)")
+    return total_rows
+
+
+def load_spool_to_stage(dest_conn, table: Table, spool_path, writer_name="executemany", tablock=False):
+    """Write the rows of a spool file into the tables stage table with the stage writer
+    writer_name.  Reloading a table reads the local file again, not the source.
+    tablock loads a stage heap with a table lock, see StageWriter."""
+    print(f"Loading stage table of [{table.table_name}] from {spool_path}...")
+
+    writer = get_stage_writer(
+        conn=dest_conn, table=table, writer_name=writer_name, tablock=tablock
+    )
+
+    timings = {"read": 0.0, "write": 0.0}
+    load_start = perf_counter()
+    chunks = read_spool_frames(spool_path)
+
+    total_rows = 0
+    opened = False
+    try:
+        while True:
+            read_start = perf_counter()
+            rows = next(chunks, None)
+            timings["read"] += perf_counter() - read_start
+            if rows is None:
+                break
+
+            write_start = perf_counter()
+            if not opened:
+                writer.open()
+                opened = True
+            writer.write_chunk(rows)
+            timings["write"] += perf_counter() - write_start
+            total_rows += len(rows)
+    finally:
+        chunks.close()
+        writer.close()
+
+    telemetry.record_span(table.table_name, "spool_read", timings["read"], rows=total_rows)
+    telemetry.record_span(
+        table.table_name, "stage_write", timings["write"], rows=total_rows, detail=writer.name
+    )
+    telemetry.record_span(
+        table.table_name, "copy", perf_counter() - load_start, rows=total_rows, detail="spool"
+    )
+
+    print(f"Copied {total_rows} rows into {table.quoted_stage_name()} from the spool")
+    return total_rows
@@ -0,0 +1,99 @@
+from utils.Table import Table
+
+# Data types that cannot be index key columns
+UNINDEXABLE_TYPES = ("text", "ntext", "image", "xml", "geography", "geometry")
+
+
+def plan_stage_indexes(table: Table):
+    """Work out the indexes the FK remap, key back-fill and unique checks need on the
+    stage table.  Returns a list of {"name", "columns"}; columns already leading the
+    stage PK are skipped since the PK covers them."""
+    pk_columns = [pk["PrimaryKeyName"] for pk in table.pk_column_list or []]
+    leading_pk_column = pk_columns[0] if pk_columns else None
+
+    indexes = []
+    planned = set()
+
+    def is_indexable(col):
+        data_type = (table.column_types or {}).get(col.removeprefix("New_"), "")
+        return not (data_type.endswith("(max)") or data_type in UNINDEXABLE_TYPES)
+
+    def add_index(name, columns):
+        if columns[0] == leading_pk_column or tuple(columns) in planned:
+            return
+        if not all(is_indexable(col) for col in columns):
+            return
+        planned.add(tuple(columns))
+        indexes.append({"name": f"IX_STAGE_{table.table_name}_{name}", "columns": columns})
+
+    # update_fks_in_stage joins stage.<fk_col> to the parent key map or stage table
+    for fk in table.fk_column_list or []:
+        add_index(f"FK_{fk['parent_column']}", [fk["parent_column"]])
+
+    # The New_ identity back-fill joins stage.<identity> to the key map
+    if table.identity:
+        add_index("IDENTITY", [table.identity])
+
+    # build_mark_duplicates_sql joins these stage columns to the destination
+    for number, uq_columns in enumerate((table.uniques or {}).values(), start=1):
+        stage_columns = [
+            col if col in table.column_list_with_new_keys else f"New_{col}"
+            for col in uq_columns
+        ]
+        add_index(f"UQ{number}", stage_columns)
+
+    return indexes
+
+
+def build_create_stage_indexes_sql(table: Table):
+    "the statements creating the planned indexes and refreshing statistics, see create_stage_indexes"
+    quoted_stage_name = table.quoted_stage_name()
+
+    statements = []
+    for index in plan_stage_indexes(table=table):
+        columns = ", ".join(f"[{col}]" for col in index["columns"])
+        # Skip indexes left behind by an interrupted run
+        statements.append(
+            f"""
+            IF INDEXPROPERTY(OBJECT_ID('{table.stage_schema}.{table.table_name}'), '{index['name']}', 'IndexID') IS NULL
+            CREATE NONCLUSTERED INDEX [{index['name']}] ON {quoted_stage_name} ({columns});
+            """
+        )
+
+    # Statistics were built on the empty table, refresh them now the rows are loaded
+    statements.append(f"UPDATE STATISTICS {quoted_stage_name};")
+
+    return statements
+
+
+def build_drop_stage_indexes_sql(table: Table):
+    "the statements dropping the planned indexes, see drop_stage_indexes"
+    quoted_stage_name = table.quoted_stage_name()
+
+    return [
+        f"DROP INDEX IF EXISTS [{index['name']}] ON {quoted_stage_name};"
+        for index in plan_stage_indexes(table=table)
+    ]
+
+
+def create_stage_indexes(conn, table: Table):
+    "create the planned indexes on a loaded stage table and refresh its statistics"
+    crsr = conn.cursor()
+
+    statements = build_create_stage_indexes_sql(table=table)
+    for statement in statements:
+        crsr.execute(statement)
+
+    # The last statement is the statistics refresh
+    print(f"Created {len(statements) - 1} supporting indexes on {table.quoted_stage_name()}")
+    crsr.close()
+
+
+def drop_stage_indexes(conn, table: Table):
+    "drop the planned indexes once the table is finished"
+    crsr = conn.cursor()
+
+    for statement in build_drop_stage_indexes_sql(table=table):
+        crsr.execute(statement)
+
+    crsr.close()
@@ -0,0 +1,191 @@
+from utils.Table import Table
+from utils.retry import retry_transient
+
+# Column types fast_executemany binds poorly: (max) types go through slow
+# data-at-execution streaming and sql_variant is not supported at all
+TVP_TYPES = ("sql_variant", "xml", "text", "ntext", "image")
+
+
+class StageWriter:
+    """Writes chunks of source rows into a stage table.  open() is called once before the
+    first chunk and close() once after the last, even when a write fails.  Chunks go
+    through write_chunk, which makes each one all or nothing and retries it.  Writers
+    whose write is a single statement set atomic_write, they need no transaction.
+    tablock inserts WITH (TABLOCK), for a single writer loading a bare heap."""
+
+    name = None
+    atomic_write = False
+
+    def __init__(self, conn, table: Table, writer_id=None, tablock=False):
+        self.conn = conn
+        self.table = table
+        self.writer_id = writer_id
+        self.tablock = tablock
+        self.crsr = None
+        self.identity_insert = False
+
+    def insert_target(self):
+        "the stage table an INSERT writes to, with its table hint"
+        if self.tablock:
+            return f"{self.table.quoted_stage_name()} WITH (TABLOCK)"
+        return self.table.quoted_stage_name()
+
+    def open(self):
+        self.crsr = self.conn.cursor()
+        if self.table.identity:
+            self.crsr.execute(
+                f"SET IDENTITY_INSERT {self.table.quoted_stage_name()} ON"
+            )
+            self.identity_insert = True
+
+    def write(self, rows):
+        raise NotImplementedError
+
+    def write_chunk(self, rows):
+        "write one chunk in its own transaction, retrying it when the failure is transient"
+
+        def attempt():
+            if self.atomic_write:
+                self.write(rows)
+                return
+
+            self.conn.autocommit = False
+            try:
+                self.write(rows)
+                self.conn.commit()
+            except Exception:
+                # A dropped connection has already lost the transaction on the server
+                try:
+                    self.conn.rollback()
+                except Exception:
+                    pass
+                raise
+            finally:
+                try:
+                    self.conn.autocommit = True
+                except Exception:
+                    pass
+
+        retry_transient(attempt, f"a chunk of {self.table.quoted_stage_name()}")
+
+    def close(self):
+        if self.crsr is None:
+            return
+        if self.identity_insert:
+            self.crsr.execute(
+                f"SET IDENTITY_INSERT {self.table.quoted_stage_name()} OFF"
+            )
+        self.crsr.close()
+
+
+class ExecutemanyWriter(StageWriter):
+    "INSERT ... VALUES (?, ...) sent as one parameter array per chunk with fast_executemany"
+
+    name = "executemany"
+
+    def open(self):
+        super().open()
+        self.crsr.fast_executemany = True
+
+        columns = ",".join(self.table.column_list)
+        placeholders = ",".join(["?" for _ in self.table.column_list])
+        self.insert_sql = f"INSERT INTO {self.insert_target()} ({columns}) VALUES ({placeholders})"
+
+    def write(self, rows):
+        self.crsr.executemany(self.insert_sql, rows)
+
+
+class TvpWriter(StageWriter):
+    """INSERT ... SELECT FROM a table-valued parameter, one parameter per chunk.
+    A table type matching the tables columns is created in the stage schema on open and
+    dropped on close.  Writers loading the same table at once need their own writer_id
+    so each gets its own type."""
+
+    name = "tvp"
+    atomic_write = True
+
+    def open(self):
+        super().open()
+
+        self.type_name = f"TVP_{self.table.table_name}"
+        if self.writer_id is not None:
+            self.type_name += f"_{self.writer_id}"
+        quoted_type_name = f"[{self.table.stage_schema}].[{self.type_name}]"
+
+        column_types = get_column_type_definitions(conn=self.conn, table=self.table)
+        type_columns = ", ".join(
+            f"[{col}] {column_types[col]}" for col in self.table.column_list
+        )
+
+        # A type left behind by an earlier run may no longer match the table
+        self.crsr.execute(f"DROP TYPE IF EXISTS {quoted_type_name}")
+        self.crsr.execute(f"CREATE TYPE {quoted_type_name} AS TABLE ({type_columns})")
+        self.quoted_type_name = quoted_type_name
+
+        columns = ",".join(self.table.column_list)
+        self.insert_sql = f"INSERT INTO {self.insert_target()} ({columns}) SELECT {columns} FROM ?"
+
+    def write(self, rows):
+        # pyodbc takes the type name and schema as the first two items of a TVP
+        tvp = [self.type_name, self.table.stage_schema]
+        tvp.extend(tuple(row) for row in rows)
+        self.crsr.execute(self.insert_sql, tvp)
+
+    def close(self):
+        if self.crsr is not None and hasattr(self, "quoted_type_name"):
+            self.crsr.execute(f"DROP TYPE IF EXISTS {self.quoted_type_name}")
+        super().close()
+
+
+STAGE_WRITERS = {writer.name: writer for writer in [ExecutemanyWriter, TvpWriter]}
+
+
+def get_column_type_definitions(conn, table: Table):
+    "full column type definitions, with length, precision and scale, of the destination table"
+    crsr = conn.cursor()
+
+    column_types_query = f"""
+    SELECT c.name AS column_name,
+        TYPE_NAME(c.user_type_id) + CASE
+            WHEN TYPE_NAME(c.user_type_id) IN ('varchar', 'char', 'varbinary', 'binary')
+            THEN '(' + IIF(c.max_length = -1, 'max', CAST(c.max_length AS VARCHAR)) + ')'
+            WHEN TYPE_NAME(c.user_type_id) IN ('nvarchar', 'nchar')
+            THEN '(' + IIF(c.max_length = -1, 'max', CAST(c.max_length / 2 AS VARCHAR)) + ')'
+            WHEN TYPE_NAME(c.user_type_id) IN ('decimal', 'numeric')
+            THEN '(' + CAST(c.precision AS VARCHAR) + ', ' + CAST(c.scale AS VARCHAR) + ')'
+            WHEN TYPE_NAME(c.user_type_id) IN ('datetime2', 'time', 'datetimeoffset')
+            THEN '(' + CAST(c.scale AS VARCHAR) + ')'
+            ELSE '' END AS column_type
+    FROM sys.columns c
+    WHERE c.object_id = OBJECT_ID('{table.schema_name}.{table.table_name}')
+    ORDER BY c.column_id;
+    """
+    crsr.execute(column_types_query)
+    column_types = {row[0]: row[1] for row in crsr.fetchall()}
+
+    crsr.close()
+    return column_types
+
+
+def choose_stage_writer(table: Table, writer_name="auto"):
+    """Name of the stage writer for a table.  "auto" picks the TVP writer when any
+    copied column has a type fast_executemany handles badly, otherwise executemany."""
+    if writer_name != "auto":
+        if writer_name not in STAGE_WRITERS:
+            raise ValueError(f"Unknown stage writer: {writer_name}")
+        return writer_name
+
+    column_types = table.column_types or {}
+    for col in table.column_list:
+        data_type = column_types.get(col, "")
+        if data_type.endswith("(max)") or data_type in TVP_TYPES:
+            return TvpWriter.name
+
+    return ExecutemanyWriter.name
+
+
+def get_stage_writer(conn, table: Table, writer_name="executemany", writer_id=None, tablock=False):
+    "a StageWriter instance for the table, see choose_stage_writer"
+    return STAGE_WRITERS[choose_stage_writer(table=table, writer_name=writer_name)](
+        conn, table, writer_id=writer_id, tablock=tablock
+    )
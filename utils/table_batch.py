@@ -0,0 +1,173 @@
+from utils.Table import Table
+from utils.stage_indexes import build_create_stage_indexes_sql, build_drop_stage_indexes_sql
+from utils.copy_data import (
+    get_identity_merge_sql,
+    build_update_mapped_rows_sql,
+    build_skipped_rows_key_map_sql,
+    build_mark_duplicates_sql,
+    get_composite_merge_sql,
+    get_unique_merge_sql,
+    build_heap_insert_sql,
+    build_temporal_history_insert_sql,
+)
+from utils.update_keys import (
+    build_create_key_map_sql,
+    build_update_new_pk_sql,
+    get_key_maps,
+    build_key_remap_query,
+    build_unique_pk_update_sql,
+    build_orphaned_history_keys_sql,
+)
+
+
+def build_table_batch(
+    conn,
+    table: Table,
+    combined_keys=None,
+    backfill_batch_size=None,
+    incremental=False,
+    merge_engine="merge",
+):
+    """Build everything that runs on a table after its copy as a single T-SQL batch:
+    stage indexes, FK remap, merge, key back-fill and index clean up.  The batch runs in
+    one transaction with XACT_ABORT, any error rolls it back and is re-thrown to the
+    client.  It ends by selecting the merged row count.  Only the key map lookup (and the
+    rare New_ column check of a non PK reference) reads from the server while building.
+    incremental also updates rows merged by an earlier run, as the pipeline does.
+    merge_engine picks MERGE or INSERT ... SELECT for tables without an identity, see
+    MERGE_ENGINES."""
+    statements = build_create_stage_indexes_sql(table=table)
+
+    key_maps = get_key_maps(conn=conn, stage_schema=table.stage_schema)
+
+    for fk in table.fk_column_list or []:
+        remap_query = build_key_remap_query(
+            conn=conn, table=table, key=fk, key_maps=key_maps, incremental=incremental
+        )
+        statements.append(f"{remap_query};")
+
+    if combined_keys:
+        for key in combined_keys:
+            remap_query = build_key_remap_query(
+                conn=conn, table=table, key=key, key_maps=key_maps
+            )
+            statements.append(f"{remap_query};")
+        statements.extend(
+            build_orphaned_history_keys_sql(conn=conn, table=table, key_list=combined_keys)
+        )
+
+    # Each merge is followed by capturing its row count for the result
+    merge_rows = "SET @merged_rows = @@ROWCOUNT;"
+    match table.type:
+        case "IDENTITY":
+            merge_query, unmerged_filter = get_identity_merge_sql(
+                table=table, merge_engine=merge_engine
+            )
+            statements.append(
+                build_create_key_map_sql(conn=conn, table=table, recreate=False)
+            )
+            if incremental:
+                statements.append(build_update_mapped_rows_sql(table=table))
+            statements.extend(
+                build_mark_duplicates_sql(table=table, source_filter=unmerged_filter)
+            )
+            statements.append(
+                merge_query.format(
+                    source=f"(SELECT * FROM {table.quoted_stage_name()} stage WHERE {unmerged_filter})"
+                )
+            )
+            statements.append(merge_rows)
+            statements.append(build_skipped_rows_key_map_sql(table=table))
+            statements.append(
+                build_update_new_pk_sql(table=table, batch_size=backfill_batch_size)
+            )
+        case "UNIQUE":
+            statements.extend(build_unique_pk_update_sql(table=table))
+            statements.extend(
+                build_mark_duplicates_sql(table=table, update_matched=incremental)
+            )
+            statements.append(
+                get_unique_merge_sql(
+                    table=table, update_matched=incremental, merge_engine=merge_engine
+                )
+            )
+            statements.append(merge_rows)
+        case "COMPOSITE":
+            statements.extend(
+                build_mark_duplicates_sql(table=table, update_matched=incremental)
+            )
+            statements.append(
+                get_composite_merge_sql(
+                    table=table, update_matched=incremental, merge_engine=merge_engine
+                )
+            )
+            statements.append(merge_rows)
+        case "HEAP":
+            if combined_keys:
+                statements.append(
+                    build_temporal_history_insert_sql(
+                        table=table, combined_keys=combined_keys
+                    )
+                )
+                statements.append(merge_rows)
+            else:
+                insert_heap_query = build_heap_insert_sql(table=table)
+                if insert_heap_query is not None:
+                    statements.append(insert_heap_query)
+                    statements.append(merge_rows)
+
+    statements.extend(build_drop_stage_indexes_sql(table=table))
+
+    body = "\n".join(statements)
+
+    return f"""
+    SET NOCOUNT ON;
+    SET XACT_ABORT ON;
+    DECLARE @merged_rows BIGINT = 0;
+
+    BEGIN TRY
+        BEGIN TRANSACTION;
+
+        {body}
+
+        COMMIT TRANSACTION;
+    END TRY
+    BEGIN CATCH
+        IF @@TRANCOUNT > 0 ROLLBACK TRANSACTION;
+        -- Pooled connections are reused, hand them back with the default settings
+        SET XACT_ABORT OFF;
+        SET NOCOUNT OFF;
+        THROW;
+    END CATCH;
+
+    SET XACT_ABORT OFF;
+    SET NOCOUNT OFF;
+    SELECT @merged_rows AS merged_rows;
+    """
+
+
+def run_table_batch(
+    conn,
+    table: Table,
+    combined_keys=None,
+    backfill_batch_size=None,
+    incremental=False,
+    merge_engine="merge",
+):
+    "send the post copy work of a table to the server in one round trip, returns the merged row count"
+    crsr = conn.cursor()
+
+    table_batch = build_table_batch(
+        conn=conn,
+        table=table,
+        combined_keys=combined_keys,
+        backfill_batch_size=backfill_batch_size,
+        incremental=incremental,
+        merge_engine=merge_engine,
+    )
+    crsr.execute(table_batch)
+    merged_rows = crsr.fetchone()[0]
+
+    print(f"Ran the index, FK remap and merge batch for {table.quoted_full_name()}")
+    crsr.close()
+    return merged_rows
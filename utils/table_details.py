@@ -13,7 +13,8 @@ def get_column_list(conn, table: Table, include_identity=True):
         WHERE TABLE_SCHEMA = '{table.schema_name}' AND TABLE_NAME = '{table.table_name}'
             AND COLUMNPROPERTY(
                 object_id('{table.schema_name}.{table.table_name}'), COLUMN_NAME, 'IsComputed'
-            ) = 0;
+            ) = 0
+            AND DATA_TYPE <> 'timestamp';
         SELECT @column_list AS ColumnList;
         """
     else:
@@ -25,6 +26,7 @@ def get_column_list(conn, table: Table, include_identity=True):
             AND COLUMNPROPERTY(
                 object_id('{table.schema_name}.{table.table_name}'), COLUMN_NAME, 'IsComputed'
             ) = 0
+            AND DATA_TYPE <> 'timestamp'
             AND NOT COLUMNPROPERTY(
                 object_id('{table.schema_name}.{table.table_name}'), COLUMN_NAME, 'IsIdentity'
             ) = 1;
@@ -84,10 +86,15 @@ def columns_with_new_keys(table: Table, include_identity):
 
 def get_column_data_type(conn, table: Table, column_name):
     "Returns the data type of a tables column"
+    # Served from the catalog snapshot when the table was populated from one
+    if table.column_types and column_name in table.column_types:
+        return table.column_types[column_name]
+
     crsr = conn.cursor()
 
     data_type_query = f"""
         SELECT DATA_TYPE + CASE
+            WHEN CHARACTER_MAXIMUM_LENGTH = -1 THEN '(max)'
             WHEN CHARACTER_MAXIMUM_LENGTH IS NOT NULL
             THEN '(' + CAST(CHARACTER_MAXIMUM_LENGTH AS VARCHAR) + ')'
             ELSE '' END AS DATA_TYPE
@@ -175,7 +182,8 @@ def get_temporal_info(conn, table: Table):
 
 
 def change_temporal_state(conn, temporal_info, state):
-    "State should be either ON or OFF to change SYSTEM_VERSIONING"
+    """State should be either ON or OFF to change SYSTEM_VERSIONING
+    Each step checks the catalog first, so a toggle interrupted part way can be run again."""
     crsr = conn.cursor()
 
     # Extract information from temporal_info
@@ -185,6 +193,11 @@ def change_temporal_state(conn, temporal_info, state):
     history_table = temporal_info.get("history_table")
     validity_period_start = temporal_info["validity_period_start"]
     validity_period_end = temporal_info["validity_period_end"]
+    master_object_id = f"OBJECT_ID('[{master_schema}].[{master_table}]')"
+    has_period = f"EXISTS (SELECT 1 FROM sys.periods WHERE object_id = {master_object_id})"
+    is_versioned = f"""EXISTS (
+        SELECT 1 FROM sys.tables WHERE object_id = {master_object_id} AND temporal_type = 2
+    )"""
 
     if state == "ON":
         # This works around the python datetime.datetime only pulling 6 digits of nanoseconds
@@ -199,12 +212,14 @@ def change_temporal_state(conn, temporal_info, state):
 
         # Before enabling SYSTEM_VERSIONING the PERIOD needs to be added back
         add_period_query = f"""
+        IF NOT {has_period}
         ALTER TABLE [{master_schema}].[{master_table}]
         ADD PERIOD FOR SYSTEM_TIME ({validity_period_start}, {validity_period_end});
         """
         crsr.execute(add_period_query)
 
         temporal_query = f"""
+        IF NOT {is_versioned}
         ALTER TABLE [{master_schema}].[{master_table}]
         SET (
             SYSTEM_VERSIONING = ON (
@@ -217,12 +232,14 @@ def change_temporal_state(conn, temporal_info, state):
 
     elif state == "OFF":
         temporal_query = f"""
+        IF {is_versioned}
         ALTER TABLE [{master_schema}].[{master_table}]
         SET (SYSTEM_VERSIONING = OFF);
         """
         crsr.execute(temporal_query)
 
         drop_period_query = f"""
+        IF {has_period}
         ALTER TABLE [{master_schema}].[{master_table}]
         DROP PERIOD FOR SYSTEM_TIME;
         """
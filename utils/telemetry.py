@@ -0,0 +1,129 @@
+import json
+import os
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from time import perf_counter
+
+# Spans for work that is not tied to a single table, like the catalog load
+RUN_SPAN = "(run)"
+
+_lock = threading.Lock()
+_spans = []
+_path = None
+
+
+def enable(path):
+    "start writing spans to a JSON lines file, replacing any previous one"
+    global _path
+
+    metrics_dir = os.path.dirname(path)
+    if metrics_dir:
+        os.makedirs(metrics_dir, exist_ok=True)
+    open(path, "w").close()
+
+    with _lock:
+        _path = path
+        _spans.clear()
+
+
+def record_span(table_name, phase, seconds, rows=None, detail=None, ok=True):
+    "record one measured span; rows_per_sec is derived when a row count is known"
+    entry = {
+        "table": table_name,
+        "phase": phase,
+        "detail": detail,
+        "seconds": round(seconds, 4),
+        "rows": rows,
+        "rows_per_sec": round(rows / seconds, 1) if rows and seconds > 0 else None,
+        "ok": ok,
+        "finished_at": datetime.now(timezone.utc).isoformat(),
+    }
+
+    with _lock:
+        _spans.append(entry)
+        if _path is not None:
+            with open(_path, "a") as f:
+                f.write(json.dumps(entry) + "\n")
+
+    return entry
+
+
+@contextmanager
+def span(table_name, phase, detail=None):
+    """Time the wrapped block.  The yielded dict takes an optional "rows" count,
+    a span that raises is still recorded with ok = False."""
+    measured = {"rows": None}
+    start = perf_counter()
+    ok = False
+    try:
+        yield measured
+        ok = True
+    finally:
+        record_span(
+            table_name,
+            phase,
+            perf_counter() - start,
+            rows=measured["rows"],
+            detail=detail,
+            ok=ok,
+        )
+
+
+def get_spans():
+    with _lock:
+        return list(_spans)
+
+
+def summarize(spans=None):
+    "total seconds and rows per table, per phase and per table/phase, slowest first"
+    spans = get_spans() if spans is None else spans
+
+    def totals(key, phase=None):
+        grouped = {}
+        for entry in spans:
+            if phase is not None and entry["phase"] != phase:
+                continue
+            group = grouped.setdefault(key(entry), {"seconds": 0.0, "rows": 0})
+            group["seconds"] += entry["seconds"]
+            group["rows"] += entry["rows"] or 0
+        return sorted(grouped.items(), key=lambda item: item[1]["seconds"], reverse=True)
+
+    return {
+        "tables": totals(lambda entry: entry["table"]),
+        "phases": totals(lambda entry: entry["phase"]),
+        "table_phases": totals(lambda entry: (entry["table"], entry["phase"])),
+        # Stage loads by load mode, to choose between "indexed" and "heap" per table when
+        # measured against a real destination
+        "stage_loads": totals(
+            lambda entry: (entry["table"], entry["detail"]), phase="stage_load"
+        ),
+    }
+
+
+def print_summary(top=15):
+    "print where the run spent its time, ranked by seconds"
+    summary = summarize()
+
+    def print_ranked(title, rows):
+        print(title)
+        print(f"{'':<45}{'seconds':>12}{'rows':>14}{'rows/sec':>14}")
+        for name, group in rows[:top]:
+            if isinstance(name, tuple):
+                name = " / ".join(str(part) for part in name)
+            rows_per_sec = (
+                f"{group['rows'] / group['seconds']:.1f}"
+                if group["rows"] and group["seconds"] > 0
+                else ""
+            )
+            print(
+                f"{str(name)[:44]:<45}{group['seconds']:>12.2f}{group['rows']:>14}{rows_per_sec:>14}"
+            )
+        print("")
+
+    print("#####################################################")
+    print_ranked("Time by table", summary["tables"])
+    print_ranked("Time by phase", summary["phases"])
+    print_ranked("Slowest table phases", summary["table_phases"])
+    if summary["stage_loads"]:
+        print_ranked("Stage loads by table and load mode", summary["stage_loads"])
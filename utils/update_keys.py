@@ -1,114 +1,331 @@
+from utils import telemetry
 from utils.table_details import get_column_data_type
+from utils.create_stage import DUPLICATE_FLAG_COLUMN
 from utils.Table import Table
+from utils.retry import retry_transient
 
 
-def create_key_stage(conn, table: Table):
-    "create KeyStage table if it doesnt exist"
-    crsr = conn.cursor()
-
+def build_create_key_map_sql(conn, table: Table, recreate=True):
+    "the statements creating the tables key map, see create_key_map"
     identity_data_type = get_column_data_type(
         conn=conn, table=table, column_name=table.identity
     )
 
-    # Construct column names and data types for the staging table
-    new_identity_column = f"New_{table.identity}"
-    source_identity_column = f"Source_{table.identity}"
+    key_map_name = table.key_map_name(table.identity)
+    quoted_key_map_name = table.quoted_key_map_name(table.identity)
 
-    # Clean up the staging table if needed
-    cleanup_staging_table_sql = f"""
-        DROP TABLE IF EXISTS [{table.stage_schema}].[KeyStage];
+    create_key_map_sql = f"""
+        IF OBJECT_ID('{table.stage_schema}.{key_map_name}', 'U') IS NULL
+        CREATE TABLE {quoted_key_map_name} (
+            [old_id] {identity_data_type} NOT NULL,
+            [new_id] {identity_data_type} NOT NULL,
+            CONSTRAINT [PK_{key_map_name}] PRIMARY KEY CLUSTERED ([old_id])
+        );
     """
-    crsr.execute(cleanup_staging_table_sql)
 
-    # Create a permanent staging table if it doesn't already exist
-    create_staging_table_sql = f"""
-        CREATE TABLE [{table.stage_schema}].[KeyStage] (
-            [{new_identity_column}] {identity_data_type},
-            [{source_identity_column}] {identity_data_type}
+    if recreate:
+        create_key_map_sql = (
+            f"DROP TABLE IF EXISTS {quoted_key_map_name};\n{create_key_map_sql}"
         )
-    """
-    crsr.execute(create_staging_table_sql)
+
+    return create_key_map_sql
+
+
+def create_key_map(conn, table: Table, recreate=True):
+    """Create the tables key map: one row per identity value, old_id -> new_id,
+    clustered on old_id.  It is kept for the whole run so FK remaps of child tables in
+    later waves can join against it instead of the wide parent stage table."""
+    crsr = conn.cursor()
+
+    crsr.execute(build_create_key_map_sql(conn=conn, table=table, recreate=recreate))
 
     crsr.close()
 
-    return new_identity_column, source_identity_column
+    return table.quoted_key_map_name(table.identity)
 
 
-def update_new_pk_in_stage(conn, table: Table, key_arrays):
-    "Update the New_ column in the STAGE schema"
+def drop_key_map(conn, table: Table):
+    "drop the tables key map so a fresh load does not reuse mappings from an older run"
     crsr = conn.cursor()
 
-    # Parse the key_array
-    column_name = key_arrays["column_name"]
-    inserted_identity_values = key_arrays["inserted_identity_values"]
-    source_identity_values = key_arrays["source_identity_values"]
+    crsr.execute(f"DROP TABLE IF EXISTS {table.quoted_key_map_name(table.identity)};")
+
+    crsr.close()
+
+
+def build_update_new_pk_sql(table: Table, batch_size=None):
+    "the UPDATE back-filling the New_ identity column from the key map, see update_new_pk_in_stage"
+    quoted_stage_name = table.quoted_stage_name()
+    quoted_key_map_name = table.quoted_key_map_name(table.identity)
+
+    update_sql = f"""
+        UPDATE stage
+        SET stage.[New_{table.identity}] = km.[new_id]
+        FROM {quoted_stage_name} stage
+        INNER JOIN {quoted_key_map_name} km
+        ON stage.[{table.identity}] = km.[old_id]
+    """
 
-    # Construct and execute dynamic SQL statements to update New_ column
-    for inserted_id, source_id in zip(inserted_identity_values, source_identity_values):
+    if batch_size:
+        identity_data_type = table.column_types[table.identity]
+        # The key map is clustered on old_id so each range is a seek.  The last range ends
+        # at the highest key, so no range end overflows the identity type.  NOCOUNT is put
+        # back as it was, since this also runs on pooled connections and in a table batch
         update_sql = f"""
-        UPDATE [{table.stage_schema}].[{table.table_name}]
-        SET New_{column_name} = ?
-        WHERE {column_name} = ?
+        DECLARE @nocount_was_on BIT = CASE WHEN @@OPTIONS & 512 = 512 THEN 1 ELSE 0 END;
+        DECLARE @range_start {identity_data_type}, @range_end {identity_data_type},
+            @max_key {identity_data_type};
+        SET NOCOUNT ON;
+
+        SELECT @range_start = MIN([old_id]), @max_key = MAX([old_id])
+        FROM {quoted_key_map_name};
+
+        BEGIN TRY
+            WHILE @range_start <= @max_key
+            BEGIN
+                SET @range_end = CASE
+                    WHEN CAST(@max_key AS DECIMAL(38, 0)) - @range_start < {int(batch_size)}
+                    THEN @max_key
+                    ELSE @range_start + {int(batch_size) - 1}
+                END;
+
+                {update_sql}
+                WHERE km.[old_id] >= @range_start AND km.[old_id] <= @range_end;
+
+                IF @range_end = @max_key BREAK;
+                SET @range_start = @range_end + 1;
+            END
+        END TRY
+        BEGIN CATCH
+            IF @nocount_was_on = 0 SET NOCOUNT OFF;
+            THROW;
+        END CATCH;
+
+        IF @nocount_was_on = 0 SET NOCOUNT OFF;
         """
-        crsr.execute(update_sql, inserted_id, source_id)
+    else:
+        update_sql += ";"
+
+    return update_sql
+
+
+def update_new_pk_in_stage(conn, table: Table, batch_size=None):
+    """Update the New_ column in the STAGE schema from the tables key map.
+    The key pairs never leave the server: a single joined UPDATE is run, or when
+    batch_size is given, a server side loop over old_id ranges of the key map.
+    The update only copies values from the key map, so it is retried when it fails
+    on a transient error."""
+    crsr = conn.cursor()
+
+    update_new_pk_query = build_update_new_pk_sql(table=table, batch_size=batch_size)
+    retry_transient(
+        lambda: crsr.execute(update_new_pk_query),
+        f"the key back-fill of {table.quoted_stage_name()}",
+    )
 
     crsr.close()
 
 
-def update_fks_in_stage(conn, table: Table):
-    """"""
+def get_key_maps(conn, stage_schema):
+    "names of the key maps that exist in the stage schema"
     crsr = conn.cursor()
 
+    key_maps_query = f"""
+        SELECT name FROM sys.tables
+        WHERE schema_id = SCHEMA_ID('{stage_schema}') AND name LIKE 'KeyMap[_]%'
+    """
+    crsr.execute(key_maps_query)
+    key_maps = {row[0] for row in crsr.fetchall()}
+
+    crsr.close()
+    return key_maps
+
+
+def build_key_remap_query(conn, table: Table, key, key_maps, incremental=False):
+    """UPDATE setting stage.New_<parent_column> for one FK (or temporal history key).
+    When the referenced table has a key map the remap joins the narrow map, otherwise it
+    falls back to the referenced stage table.  Self references always use the stage table
+    since the tables own map is only filled by its merge.  In an incremental run the
+    referenced stage table only holds the parents delta, so rows it does not match keep
+    their key, the same value the stage join gives for a parent without a key map."""
     quoted_stage_name = table.quoted_stage_name()
+    referenced_table = Table(
+        schema_name=table.schema_name,
+        stage_schema=table.stage_schema,
+        table_name=key["referenced_table"],
+    )
 
-    for fk in table.fk_column_list:
-        # This check is needed for rare occasions where an FK points at a column in
-        # a parent table that is not the PK of that table, so a New_ column was never created
-        new_col_check_query = f"""
-        SELECT COUNT(*) FROM INFORMATION_SCHEMA.COLUMNS
-        WHERE TABLE_SCHEMA = '{table.stage_schema}'
-        AND TABLE_NAME = '{fk['referenced_table']}'
-        AND COLUMN_NAME = 'New_{fk['referenced_column']}'
+    # An FK an FK cycle was split on is merged as NULL, update_deferred_fks sets it
+    # once the referenced table is merged
+    if key.get("deferred"):
+        return f"""
+            UPDATE {quoted_stage_name}
+            SET New_{key['parent_column']} = NULL
         """
-        crsr.execute(new_col_check_query)
-        new_column_exists = crsr.fetchone()[0]
-
-        if new_column_exists:
-            coalesce_string = f"""
-            COALESCE(
-                parent.New_{fk['referenced_column']},
-                parent.{fk['referenced_column']}
-            )
-            """
-        else:
-            coalesce_string = f"parent.{fk['referenced_column']}"
 
-        # Main update query for each New_ fk column of the current table
-        update_query = f"""
+    if (
+        key["referenced_table"] != table.table_name
+        and referenced_table.key_map_name(key["referenced_column"]) in key_maps
+    ):
+        return f"""
             UPDATE stage
-            SET stage.New_{fk['parent_column']} = {coalesce_string}
+            SET stage.New_{key['parent_column']} = km.new_id
             FROM {quoted_stage_name} stage
-            INNER JOIN [{table.stage_schema}].[{fk['referenced_table']}] parent
-            ON stage.{fk['parent_column']} = parent.{fk['referenced_column']}
+            INNER JOIN {referenced_table.quoted_key_map_name(key['referenced_column'])} km
+            ON stage.{key['parent_column']} = km.old_id
         """
-        crsr.execute(update_query)
+
+    crsr = conn.cursor()
+
+    # This check is needed for rare occasions where an FK points at a column in
+    # a parent table that is not the PK of that table, so a New_ column was never created
+    new_col_check_query = f"""
+    SELECT COUNT(*) FROM INFORMATION_SCHEMA.COLUMNS
+    WHERE TABLE_SCHEMA = '{table.stage_schema}'
+    AND TABLE_NAME = '{key['referenced_table']}'
+    AND COLUMN_NAME = 'New_{key['referenced_column']}'
+    """
+    crsr.execute(new_col_check_query)
+    new_column_exists = crsr.fetchone()[0]
+
+    crsr.close()
+
+    if new_column_exists:
+        coalesce_string = f"""
+        COALESCE(
+            parent.New_{key['referenced_column']},
+            parent.{key['referenced_column']}
+        )
+        """
+    else:
+        coalesce_string = f"parent.{key['referenced_column']}"
+
+    remap_query = f"""
+        UPDATE stage
+        SET stage.New_{key['parent_column']} = {coalesce_string}
+        FROM {quoted_stage_name} stage
+        INNER JOIN {referenced_table.quoted_stage_name()} parent
+        ON stage.{key['parent_column']} = parent.{key['referenced_column']}
+    """
+
+    if incremental:
+        remap_query += f""";
+        UPDATE {quoted_stage_name}
+        SET New_{key['parent_column']} = {key['parent_column']}
+        WHERE New_{key['parent_column']} IS NULL AND {key['parent_column']} IS NOT NULL
+    """
+
+    return remap_query
+
+
+def update_fks_in_stage(conn, table: Table, incremental=False):
+    "Translate every FK column of the stage table into the New_ FK column"
+    crsr = conn.cursor()
+
+    key_maps = get_key_maps(conn=conn, stage_schema=table.stage_schema)
+
+    for fk in table.fk_column_list:
+        # Main update query for each New_ fk column of the current table
+        with telemetry.span(table.table_name, "fk_remap", detail=fk["name"]) as span:
+            update_query = build_key_remap_query(
+                conn=conn,
+                table=table,
+                key=fk,
+                key_maps=key_maps,
+                incremental=incremental,
+            )
+            crsr.execute(update_query)
+            span["rows"] = crsr.rowcount
 
         print(f"Updated Foreign Key [{fk['name']}]")
 
     crsr.close()
 
 
-def update_pk_columns_in_unique_stage(conn, table: Table):
-    "Unique tables have New_ columns that should just match the values of their base columns"
+def build_deferred_fk_update_sql(table: Table, fk, key_maps):
+    """UPDATE setting a deferred FK of the merged destination rows, see update_deferred_fks.
+    Each destination row is found by the New_ PK of its stage row, and gets the new key
+    of its parent from the parents key map, or the stage value when it has no key map.
+    Only rows this run merged are set: their FK is still NULL and their stage row was not
+    flagged as skipped by the merge, see build_mark_duplicates_sql.  Stage rows an earlier
+    run merged are never flagged, a delta run merges them again."""
+    quoted_stage_name = table.quoted_stage_name()
+    referenced_table = Table(
+        schema_name=table.schema_name,
+        stage_schema=table.stage_schema,
+        table_name=fk["referenced_table"],
+    )
+
+    row_match = " AND ".join(
+        f"target.[{pk['PrimaryKeyName']}] = stage.[New_{pk['PrimaryKeyName']}]"
+        for pk in table.pk_column_list
+    )
+    key_map_join = ""
+    new_key = f"stage.[{fk['parent_column']}]"
+    if referenced_table.key_map_name(fk["referenced_column"]) in key_maps:
+        key_map_join = f"""
+        INNER JOIN {referenced_table.quoted_key_map_name(fk['referenced_column'])} km
+        ON stage.[{fk['parent_column']}] = km.old_id"""
+        new_key = "km.new_id"
+
+    return f"""
+        UPDATE target
+        SET target.[{fk['parent_column']}] = {new_key}
+        FROM {table.quoted_full_name()} target
+        INNER JOIN {quoted_stage_name} stage ON {row_match}{key_map_join}
+        WHERE stage.[{fk['parent_column']}] IS NOT NULL
+        AND target.[{fk['parent_column']}] IS NULL
+        AND COALESCE(stage.[{DUPLICATE_FLAG_COLUMN}], 0) = 0
+    """
+
+
+def update_deferred_fks(conn, table: Table, referenced_tables):
+    """Set the FKs of table to referenced_tables, merged as NULL to split an FK cycle,
+    now that those tables are merged.  Setting them again is harmless."""
+    if not table.pk_column_list:
+        print(f"WARNING: [{table.table_name}] has no PK, its deferred FKs stay NULL")
+        return
+
     crsr = conn.cursor()
 
+    key_maps = get_key_maps(conn=conn, stage_schema=table.stage_schema)
+
+    for fk in table.fk_column_list:
+        if fk["referenced_table"] not in referenced_tables:
+            continue
+        with telemetry.span(table.table_name, "deferred_fk", detail=fk["name"]) as span:
+            crsr.execute(
+                build_deferred_fk_update_sql(table=table, fk=fk, key_maps=key_maps)
+            )
+            span["rows"] = crsr.rowcount
+
+        print(f"Set deferred Foreign Key [{fk['name']}]")
+
+    crsr.close()
+
+
+def build_unique_pk_update_sql(table: Table):
+    "one UPDATE per PK column copying it into its New_ column, see update_pk_columns_in_unique_stage"
     quoted_stage_name = table.quoted_stage_name()
 
-    for pk in table.pk_column_list:
-        update_query = f"""
+    return [
+        f"""
             UPDATE {quoted_stage_name}
-            SET New_{pk["PrimaryKeyName"]} = {pk["PrimaryKeyName"]}
+            SET New_{pk["PrimaryKeyName"]} = {pk["PrimaryKeyName"]};
         """
+        for pk in table.pk_column_list
+    ]
+
+
+def update_pk_columns_in_unique_stage(conn, table: Table):
+    "Unique tables have New_ columns that should just match the values of their base columns"
+    crsr = conn.cursor()
+
+    quoted_stage_name = table.quoted_stage_name()
+
+    for pk, update_query in zip(
+        table.pk_column_list, build_unique_pk_update_sql(table=table)
+    ):
         crsr.execute(update_query)
 
         print(
@@ -122,43 +339,34 @@ def update_temporal_history_stage_keys(conn, table: Table, key_list):
     "Update key columns in Stage schema for a temporal history table"
     crsr = conn.cursor()
 
-    quoted_stage_name = table.quoted_stage_name()
+    key_maps = get_key_maps(conn=conn, stage_schema=table.stage_schema)
 
     for key in key_list:
-        # This check is needed for rare occasions where an FK points at a column in
-        # a parent table that is not the PK of that table, so a New_ column was never created
-        new_col_check_query = f"""
-        SELECT COUNT(*) FROM INFORMATION_SCHEMA.COLUMNS
-        WHERE TABLE_SCHEMA = '{table.stage_schema}'
-        AND TABLE_NAME = '{key['referenced_table']}'
-        AND COLUMN_NAME = 'New_{key['referenced_column']}'
-        """
-        crsr.execute(new_col_check_query)
-        new_column_exists = crsr.fetchone()[0]
-
-        if new_column_exists:
-            coalesce_string = f"""
-            COALESCE(
-                parent.New_{key['referenced_column']},
-                parent.{key['referenced_column']}
+        with telemetry.span(
+            table.table_name, "fk_remap", detail=key["parent_column"]
+        ) as span:
+            update_query = build_key_remap_query(
+                conn=conn, table=table, key=key, key_maps=key_maps
             )
-            """
-        else:
-            coalesce_string = f"parent.{key['referenced_column']}"
+            crsr.execute(update_query)
+            span["rows"] = crsr.rowcount
 
-        update_query = f"""
-            UPDATE {quoted_stage_name}
-            SET New_{key['parent_column']} = {coalesce_string}
-            FROM {quoted_stage_name} stage
-            INNER JOIN [{table.stage_schema}].[{key['referenced_table']}] parent
-            ON stage.{key['parent_column']} = parent.{key['referenced_column']}
-        """
+    for update_query in build_orphaned_history_keys_sql(
+        conn=conn, table=table, key_list=key_list
+    ):
         crsr.execute(update_query)
 
-    # There may still be records in History that no longer have a corresponding parent Id
-    # because the parent rows might have been removed.  In order to keep the history rows and not
-    # point them at incorrect parents, we will replace them with their negative equivalents.
-    # NOTE: This is a hack, but it's the best we can do.
+    crsr.close()
+
+
+def build_orphaned_history_keys_sql(conn, table: Table, key_list):
+    """There may still be records in History that no longer have a corresponding parent Id
+    because the parent rows might have been removed.  In order to keep the history rows and not
+    point them at incorrect parents, we will replace them with their negative equivalents.
+    NOTE: This is a hack, but it's the best we can do."""
+    quoted_stage_name = table.quoted_stage_name()
+
+    update_queries = []
     for key in key_list:
         col_data_type = get_column_data_type(
             conn=conn, table=table, column_name=key["parent_column"]
@@ -172,11 +380,12 @@ def update_temporal_history_stage_keys(conn, table: Table, key_list):
             "smallint",
             "smallinteger",
         ):
-            update_query = f"""
+            update_queries.append(
+                f"""
                 UPDATE {quoted_stage_name}
                 SET New_{key['parent_column']} = {key['parent_column']} * -1
-                WHERE New_{key['parent_column']} IS NULL
+                WHERE New_{key['parent_column']} IS NULL;
             """
-            crsr.execute(update_query)
+            )
 
-    crsr.close()
+    return update_queries
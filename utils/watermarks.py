@@ -0,0 +1,205 @@
+import json
+import os
+import threading
+from datetime import date, datetime
+from utils.Table import Table
+from utils.catalog import ROWVERSION_TYPES
+
+# Date and time watermarks stop this far behind the source clock, so rows of transactions
+# still open when the mark is read are copied by the next run
+DEFAULT_WATERMARK_LAG_SECONDS = 300
+DATETIME_TYPES = ("date", "datetime", "datetime2", "smalldatetime", "datetimeoffset")
+
+
+def encode_watermark(value):
+    "a JSON friendly {kind, value} for a high-water mark read from the source"
+    if value is None:
+        return None
+    if isinstance(value, (bytes, bytearray)):
+        return {"kind": "rowversion", "value": bytes(value).hex()}
+    if isinstance(value, datetime):
+        return {"kind": "datetime", "value": value.isoformat()}
+    if isinstance(value, date):
+        return {"kind": "date", "value": value.isoformat()}
+    return {"kind": "number", "value": value}
+
+
+def decode_watermark(encoded):
+    "the query parameter for an encoded high-water mark"
+    if encoded is None:
+        return None
+    match encoded["kind"]:
+        case "rowversion":
+            return bytes.fromhex(encoded["value"])
+        case "datetime":
+            return datetime.fromisoformat(encoded["value"])
+        case "date":
+            return date.fromisoformat(encoded["value"])
+        case _:
+            return encoded["value"]
+
+
+def get_watermark_column(table: Table, configured_column=None):
+    """The column a tables delta is tracked by: the column configured in tables.json,
+    else a rowversion column, else the period column of a temporal table (ValidFrom
+    changes on every update of the master, ValidTo is set when a history row is added).
+    None when the table has none of these.  A rowversion column is only read for the
+    watermark, it is never copied since the destination sets its own values."""
+    if configured_column:
+        return configured_column
+
+    for col, data_type in (table.column_types or {}).items():
+        if data_type in ROWVERSION_TYPES:
+            return col
+
+    temporal_info = table.temporal_info or {}
+    match temporal_info.get("temporal_type"):
+        case "TEMPORAL":
+            return temporal_info["validity_period_start"]
+        case "HISTORY":
+            return temporal_info["validity_period_end"]
+
+    return None
+
+
+def get_watermark_type(table: Table, column_name):
+    "the data type of a watermark column without its length, empty when it is not known"
+    return (table.column_types or {}).get(column_name, "").split("(")[0].lower()
+
+
+def is_clock_watermark(table: Table, column_name):
+    """whether the watermark column is read from the sources clock instead of its rows: a
+    rowversion or a date and time column.  A clock watermark is an exclusive upper bound,
+    a watermark read from the rows is the last row copied."""
+    data_type = get_watermark_type(table=table, column_name=column_name)
+    return data_type in ROWVERSION_TYPES or data_type in DATETIME_TYPES
+
+
+def build_high_water_mark_query(
+    table: Table, column_name, lag_seconds=DEFAULT_WATERMARK_LAG_SECONDS
+):
+    """The query reading a tables high-water mark from the source.  A rowversion column
+    uses MIN_ACTIVE_ROWVERSION(): every row below it is committed, while MAX() can be
+    passed by rows an open transaction commits later.  A date and time column uses the
+    sources clock lag_seconds ago, the earlier of local and UTC time since the column
+    may hold either (period columns are UTC).  Other columns use their highest value."""
+    data_type = get_watermark_type(table=table, column_name=column_name)
+    if data_type in ROWVERSION_TYPES:
+        return "SELECT MIN_ACTIVE_ROWVERSION()"
+    if data_type == "datetimeoffset":
+        return f"SELECT DATEADD(SECOND, -{int(lag_seconds)}, SYSDATETIMEOFFSET())"
+    if data_type in DATETIME_TYPES:
+        return f"""
+        SELECT CAST(DATEADD(SECOND, -{int(lag_seconds)}, CASE
+            WHEN SYSUTCDATETIME() < SYSDATETIME() THEN SYSUTCDATETIME()
+            ELSE SYSDATETIME()
+        END) AS {table.column_types[column_name]})
+        """
+    return f"SELECT MAX([{column_name}]) FROM {table.quoted_full_name()}"
+
+
+def get_source_high_water_mark(
+    src_conn, table: Table, column_name, lag_seconds=DEFAULT_WATERMARK_LAG_SECONDS
+):
+    "the high-water mark of the watermark column in the source, see build_high_water_mark_query"
+    crsr = src_conn.cursor()
+
+    crsr.execute(
+        build_high_water_mark_query(
+            table=table, column_name=column_name, lag_seconds=lag_seconds
+        )
+    )
+    row = crsr.fetchone()
+    high_water_mark = row[0] if row else None
+
+    crsr.close()
+    return high_water_mark
+
+
+def build_watermark_filter(table: Table, column_name, low_water_mark, high_water_mark):
+    """The source filter and its parameters copying the rows between two high-water
+    marks.  A clock watermark copies from the low mark up to, not including, the high
+    mark; other watermarks copy past the low mark up to and including the high mark.
+    Without a low mark every row up to the high mark is copied, rows without a value
+    too.  Returns (None, ()) when there is nothing to filter on."""
+    col = f"[{column_name}]"
+    lower, upper = (">=", "<") if is_clock_watermark(table, column_name) else (">", "<=")
+
+    conditions = []
+    params = []
+    if low_water_mark is not None:
+        conditions.append(f"{col} {lower} ?")
+        params.append(low_water_mark)
+    if high_water_mark is not None:
+        if low_water_mark is None:
+            conditions.append(f"({col} {upper} ? OR {col} IS NULL)")
+        else:
+            conditions.append(f"{col} {upper} ?")
+        params.append(high_water_mark)
+
+    if not conditions:
+        return None, ()
+    return " AND ".join(conditions), tuple(params)
+
+
+class WatermarkStore:
+    """Per-table high-water marks of completed runs, kept in a local JSON file.
+    A run records the mark it read before copying as pending and promotes it once the
+    table is done, so a table that fails part way is copied from its old mark again.
+    reset starts the store over, as a full (non incremental) run does."""
+
+    def __init__(self, path=None, reset=False):
+        self.path = path
+        self.lock = threading.Lock()
+        self.tables = {}
+
+        if path is None:
+            return
+
+        if not reset and os.path.exists(path):
+            with open(path, "r") as f:
+                self.tables = json.load(f)
+        else:
+            self.save()
+
+    def save(self):
+        if self.path is None:
+            return
+        store_dir = os.path.dirname(self.path)
+        if store_dir:
+            os.makedirs(store_dir, exist_ok=True)
+        # Write a temp file and swap it in so a crash never leaves a torn store
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, "w") as f:
+            json.dump(self.tables, f, indent=2)
+        os.replace(temp_path, self.path)
+
+    def has_run(self, table_name):
+        "whether a table finished in an earlier run, so its key map and rows are in place"
+        with self.lock:
+            return self.tables.get(table_name, {}).get("completed", False)
+
+    def get(self, table_name, column_name):
+        "the committed high-water mark of a table, None if there is none for this column"
+        with self.lock:
+            entry = self.tables.get(table_name, {})
+            if entry.get("column") != column_name:
+                return None
+            return decode_watermark(entry.get("value"))
+
+    def set_pending(self, table_name, column_name, value):
+        with self.lock:
+            entry = self.tables.setdefault(table_name, {})
+            entry["pending_column"] = column_name
+            entry["pending"] = encode_watermark(value)
+            self.save()
+
+    def commit(self, table_name):
+        "mark a table as completed and promote its pending high-water mark"
+        with self.lock:
+            entry = self.tables.setdefault(table_name, {})
+            if "pending_column" in entry:
+                entry["column"] = entry.pop("pending_column")
+                entry["value"] = entry.pop("pending")
+            entry["completed"] = True
+            self.save()
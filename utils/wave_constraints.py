@@ -0,0 +1,197 @@
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+from utils import telemetry
+from utils.connections import ConnectionPool
+from utils.retry import retry_transient
+
+# SERVERPROPERTY('EngineEdition') of Enterprise (and Developer), Azure SQL Database and
+# Managed Instance, the editions that build an index with a parallel plan
+PARALLEL_INDEX_EDITIONS = (3, 5, 8)
+
+
+def get_wave_indexes(conn, schema_name, table_names):
+    """Enabled nonclustered indexes of the tables that can be disabled during a load.
+    Unique indexes keep enforcing their constraint, so they stay enabled."""
+    crsr = conn.cursor()
+
+    table_list = ", ".join(f"'{table_name}'" for table_name in table_names)
+    indexes_query = f"""
+    SELECT OBJECT_NAME(i.object_id) AS table_name, i.name AS index_name
+    FROM sys.indexes i
+    WHERE i.type = 2   -- Nonclustered rowstore
+    AND i.is_disabled = 0 AND i.is_unique = 0 AND i.is_primary_key = 0
+    AND OBJECT_SCHEMA_NAME(i.object_id) = '{schema_name}'
+    AND OBJECT_NAME(i.object_id) IN ({table_list})
+    ORDER BY table_name, index_name;
+    """
+    crsr.execute(indexes_query)
+    indexes = [{"table": row[0], "index": row[1]} for row in crsr.fetchall()]
+
+    crsr.close()
+    return indexes
+
+
+def get_wave_foreign_keys(conn, schema_name, table_names):
+    "enabled and trusted FKs of the tables, the ones checked on every row merged into them"
+    crsr = conn.cursor()
+
+    table_list = ", ".join(f"'{table_name}'" for table_name in table_names)
+    foreign_keys_query = f"""
+    SELECT OBJECT_NAME(fk.parent_object_id) AS table_name, fk.name AS constraint_name
+    FROM sys.foreign_keys fk
+    WHERE fk.is_disabled = 0 AND fk.is_not_trusted = 0
+    AND OBJECT_SCHEMA_NAME(fk.parent_object_id) = '{schema_name}'
+    AND OBJECT_NAME(fk.parent_object_id) IN ({table_list})
+    ORDER BY table_name, constraint_name;
+    """
+    crsr.execute(foreign_keys_query)
+    foreign_keys = [{"table": row[0], "constraint": row[1]} for row in crsr.fetchall()]
+
+    crsr.close()
+    return foreign_keys
+
+
+def supports_parallel_index_builds(conn):
+    "whether the servers edition builds indexes with a parallel plan"
+    crsr = conn.cursor()
+
+    crsr.execute("SELECT CAST(SERVERPROPERTY('EngineEdition') AS INT)")
+    row = crsr.fetchone()
+
+    crsr.close()
+    return row is not None and row[0] in PARALLEL_INDEX_EDITIONS
+
+
+def disable_wave_constraints(conn, schema_name, table_names, wave_num=None):
+    """Disable the nonclustered indexes and FK checks of a waves tables in one batch.
+    Returns what was disabled, for restore_wave_constraints."""
+    start = perf_counter()
+
+    indexes = get_wave_indexes(conn=conn, schema_name=schema_name, table_names=table_names)
+    foreign_keys = get_wave_foreign_keys(
+        conn=conn, schema_name=schema_name, table_names=table_names
+    )
+
+    statements = [
+        f"ALTER INDEX [{item['index']}] ON [{schema_name}].[{item['table']}] DISABLE;"
+        for item in indexes
+    ]
+    statements.extend(
+        f"ALTER TABLE [{schema_name}].[{item['table']}] NOCHECK CONSTRAINT [{item['constraint']}];"
+        for item in foreign_keys
+    )
+    if statements:
+        crsr = conn.cursor()
+        crsr.execute("\n".join(statements))
+        crsr.close()
+
+    telemetry.record_span(
+        telemetry.RUN_SPAN,
+        "wave_constraints_off",
+        perf_counter() - start,
+        detail=f"wave {wave_num}",
+    )
+    print(
+        f"Disabled {len(indexes)} nonclustered indexes and {len(foreign_keys)} FK checks "
+        f"for wave # {wave_num}"
+    )
+    return {
+        "wave_num": wave_num,
+        "schema_name": schema_name,
+        "indexes": indexes,
+        "foreign_keys": foreign_keys,
+    }
+
+
+def run_each(action, items, concurrency):
+    """Run action on every item over concurrency threads.  Every item is attempted,
+    the first error is raised once all are finished."""
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+        futures = [executor.submit(action, item) for item in items]
+    errors = [future.exception() for future in futures if future.exception()]
+    if errors:
+        raise errors[0]
+
+
+def restore_wave_constraints(dest_pool: ConnectionPool, state, workers=1):
+    """Rebuild the indexes and re-validate the FKs disable_wave_constraints turned off.
+    Editions with parallel index builds rebuild one index at a time with every core,
+    other editions rebuild up to workers indexes at once on their own connections.
+    FKs are checked WITH CHECK, so they are trusted by the optimizer again.  Returns
+    the seconds spent on each step."""
+    schema_name = state["schema_name"]
+
+    with dest_pool.connection() as conn:
+        parallel_builds = supports_parallel_index_builds(conn=conn)
+    rebuild_option = " WITH (MAXDOP = 0)" if parallel_builds else ""
+
+    def run_statement(table_name, phase, detail, statement):
+        # A failed attempt drops its connection, the next one takes a new one
+        def attempt():
+            with dest_pool.connection() as conn:
+                crsr = conn.cursor()
+                crsr.execute(statement)
+                crsr.close()
+
+        with telemetry.span(table_name, phase, detail=detail):
+            retry_transient(attempt, f"{phase} of {detail}", reconnects=True)
+
+    def rebuild_index(item):
+        run_statement(
+            item["table"],
+            "index_rebuild",
+            item["index"],
+            f"ALTER INDEX [{item['index']}] ON [{schema_name}].[{item['table']}] REBUILD{rebuild_option}",
+        )
+
+    def check_foreign_key(item):
+        run_statement(
+            item["table"],
+            "fk_check",
+            item["constraint"],
+            f"ALTER TABLE [{schema_name}].[{item['table']}] WITH CHECK CHECK CONSTRAINT [{item['constraint']}]",
+        )
+
+    # FK checks probe the child tables, so their indexes are rebuilt first
+    rebuild_start = perf_counter()
+    run_each(rebuild_index, state["indexes"], 1 if parallel_builds else workers)
+    rebuild_seconds = perf_counter() - rebuild_start
+
+    check_start = perf_counter()
+    run_each(check_foreign_key, state["foreign_keys"], workers)
+    check_seconds = perf_counter() - check_start
+
+    detail = f"wave {state['wave_num']}"
+    telemetry.record_span(telemetry.RUN_SPAN, "wave_index_rebuild", rebuild_seconds, detail=detail)
+    telemetry.record_span(telemetry.RUN_SPAN, "wave_fk_check", check_seconds, detail=detail)
+    print(
+        f"Rebuilt {len(state['indexes'])} indexes in {rebuild_seconds:.2f}s "
+        f"({'parallel plans' if parallel_builds else f'up to {workers} at once'}) and "
+        f"checked {len(state['foreign_keys'])} FKs in {check_seconds:.2f}s "
+        f"for wave # {state['wave_num']}"
+    )
+    return {"index_rebuild": rebuild_seconds, "fk_check": check_seconds}
+
+
+def save_deferred_constraints(path, state):
+    """Record what a wave disabled, None once it is restored, so a run that crashed with
+    indexes disabled restores them when it starts again"""
+    if path is None:
+        return
+    state_dir = os.path.dirname(path)
+    if state_dir:
+        os.makedirs(state_dir, exist_ok=True)
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "w") as f:
+        json.dump(state, f, indent=2)
+    os.replace(temp_path, path)
+
+
+def load_deferred_constraints(path):
+    "what an earlier run left disabled, None when everything was restored"
+    if path is None or not os.path.exists(path):
+        return None
+    with open(path, "r") as f:
+        return json.load(f)
@@ -0,0 +1,232 @@
+import json
+import os
+
+
+def get_table_dependencies(conn, schema_name):
+    """Read every table of the schema and the FK graph between them in one pass.
+    Returns the table names, a dict of table -> set of tables it depends on, and the
+    (table, referenced table) pairs whose FKs are all on nullable columns, the ones an
+    FK cycle can be split on.  A temporal history table depends on its master table,
+    as the history keys are remapped from the master's stage table."""
+    crsr = conn.cursor()
+
+    tables_query = f"""
+    SELECT t.name AS table_name, h.name AS history_table
+    FROM sys.tables AS t
+    LEFT JOIN sys.tables AS h ON t.history_table_id = h.object_id
+        AND h.schema_id = t.schema_id
+    WHERE SCHEMA_NAME(t.schema_id) = '{schema_name}'
+    ORDER BY t.name;
+    """
+    crsr.execute(tables_query)
+    table_rows = crsr.fetchall()
+
+    foreign_keys_query = f"""
+    SELECT
+        OBJECT_NAME(FK.parent_object_id) AS parent_table,
+        OBJECT_NAME(FK.referenced_object_id) AS referenced_table,
+        MIN(CAST(C.is_nullable AS INT)) AS is_nullable
+    FROM sys.foreign_keys AS FK
+    INNER JOIN sys.foreign_key_columns AS FKC ON FKC.constraint_object_id = FK.object_id
+    INNER JOIN sys.columns AS C ON C.object_id = FKC.parent_object_id
+        AND C.column_id = FKC.parent_column_id
+    WHERE OBJECT_SCHEMA_NAME(FK.parent_object_id) = '{schema_name}'
+        AND OBJECT_SCHEMA_NAME(FK.referenced_object_id) = '{schema_name}'
+    GROUP BY FK.parent_object_id, FK.referenced_object_id;
+    """
+    crsr.execute(foreign_keys_query)
+    fk_rows = crsr.fetchall()
+
+    crsr.close()
+
+    tables = [row.table_name for row in table_rows]
+    dependencies = {table_name: set() for table_name in tables}
+
+    for row in table_rows:
+        if row.history_table:
+            dependencies[row.history_table].add(row.table_name)
+
+    nullable_dependencies = set()
+    for row in fk_rows:
+        dependencies[row.parent_table].add(row.referenced_table)
+        if row.is_nullable == 1:
+            nullable_dependencies.add((row.parent_table, row.referenced_table))
+
+    return tables, dependencies, nullable_dependencies
+
+
+def find_cycles(tables, dependencies):
+    """Tarjan's strongly connected components, written iteratively so deep FK chains
+    do not hit the recursion limit.  Returns every component, cycles are those with
+    more than one table."""
+    index = {}
+    lowlink = {}
+    on_stack = set()
+    stack = []
+    components = []
+    counter = 0
+
+    for root in tables:
+        if root in index:
+            continue
+
+        work = [(root, iter(sorted(dependencies[root])))]
+        index[root] = lowlink[root] = counter
+        counter += 1
+        stack.append(root)
+        on_stack.add(root)
+
+        while work:
+            node, children = work[-1]
+            advanced = False
+            for child in children:
+                if child not in index:
+                    index[child] = lowlink[child] = counter
+                    counter += 1
+                    stack.append(child)
+                    on_stack.add(child)
+                    work.append((child, iter(sorted(dependencies[child]))))
+                    advanced = True
+                    break
+                elif child in on_stack:
+                    lowlink[node] = min(lowlink[node], index[child])
+
+            if advanced:
+                continue
+
+            work.pop()
+            if work:
+                parent = work[-1][0]
+                lowlink[parent] = min(lowlink[parent], lowlink[node])
+
+            if lowlink[node] == index[node]:
+                component = []
+                while True:
+                    member = stack.pop()
+                    on_stack.discard(member)
+                    component.append(member)
+                    if member == node:
+                        break
+                components.append(sorted(component))
+
+    return components
+
+
+def split_cycles(tables, dependencies, nullable_dependencies):
+    """Break FK cycles by dropping nullable FKs from the ordering, one per cycle at a time
+    until no cycle has a nullable FK left.  Returns the remaining dependencies and the
+    (table, referenced table) pairs dropped, whose FKs are loaded as NULL and set once the
+    referenced table is merged."""
+    dependencies = {table_name: set(parents) for table_name, parents in dependencies.items()}
+    deferred = []
+
+    while True:
+        split = False
+        for component in find_cycles(tables, dependencies):
+            if len(component) == 1:
+                continue
+            members = set(component)
+            candidates = sorted(
+                (table_name, parent)
+                for table_name in component
+                for parent in dependencies[table_name]
+                if parent in members
+                and parent != table_name
+                and (table_name, parent) in nullable_dependencies
+            )
+            if candidates:
+                table_name, parent = candidates[0]
+                dependencies[table_name].discard(parent)
+                deferred.append((table_name, parent))
+                split = True
+        if not split:
+            return dependencies, deferred
+
+
+def plan_waves(tables, dependencies, nullable_dependencies=None):
+    """Place every table in the earliest wave after all of its dependencies.
+    This gives the fewest possible waves (the longest dependency chain) and makes each
+    wave as wide as it can be.  FK cycles are split on their nullable FKs first, see
+    split_cycles.  Tables in a cycle that cannot be split share a wave that runs its
+    tables one at a time; self references are ignored for ordering."""
+    self_references = sorted(t for t in tables if t in dependencies[t])
+
+    dependencies, deferred = split_cycles(
+        tables, dependencies, nullable_dependencies or set()
+    )
+
+    # Components come out of Tarjan in reverse topological order: dependencies first
+    components = find_cycles(tables, dependencies)
+    component_of = {}
+    for number, component in enumerate(components):
+        for table_name in component:
+            component_of[table_name] = number
+
+    component_wave = {}
+    for number, component in enumerate(components):
+        wave = 0
+        for table_name in component:
+            for parent in dependencies[table_name]:
+                parent_component = component_of[parent]
+                if parent_component != number:
+                    wave = max(wave, component_wave[parent_component] + 1)
+        component_wave[number] = wave
+
+    waves = [[] for _ in range(max(component_wave.values(), default=-1) + 1)]
+    for table_name in tables:
+        waves[component_wave[component_of[table_name]]].append(table_name)
+
+    cycles = [component for component in components if len(component) > 1]
+    return {
+        "waves": [sorted(wave) for wave in waves],
+        "cycles": cycles,
+        "serial_waves": sorted({component_wave[component_of[cycle[0]]] for cycle in cycles}),
+        "deferred_fks": [
+            {"table": table_name, "referenced_table": parent}
+            for table_name, parent in deferred
+        ],
+        "self_references": self_references,
+    }
+
+
+def write_tables_config(
+    path, db_name, waves, table_options=None, serial_waves=None, deferred_fks=None
+):
+    """write a wave plan out in the tables.json format, as the entry of db_name.
+    The entries of other databases in an existing file are kept, and so are the per-table
+    options of db_name unless table_options is given.
+    serial_waves are the indexes of the waves whose tables must run one at a time."""
+    serial_waves = set(serial_waves or [])
+    wave_list = []
+    for wave_index, wave in enumerate(waves):
+        wave_config = {"wave_num": str(wave_index + 1), "tables": wave}
+        if wave_index in serial_waves:
+            wave_config["serial"] = True
+        wave_list.append(wave_config)
+
+    tables_config = {"databases": []}
+    if os.path.exists(path):
+        with open(path, "r") as f:
+            tables_config = json.load(f)
+        tables_config.setdefault("databases", [])
+
+    existing = [d for d in tables_config["databases"] if d["db_name"] == db_name]
+    if table_options is None and existing:
+        # Per-table options are hand written, carry them over from the entry being replaced
+        table_options = existing[0].get("table_options")
+
+    database = {"db_name": db_name, "waves": wave_list}
+    if deferred_fks:
+        database["deferred_fks"] = deferred_fks
+    if table_options:
+        database["table_options"] = table_options
+
+    if existing:
+        position = tables_config["databases"].index(existing[0])
+        tables_config["databases"][position] = database
+    else:
+        tables_config["databases"].append(database)
+
+    with open(path, "w") as f:
+        json.dump(tables_config, f, indent=2)
+        f.write("\n")